@@ -0,0 +1,260 @@
+"""
+the DependencyGraph class -- the dependencies between products, as given by
+their table files (used by Eups.getDependentProducts(), and so by list -D,
+uses, remove and distrib create).
+"""
+from __future__ import absolute_import, print_function
+
+from . import hooks
+from . import utils
+from .exceptions import TableFileNotFound
+from .graph import Graph
+from .Product import Product
+from .table import Action
+
+class DependencyGraph(object):
+    """
+    The graph of the dependencies between products.  The nodes are Products
+    and the edges are the setupRequired (and unsetupRequired) commands in
+    their table files, each labelled as optional or not.
+
+    Resolving a table file's dependencies (finding the products that satisfy
+    each setupRequired) is done once for each product, exactness, setup type
+    and VRO, however many times the product appears in the dependency trees
+    that are walked, so a single graph is shared by everything that an Eups
+    instance does; see Eups.getDependencyGraph().
+    """
+
+    def __init__(self, Eups):
+        """
+        @param Eups    the Eups instance used to find products
+        """
+        self.Eups = Eups
+        self._expansions = {}           # the memoized results of Table.directDependencies()
+
+    def clear(self):
+        """
+        forget all resolved dependencies (e.g. because products have been declared)
+        """
+        self._expansions = {}
+
+    def directDependencies(self, table, followExact=None, listExternalDependencies=False):
+        """
+        return the products set up and unsetup by a table file, as returned
+        by Table.directDependencies().  The results are remembered for tables
+        that belong to a product.
+
+        @param table          the table in question
+        @param followExact    follow the exact, as-built versions in the
+                                 table file.  If None, use Eups.exact_version
+        @param listExternalDependencies  Return the external dependencies
+        """
+        Eups = self.Eups
+        if followExact is None:
+            followExact = Eups.exact_version
+        followExact = bool(followExact)
+
+        prod = table.topProduct
+        if not prod or not prod.name:
+            return table.directDependencies(Eups, followExact, listExternalDependencies)
+
+        key = (prod.name, prod.version, prod.flavor, table.file, followExact, bool(listExternalDependencies),
+               tuple(Eups.setupType), tuple(Eups.getPreferredTags()), Eups.ignore_versions)
+        try:
+            return self._expansions[key]
+        except KeyError:
+            pass
+
+        deps = table.directDependencies(Eups, followExact, listExternalDependencies)
+        self._expansions[key] = deps
+
+        return deps
+
+    def dependencies(self, table, recursive=None, recursionDepth=0, followExact=None,
+                     productDictionary=None, addDefaultProduct=None, requiredVersions={},
+                     listExternalDependencies=False):
+        """
+        Return the product dependencies of a table as a list of (Product,
+        optional?, recursionDepth) lists; see Table.dependencies() for the
+        meaning of the arguments.  If recursive is a dictionary (rather than
+        True), it lists the products that have already been analysed.
+        """
+        Eups = self.Eups
+        if followExact is None:
+            followExact = Eups.exact_version
+
+        if recursive and not isinstance(recursive, bool):
+            recursiveDict = recursive
+        else:
+            recursiveDict = {}          # dictionary of products we've analysed
+        prodkey = lambda p: "%s-%s" % (p.name, p.version)
+
+        if productDictionary is None:
+            productDictionary = {}
+
+        topProduct = table.topProduct
+        if topProduct not in productDictionary:
+            productDictionary[topProduct] = []
+
+        if addDefaultProduct is None and \
+               topProduct and topProduct.name == hooks.config.Eups.defaultProduct["name"]:
+            addDefaultProduct = False
+
+        deps = []
+        for cmd, productName, product, optional, requestedVRO, noRecursion, vers in \
+                self.directDependencies(table, followExact, listExternalDependencies):
+
+            if cmd == Action.unsetupRequired:
+                #
+                # Remove all mention of the unsetup product
+                #
+                try:
+                    thisProduct = [val for val in deps if val[0].name == productName][0][0]
+                except IndexError:
+                    continue
+                deptable = thisProduct.getTable()
+
+                unsetupProducts = [thisProduct.name]
+                if deptable and not noRecursion:
+                    subDeps = self.dependencies(deptable, recursive=True, followExact=followExact)
+                    unsetupProducts += [val[0].name for val in subDeps]
+
+                for pn in unsetupProducts:
+                    for i in reversed(sorted([i for i, val in enumerate(deps) if val[0].name == pn])):
+                        del deps[i]
+
+                continue
+
+            Eups.pushStack("vro", requestedVRO)
+            try:
+                if requiredVersions and productName in requiredVersions:
+                    q = None
+                    if optional:
+                        q = utils.Quiet(Eups)
+                    product = Eups.findProduct(productName, requiredVersions[productName])
+                    del q
+                    if not product:
+                        product = Product(productName, vers) # it doesn't exist, but it's still a dep.
+
+                val = [product, optional, (recursionDepth if recursive else None)]
+                deps.append(val)
+
+                if recursive and not noRecursion and prodkey(product) not in recursiveDict:
+                    recursiveDict[prodkey(product)] = 1
+                    try:
+                        deptable = product.getTable(addDefaultProduct=addDefaultProduct)
+                    except TableFileNotFound:
+                        deptable = None
+                        val = [Product(productName, vers), optional, recursionDepth]
+                        deps.append(val)
+
+                    if deptable:
+                        deps += self.dependencies(deptable, recursiveDict, recursionDepth + 1, followExact,
+                                                  productDictionary, addDefaultProduct,
+                                                  requiredVersions=requiredVersions)
+            finally:
+                Eups.popStack("vro")
+
+            productDictionary[topProduct].append(val)
+
+        return deps
+
+    def topologicalDepths(self, productDictionary, topProduct=None, checkCycles=False):
+        """
+        Sort the products in a productDictionary (as filled by dependencies())
+        topologically, returning a dictionary mapping each product's name to
+        its depth (the products with the greatest depth must be set up first).
+
+        The defaultProduct (see hooks.config.Eups.defaultProduct) is treated
+        specially, as every product implicitly depends on it.
+
+        @param productDictionary  the dependencies of each Product
+        @param topProduct         the product whose dependencies these are
+        @param checkCycles        Raise RuntimeError if there's a cycle
+        """
+        pdir = {}
+        #
+        # Remove the defaultProduct from productDictionary
+        #
+        productDictionary = productDictionary.copy()
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+        if defaultProduct:
+            prods = [k for k in productDictionary.keys() if k and k.name == defaultProduct]
+            if prods:
+                defaultProduct = prods[0]
+
+                ptable = defaultProduct.getTable()
+                defaultDeps = []
+                if ptable:
+                    defaultDeps = [p[0] for p in self.dependencies(ptable, recursive=True)]
+                pdir[defaultProduct] = set(defaultDeps)
+
+                if topProduct in defaultDeps:
+                    del productDictionary[defaultProduct]
+                    pdir[defaultProduct] = set()
+            else:
+                defaultProduct = None
+
+        if not defaultProduct:
+            pdir[defaultProduct] = set()
+        #
+        # We have to a bit careful as we populate pdir.  There will be dependent cycles induced if
+        # there's an implicit dependency on a product that also appears in defaultProduct's dependencies
+        #
+        for k, values in productDictionary.items():
+            if k == defaultProduct:   # don't modify pdir[defaultProduct]; especially don't add defaultProduct
+                continue
+
+            if k not in pdir:
+                pdir[k] = set()
+
+            for v in values:
+                p = v[0]             # the dependent product
+
+                if p == defaultProduct and k in pdir[defaultProduct]:
+                    continue
+
+                pdir[k].add(p)
+        #
+        # Actually do the topological sort
+        #
+        sortedProducts = Graph(pdir).topologicalLayers(verbose=self.Eups.verbose,
+                                                       checkCycles=checkCycles) # products sorted topologically
+        #
+        # Replace the recursion level by the topological depth
+        #
+        depths = {}
+        nlevel = len(sortedProducts) + 1 # "+ 1" to allow for topProduct
+        for i, pp in enumerate(sortedProducts):
+            for p in pp:
+                if p:
+                    depths[p.name] = nlevel - i - 1
+
+        if defaultProduct:
+            depths[defaultProduct] = nlevel
+
+        return depths
+
+    def findCycles(self, productDictionary):
+        """
+        Return the cycles in a productDictionary (as filled by dependencies())
+        as a list of lists of Products
+        """
+        graph = Graph()
+        for k, values in productDictionary.items():
+            graph.addEdges(k, [v[0] for v in values])
+
+        return graph.cycles()
+
+    def dependents(self, productDictionary):
+        """
+        Invert a productDictionary (as filled by dependencies()), returning a
+        dictionary mapping each Product to the list of (Product, optional)
+        that depend upon it directly
+        """
+        out = {}
+        for k, values in productDictionary.items():
+            for p, optional, depth in values:
+                out.setdefault(p, []).append((k, optional))
+
+        return out
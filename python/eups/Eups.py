@@ -19,7 +19,11 @@ from .tags       import Tags, Tag, TagNotRecognized
 from .exceptions import ProductNotFound, EupsException, TableError, TableFileNotFound
 from .table      import Table, Action
 from .Product    import Product
-from .Uses       import Uses
+from .Uses       import Uses, UsesIndex
+from .SetupCache import SetupCache
+from .DependencyGraph import DependencyGraph
+from .VersionCompare import sortArgs, keysAgree
+from .VersionConstraint import VersionConstraint
 from .utils      import cmp_or_key, xrange, cmp
 from . import hooks
 
@@ -121,7 +125,12 @@ class Eups(object):
                                   find the top-level target product.  Its
                                   dependencies can be found in any of the
                                   directories in path.
-        @param userDataDir      the directory where per-user information is
+        @param readCache        if True, read (and refresh) the product caches;
+                                  if "readonly", only use caches that the
+                                  database journals show to be current, never
+                                  write them, and look up products that have
+                                  changed since in the databases.
+        @param userDataDir     the directory where per-user information is
                                   cached.  If None, this defaults to ~/.eups.
         @param asAdmin          if True, product caches will be saved in the
                                   database directories rather than under the
@@ -184,6 +193,9 @@ class Eups(object):
         utils.Color.colorize(hooks.config.Eups.colorize)
 
         self.oldEnviron = os.environ.copy() # the initial version of the environment
+        self.cacheSetups = hooks.config.Eups.cacheSetups # replay saved setups?  See cachedSetup()
+        self._envPaths = {}             # utils.EnvPaths for path-like variables; see getEnvPath()
+        self._undoRecords = []          # undo records of the products being setup; see recordUndo()
 
         self.aliases = {}               # aliases that we should set
         self.oldAliases = {}            # initial value of aliases.  This is a bit of a fake, as we
@@ -252,6 +264,8 @@ class Eups(object):
         self._msgs = {}                 # used to suppress messages
         self._msgs["setup"] = {}        # used to suppress messages about setups
 
+        self._dependencyGraph = DependencyGraph(self) # the resolved dependencies of products
+
         self._stacks = {}               # used for saving/restoring state
         self._stacks["env"] = []        # environment that we'll setup
         self._stacks["vro"] = []        # the VRO
@@ -312,10 +326,14 @@ class Eups(object):
         # N.b. we'll do the same for user directories (e.g. ~/.eups) later
         #
         self.versions = {}
+        # the flavors of the ProductStacks in self.versions whose saving is
+        # deferred until the end of a batch of declarations, keyed by
+        # EUPS_PATH directory; None unless in a batch (see declareProducts())
+        self._deferredSaves = None
         neededFlavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
         if readCache:
           for p in self.path:
-              self._setProductStack_fromCache(p, neededFlavors)
+              self._setProductStack_fromCache(p, neededFlavors, readOnly=(readCache == "readonly"))
         #
         #
         fallbackList = hooks.config.Eups.fallbackFlavors
@@ -505,6 +523,47 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return db
 
+    def _saveStack(self, eupsPathDir, flavors, label="Warning"):
+        """
+        save the ProductStack for an EUPS_PATH directory after it's been
+        updated, rebuilding it from the database if it's out of sync with its
+        cache.  During a batch of declarations the save is deferred to the
+        end of the batch.
+        @param eupsPathDir  the EUPS_PATH directory
+        @param flavors      the flavor (or list of flavors) that were updated
+        @param label        how to label the message that the cache is out of sync
+        """
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        if self._deferredSaves is not None:
+            self._deferredSaves.setdefault(eupsPathDir, set()).update(flavors)
+            return
+
+        try:
+            self.versions[eupsPathDir].save(flavors)
+        except CacheOutOfSync as e:
+            if self.quiet <= 0:
+                print("%s: %s" % (label, e), file=utils.stdwarn)
+                print("Correcting...", file=utils.stdwarn)
+            self.versions[eupsPathDir].refreshFromDatabase()
+
+    def _cachedStack(self, eupsPathDir, productName, noCache=False):
+        """
+        return the ProductStack that caches a product in an EUPS_PATH directory,
+        or None if the database should be consulted instead (because noCache is
+        true, there is no cache, or the cache is a read-only view that may be
+        out of date for this product)
+        """
+        if noCache or eupsPathDir not in self.versions or not self.versions[eupsPathDir]:
+            return None
+
+        stack = self.versions[eupsPathDir]
+        if stack.readOnly and (productName in stack.stale or not stack.hasProduct(productName)):
+            return None
+
+        return stack
+
     def _userStackCache(self, eupsPathDir):
         if not self.userDataDir:
             return None
@@ -863,8 +922,7 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                 if vroTag == "versionExpr" and versionExpr:
                     if self.isLegalRelativeVersion(versionExpr):  # raises exception if bad syntax used
-                        products = self._findProductsByExpr(name, versionExpr, eupsPathDirs, flavor, noCache)
-                        product = self._selectPreferredProduct(products, ["latest"])
+                        product = self._findLatestProductByExpr(name, versionExpr, eupsPathDirs, flavor, noCache)
 
                         if product:
                             vroReason = [vroTag, versionExpr]
@@ -876,7 +934,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 #
                 vroTag = "version"
                 for root in eupsPathDirs:
-                    if noCache or root not in self.versions or not self.versions[root]:
+                    if not self._cachedStack(root, name, noCache):
                         # go directly to the EUPS database
                         if not os.path.exists(self.getUpsDB(root)):
                             if self.verbose:
@@ -1067,7 +1125,7 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         # search path for an explicit version
         for root in eupsPathDirs:
-            if noCache or root not in self.versions or not self.versions[root]:
+            if not self._cachedStack(root, name, noCache):
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
                     if self.verbose:
@@ -1155,7 +1213,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             return out
 
         for root in eupsPathDirs:
-            if noCache or root not in self.versions or not self.versions[root]:
+            if not self._cachedStack(root, name, noCache):
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
                     if self.verbose:
@@ -1288,7 +1346,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         out = None
 
         for root in eupsPathDirs:
-            if noCache or root not in self.versions or not self.versions[root]:
+            if not self._cachedStack(root, name, noCache):
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
                     if self.verbose:
@@ -1312,19 +1370,18 @@ The what argument tells us what sort of state is expected (allowed values are de
             else:
                 # consult the cache
                 try:
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers.sort(**cmp_or_key(self.version_cmp))
-                    if len(vers) == 0:
+                    latest = self.versions[root].getLatestVersion(name, flavor, self.version_cmp)
+                    if latest is None:
                         continue
 
                     # is latest version in this stack newer than minimum version?
-                    if minver and self.version_cmp(vers[-1], minver) < 0:
+                    if minver and self.version_cmp(latest, minver) < 0:
                         continue
 
-                    if out == None or self.version_cmp(vers[-1],
+                    if out == None or self.version_cmp(latest,
                                                         out.version) > 0:
                         # latest one in this stack is latest one seen
-                        out = self.versions[root].getProduct(name, vers[-1], flavor)
+                        out = self.versions[root].getProduct(name, latest, flavor)
 
                 except ProductNotFound:
                     continue
@@ -1341,7 +1398,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         out = []
         outver = []
         for root in eupsPathDirs:
-            if noCache or root not in self.versions or not self.versions[root]:
+            if not self._cachedStack(root, name, noCache):
                 # go directly to the EUPS database
                 if not os.path.exists(self.getUpsDB(root)):
                     if self.verbose:
@@ -1352,7 +1409,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if len(products) == 0:
                     continue
 
-                products = [z for z in products if self.version_match(z.version, expr)]
+                products = self.version_filter(products, expr, lambda p: p.version)
                 for prod in products:
                     if prod.version not in outver:
                         out.append(prod)
@@ -1362,7 +1419,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 # consult the cache
                 try:
                     vers = self.versions[root].getVersions(name, flavor)
-                    vers = [z for z in vers if self.version_match(z, expr)]
+                    vers = self.version_filter(vers, expr)
                     if len(vers) == 0:
                         continue
                     for ver in vers:
@@ -1376,6 +1433,34 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return out
 
+    def _findLatestProductByExpr(self, name, expr, eupsPathDirs, flavor, noCache):
+        # find the latest product that satisfies the given expression.  The
+        # cached stacks keep their versions sorted, so only the versions
+        # newer than the latest match need be checked against expr (unless
+        # the order depends on which versions are compared; see keysAgree())
+        products = []
+        outver = []
+        for root in eupsPathDirs:
+            if not self._cachedStack(root, name, noCache) or \
+                   not keysAgree(self.version_cmp, self.versions[root].getVersions(name, flavor)):
+                candidates = self._findProductsByExpr(name, expr, [root], flavor, noCache)
+            else:
+                latest = self.versions[root].getLatestVersion(name, flavor, self.version_cmp,
+                                                              lambda v: self.version_match(v, expr))
+                if latest is None:
+                    continue
+                try:
+                    candidates = [self.versions[root].getProduct(name, latest, flavor)]
+                except ProductNotFound:
+                    continue
+
+            for prod in candidates:
+                if prod.version not in outver:
+                    products.append(prod)
+                    outver.append(prod.version)
+
+        return self._selectPreferredProduct(products, ["latest"])
+
     def _selectPreferredProduct(self, products, preferredTags=None):
         # return the product in a list that is most preferred.
         # None is returned if no products are so tagged.
@@ -1391,7 +1476,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             if tag.name == "latest":
                 # find the latest version; first order the versions
                 vers = [p.version for p in products]
-                vers.sort(**cmp_or_key(self.version_cmp))
+                vers.sort(**sortArgs(self.version_cmp, vers))
 
                 # select the product with the latest version
                 if len(vers) > 0:
@@ -1480,9 +1565,10 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                 self._setProductStack_fromCache(dataDir, [self.flavor])
 
-    def _setProductStack_fromCache(self, dataDir, neededFlavors):
+    def _setProductStack_fromCache(self, dataDir, neededFlavors, readOnly=False):
         # the product cache.  If cache is non-existent or out of date, the product info will be refreshed from
-        # the database
+        # the database.  If readOnly, only use a cache that the database's journal shows to be current,
+        # and don't update it; without such a cache, products are looked up in the database
         dbpath = self.getUpsDB(dataDir)
         cacheDir = dbpath
         userCacheDir = self._makeUserCacheDir(dataDir)
@@ -1490,6 +1576,13 @@ The what argument tells us what sort of state is expected (allowed values are de
             # use a user-writable alternate location for the cache
             cacheDir = userCacheDir
 
+        if readOnly:
+            stack = ProductStack.fromCacheReadOnly(dbpath, neededFlavors, persistDir=cacheDir,
+                                                   userTagDir=userCacheDir, verbose=self.verbose)
+            if stack:
+                self.versions[dataDir] = stack
+            return
+
         self.versions[dataDir] = ProductStack.fromCache(dbpath, neededFlavors,
                                                         persistDir=cacheDir,
                                                         userTagDir=userCacheDir,
@@ -1570,6 +1663,49 @@ The what argument tells us what sort of state is expected (allowed values are de
             val = ""
         os.environ[key] = val
 
+    def getEnvPath(self, key, delim=":"):
+        """
+        Return the current value of a path-like environmental variable as a
+        utils.EnvPath.  The EnvPath is only split out of the variable's value
+        if the variable has been changed other than with setEnvPath(); otherwise
+        the EnvPath that was last set is returned, ready to be modified further.
+        @param key     the name of the variable
+        @param delim   the delimiter between elements of the path
+        """
+        val = os.environ.get(key, "")
+
+        path = self._envPaths.get((key, delim))
+        if path is None or (path.value is not val and path.value != val):
+            path = utils.EnvPath(val, delim)
+            self._envPaths[(key, delim)] = path
+
+        return path
+
+    def setEnvPath(self, key, path, prependDelim=False, appendDelim=False, interpolateEnv=True):
+        """
+        Set a path-like environmental variable from a utils.EnvPath
+        @param key            the name of the variable
+        @param path           the EnvPath to set it to
+        @param prependDelim   if True, start the value with a delimiter
+        @param appendDelim    if True, end the value with a delimiter
+        @param interpolateEnv if True, replace ${ENV} by its value if known
+        """
+        npath = str(path)
+        val = npath
+        if prependDelim and not val.startswith(path.delim):
+            val = path.delim + val
+        if appendDelim and not val.endswith(path.delim):
+            val += path.delim
+
+        self.setEnv(key, val, interpolateEnv=interpolateEnv)
+        #
+        # We can reuse the path next time if it's what we'd get by splitting the value
+        #
+        if "" in path or os.environ[key].strip(path.delim) != npath:
+            self._envPaths.pop((key, path.delim), None)
+        else:
+            path.value = os.environ[key]
+
     def unsetEnv(self, key):
         """Unset an environmental variable"""
 
@@ -1677,58 +1813,17 @@ The what argument tells us what sort of state is expected (allowed values are de
     def version_match(self, vname, expr):
         """Return vname if it matches the logical expression expr"""
 
-        expr0 = expr
-        expr = [x for x in re.split(r"\s*(%s|\|\||\s)\s*" % self._relop_re.pattern, expr0) if not re.search(r"^\s*$", x)]
-
-        logop = None                    # the next logical operation to process
-        value = None                    # the value of the current term (e.g. ">= 2.0.0")
-        i = -1
-        while i < len(expr) - 1:
-            i += 1
-
-            if self._relop_re.search(expr[i]):
-                relop = expr[i]; i += 1
-                v = expr[i]
-            elif re.search(r"^[-+.:/\w]+$", expr[i]) and expr[i] not in ("and", "or"):
-                relop = "=="
-                v = expr[i]
-            elif expr[i] == "||" or expr[i] == "or":
-                logop = "or"
-                continue
-            elif expr[i] == "&&" or expr[i] == "and":
-                if not value:
-                    return False        # short circuit
+        return VersionConstraint.compile(expr).match(vname, self.version_match_prim)
 
-                logop = "and"
-                continue
-            else:
-                print("Unexpected operator %s in \"%s\"" % (expr[i], expr0), file=utils.stdwarn)
-                break
-
-            if not logop and value is not None:
-                print("Expected logical operator || or && in \"%s\" at %s" % (expr0, v), file=utils.stdwarn)
-            else:
-                try:
-                    rhs = self.version_match_prim(relop, vname, v)
-                    if not logop:
-                        value = rhs
-                    elif logop == "and":
-                        if value and rhs:
-                            value = True
-                        else:
-                            value = False
-                    elif logop == "or":
-                        if value or rhs:
-                            return vname
-
-                        value = False
-                except ValueError:           # no sort order is defined
-                    return None
-
-        if value:
-            return vname
-        else:
-            return None
+    def version_filter(self, versions, expr, getVersion=None):
+        """
+        Return the elements of a list of versions that match the logical expression expr
+        @param versions    the list of versions
+        @param expr        the expression, e.g. ">= 1.2 || < 0.5"
+        @param getVersion  a function that returns the version of each element of
+                             the list; if None, the elements are the versions
+        """
+        return VersionConstraint.compile(expr).filter(versions, self.version_match_prim, getVersion)
 
     def version_match_prim(self, op, v1, v2):
         """
@@ -1941,18 +2036,30 @@ The what argument tells us what sort of state is expected (allowed values are de
                 del q
 
                 self.alreadySetupProducts[product.name] = (product, vroReason)
+        #
+        # On unsetup, we don't need the table file if the setup left a record of how to undo it
+        #
+        undo = None
+        if not fwd:
+            undo = self._getUndoRecord(product.name)
 
-        try:
-            table = product.getTable(quiet=not fwd, verbose=self.verbose)
-        except TableFileNotFound as e:
-            if fwd:
-                raise
+        if undo is not None:
+            table = None
+            if self.verbose > 2:
+                print("Unsetting up %s %s from its undo record" % (product.name, product.version),
+                      file=utils.stdinfo)
+        else:
+            try:
+                table = product.getTable(quiet=not fwd, verbose=self.verbose)
+            except TableFileNotFound as e:
+                if fwd:
+                    raise
 
-            if not self.force:
-                raise
+                if not self.force:
+                    raise
 
-            table = None
-            print("Warning: %s" % e, file=utils.stdwarn)
+                table = None
+                print("Warning: %s" % e, file=utils.stdwarn)
 
         if table:
             try:
@@ -2067,41 +2174,67 @@ The what argument tells us what sort of state is expected (allowed values are de
             self.unsetEnv(self._envarDirName(product.name))
             self.unsetEnv(self._envarSetupName(product.name))
             self.unsetEnv(utils.dirExtraEnvNameFor(product.name))
+            self.unsetEnv(utils.undoEnvNameFor(product.name))
         #
-        # Process table file
+        # Record what the table file does, so that it can be undone without reading it again;
+        # we can't if some of the dependencies are skipped, as unsetup would skip them too
         #
-        for a in actions:
-            if localProduct:    # we'll set e.g. PATH from localProduct
-                if a.cmd not in (Action.setupOptional,   Action.setupRequired,
-                                 Action.unsetupOptional, Action.unsetupRequired):
-                    continue
-
-            a.execute(self, recursionDepth + 1, fwd, noRecursion=noRecursion, tableProduct=product,
-                      implicitProduct=implicitProduct)
+        undoRecord = None
+        if fwd and setupToplevel and not noRecursion and recursionDepth != self.max_depth:
+            undoRecord = []
+        self._undoRecords.append(undoRecord)
         #
-        # Did we want to use the dependencies from an installed table, but use a different directory?
+        # Process table file
         #
-        if localProduct:
-            localTable = localProduct.getTable(quiet=True)
-            if localTable:
-                localActions = localTable.actions(setupFlavor, setupType=self.setupType, verbose=verbose)
-            else:
-                localActions = []
+        try:
+            if undo is not None:
+                self._applyUndoRecord(undo, recursionDepth, noRecursion)
 
-            for a in localActions:
-                if a.cmd in (Action.setupOptional, Action.setupRequired):
-                    continue
+            for a in actions:
+                if localProduct:    # we'll set e.g. PATH from localProduct
+                    if a.cmd not in (Action.setupOptional,   Action.setupRequired,
+                                     Action.unsetupOptional, Action.unsetupRequired):
+                        continue
 
-                a.execute(self, 0, fwd=True, noRecursion=noRecursion)
+                a.execute(self, recursionDepth + 1, fwd, noRecursion=noRecursion, tableProduct=product,
+                          implicitProduct=implicitProduct)
+            #
+            # Did we want to use the dependencies from an installed table, but use a different directory?
+            #
+            if localProduct:
+                localTable = localProduct.getTable(quiet=True)
+                if localTable:
+                    localActions = localTable.actions(setupFlavor, setupType=self.setupType, verbose=verbose)
+                else:
+                    localActions = []
+
+                for a in localActions:
+                    if a.cmd in (Action.setupOptional, Action.setupRequired):
+                        continue
+
+                    a.execute(self, 0, fwd=True, noRecursion=noRecursion)
+        finally:
+            self._undoRecords.pop()
+
+        if fwd and setupToplevel:
+            undoValue = None
+            if undoRecord is not None:
+                undoValue = _encodeUndoRecord(setup_product_str, undoRecord)
+
+            if undoValue:
+                self.setEnv(utils.undoEnvNameFor(product.name), undoValue)
+            else:
+                self.unsetEnv(utils.undoEnvNameFor(product.name))
 
         if recursionDepth == 0:            # we can cleanup
             if fwd:
                 del self._msgs["setup"]
-        #
-        # we made a copy of os.environ so the usual magic putenv doesn't happen
-        #
-        for key, val in os.environ.items():
-            os.putenv(key, val)
+            #
+            # we made a copy of os.environ so the usual magic putenv doesn't happen;
+            # do it once all the dependencies have been setup
+            #
+            for key, val in os.environ.items():
+                os.putenv(key, val)
 
         return True, product.version, None
 
@@ -2111,6 +2244,237 @@ The what argument tells us what sort of state is expected (allowed values are de
         return self.setup(productName, versionName, fwd=False, optional=optional,
                           recursionDepth=recursionDepth, noRecursion=noRecursion)
 
+    def recordUndo(self, what, *args):
+        """
+        Record how to undo an action carried out while setting up a product (see
+        table.Action.execute()), so that unsetup can undo it without reading the
+        table file again.  Nothing is recorded if the setup isn't being recorded
+        @param what     the action: "envPrepend", "envSet", "addAlias", or "setupRequired"
+        @param args     what unsetup needs to know to undo it:
+                          envPrepend:     variable, delimiter, values added, prependDelim, appendDelim
+                          envSet:         variable
+                          addAlias:       alias
+                          setupRequired:  product name, noRecursion, optional
+        """
+        if self._undoRecords and self._undoRecords[-1] is not None:
+            self._undoRecords[-1].append((what,) + args)
+
+    def _getUndoRecord(self, productName):
+        """
+        Return the undo record saved when a product was setup, or None if
+        there isn't one or it doesn't describe the current setup of the product
+        """
+        setupStr = os.environ.get(self._envarSetupName(productName))
+        value = os.environ.get(utils.undoEnvNameFor(productName))
+        if not setupStr or not value:
+            return None
+
+        record = _decodeUndoRecord(value)
+        if not record or record[0] != setupStr:
+            return None
+
+        return record[1]
+
+    def _applyUndoRecord(self, record, recursionDepth, noRecursion=False):
+        """
+        Undo the actions of a product's table file, as listed in the undo
+        record saved by setup(); equivalent to executing them with fwd=False
+        """
+        for op in record:
+            what, args = op[0], op[1:]
+            if what == "envPrepend":
+                key, delim, values, prependDelim, appendDelim = args
+
+                path = self.getEnvPath(key, delim)
+                for value in values:
+                    path.remove(value)
+
+                if self.force and key in self.oldEnviron:
+                    del self.oldEnviron[key]
+
+                self.setEnvPath(key, path, prependDelim=prependDelim, appendDelim=appendDelim)
+            elif what == "envSet":
+                key = args[0]
+                if self.force and key in self.oldEnviron:
+                    del self.oldEnviron[key]
+
+                self.unsetEnv(key)
+            elif what == "addAlias":
+                key = args[0]
+                if self.force and key in self.oldAliases:
+                    del self.oldAliases[key]
+
+                self.unsetAlias(key)
+            elif what == "setupRequired":
+                productName, depNoRecursion, optional = args
+                if noRecursion or recursionDepth + 1 == self.max_depth + 1:
+                    continue
+
+                self.pushStack("env")
+
+                q = None
+                if optional:
+                    q = utils.Quiet(self)
+
+                try:
+                    productOK = self.setup(productName, fwd=False, recursionDepth=recursionDepth + 1,
+                                           noRecursion=depNoRecursion, optional=optional)[0]
+                except Exception:
+                    productOK = False
+
+                del q
+
+                if productOK:
+                    self.dropStack("env")
+                else:
+                    self.popStack("env")
+            else:
+                raise RuntimeError("Programming error: unknown action %s in undo record" % what)
+
+    def cachedSetup(self, productName, versionName=None, fwd=True, productRoot=None, tablefile=None):
+        """
+        Update the environment to use (or stop using) a specified product, as
+        setup() does.  If self.cacheSetups (by default hooks.config.Eups.cacheSetups)
+        is set, the outcome is saved, and an identical setup replays it directly
+        as long as nothing that it depends on has changed (see SetupCache).  If
+        self.cacheSetups is "verify", a saved outcome isn't replayed;  the setup is
+        carried out and any differences from the saved outcome are reported.
+
+        Unsetups, and setups of products in a given directory or with a given
+        table file, are never cached.
+
+        @param productName      the name of the product desired
+        @param versionName      the version of the product desired;  see setup()
+        @param fwd              if False, the product will be unset; otherwise
+                                  it will be setup.
+        @param productRoot      the directory where the product is installed
+                                  to assume;  see setup()
+        @param tablefile        use this table file to setup the product
+        @return (success?, version, reason), as returned by setup()
+        """
+        cache = self._setupCacheFor(productName, versionName, fwd, productRoot, tablefile)
+        if not cache:
+            return self.setup(productName, versionName, fwd, productRoot=productRoot, tablefile=tablefile)
+
+        environ = os.environ.copy()
+        saved = cache.load(environ)
+        if saved and self.cacheSetups != "verify":
+            if self.verbose > 1:
+                print("Replaying the saved setup of %s %s" % (productName, saved["productVersion"]),
+                      file=utils.stdinfo)
+            self._replaySetup(saved)
+            return True, saved["productVersion"], None
+        #
+        # Carry out the setup, remembering any messages so that we can replay them too
+        #
+        messages = []
+        streams = dict([(name, getattr(utils, name)) for name in ("stderr", "stdinfo", "stdwarn", "stdok")])
+        stderr = sys.stderr
+        try:
+            for name, stream in streams.items():
+                setattr(utils, name, _MessageRecorder(name, stream, messages))
+            sys.stderr = _MessageRecorder("sys.stderr", stderr, messages)
+
+            ok, version, reason = self.setup(productName, versionName, fwd)
+        finally:
+            for name, stream in streams.items():
+                setattr(utils, name, stream)
+            sys.stderr = stderr
+
+        if not ok:
+            return ok, version, reason
+
+        env = [(k, v) for k, v in os.environ.items() if environ.get(k) != v] + \
+              [(k, None) for k in environ.keys() if k not in os.environ]
+        aliases = self.aliases.copy()
+        unaliases = sorted(self.oldAliases.keys())
+
+        if saved:
+            diffs = []
+            if saved["productVersion"] != version:
+                diffs.append("version: saved %s, found %s" % (saved["productVersion"], version))
+            for what, old, new in [("", dict(saved["env"]), dict(env)), ("alias ", saved["aliases"], aliases),
+                                   ("unalias ", dict.fromkeys(saved["unaliases"], True),
+                                    dict.fromkeys(unaliases, True))]:
+                for key in sorted(set(old.keys()) | set(new.keys())):
+                    if old.get(key) != new.get(key):
+                        diffs.append("%s%s: saved %s, found %s" % (what, key, old.get(key), new.get(key)))
+
+            if not diffs:
+                if self.verbose > 0:
+                    print("The saved setup of %s %s is correct" % (productName, version), file=utils.stdinfo)
+                return ok, version, reason
+
+            print("The saved setup of %s %s differs from the setup just carried out:" %
+                  (productName, version), file=utils.stdwarn)
+            for d in diffs:
+                print("    %s" % d, file=utils.stdwarn)
+
+        products, files = [], []
+        for p, vroReason in self.alreadySetupProducts.values():
+            if vroReason:
+                products.append((p.name, p.version))
+            try:
+                tableFile = p.tableFileName()
+            except Exception:
+                tableFile = None
+            if tableFile:
+                files.append(tableFile)
+        files += [t for t in self.getPreferredTags() if os.path.isfile(t)]
+
+        cache.save(environ, version, sorted(products), sorted(set(files)), env, aliases, unaliases, messages)
+
+        return ok, version, reason
+
+    def _setupCacheFor(self, productName, versionName, fwd, productRoot, tablefile):
+        """
+        Return the SetupCache for a setup, or None if the setup shouldn't be cached
+        """
+        if not self.cacheSetups or not fwd or productRoot or tablefile or \
+               self.noaction or self.force or not self.userDataDir or self.aliases or self.oldAliases:
+            return None
+
+        if isinstance(versionName, Tag):
+            versionName = ("tag", versionName.name)
+        elif utils.is_string(versionName) and versionName.startswith(Product.LocalVersionPrefix):
+            return None
+
+        generations = self._journalGenerations()
+        if generations is None:
+            return None                 # we can't tell if anything's changed
+
+        settings = (productName, versionName, self.flavor, tuple(self.setupType),
+                    tuple(self.getPreferredTags()), bool(self.ignore_versions), bool(self.exact_version),
+                    bool(self.keep), self.max_depth, tuple(self.path), self.verbose, self.quiet,
+                    hooks.config.Eups.defaultProduct["name"])
+
+        return SetupCache(os.path.join(self.userDataDir, "_caches_", "_setups_"), settings, generations)
+
+    def _replaySetup(self, saved):
+        """
+        Replay the outcome of a setup saved by cachedSetup()
+        """
+        for stream, text in saved["messages"]:
+            if stream == "sys.stderr":
+                sys.stderr.write(text)
+            else:
+                getattr(utils, stream).write(text)
+
+        for key, val in saved["env"]:
+            if val is None:
+                self.unsetEnv(key)
+            else:
+                self.setEnv(key, val)
+        for key, val in saved["aliases"].items():
+            self.setAlias(key, val)
+        for key in saved["unaliases"]:
+            self.oldAliases[key] = None
+        #
+        # setup() does this once all the dependencies have been setup
+        #
+        for key, val in os.environ.items():
+            os.putenv(key, val)
+
     def assignTag(self, tag, productName, versionName, eupsPathDir=None, eupsPathDirForRead=None):
         """
         assign the given tag to a product.  The product that it will be
@@ -2122,6 +2486,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param productName   the name of the product to tag
         @param versionName   the version of the product
         """
+        self._dependencyGraph.clear()   # the products may be about to change
+
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2163,13 +2529,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         if root in self.versions and self.versions[root]:
             self.versions[root].ensureInSync(verbose=self.verbose)
             self.versions[root].assignTag(tag, productName, versionName, self.flavor)
-            try:
-                self.versions[root].save(self.flavor)
-            except CacheOutOfSync as e:
-                if self.quiet <= 0:
-                    print("Warning: " + str(e), file=utils.stdwarn)
-                    print("Correcting...", file=utils.stdwarn)
-                self.versions[root].refreshFromDatabase()
+            self._saveStack(root, self.flavor)
 
     def unassignTag(self, tag, productName, versionName=None, eupsPathDir=None, eupsPathDirForRead=None):
         """
@@ -2182,6 +2542,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                                  the first product in the stack with that tag
                                  will be chosen.
         """
+        self._dependencyGraph.clear()   # the products may be about to change
+
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2254,13 +2616,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         if eupsPathDir in self.versions and self.versions[eupsPathDir]:
             self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
             if self.versions[eupsPathDir].unassignTag(str(tag), productName, self.flavor):
-                try:
-                    self.versions[eupsPathDir].save(self.flavor)
-                except CacheOutOfSync as e:
-                    if self.quiet <= 0:
-                        print("Warning: " + str(e), file=utils.stdwarn)
-                        print("Correcting...", file=utils.stdwarn)
-                    self.versions[eupsPathDir].refreshFromDatabase()
+                self._saveStack(eupsPathDir, self.flavor)
 
             elif self.verbose:
                 print("Tag %s not assigned to %s %s" % \
@@ -2323,6 +2679,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param declareCurrent  DEPRECATED, if True and tag=None, it is
                                equivalent to tag="current".
         """
+        self._dependencyGraph.clear()   # the products may be about to change
+
         if re.search(r"[^a-zA-Z_0-9]", productName):
             raise EupsException("Product names may only include the characters [a-zA-Z_0-9]: saw %s" % productName)
 
@@ -2668,14 +3026,7 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                     self.versions[eupsPathDir].ensureInSync(verbose=self.verbose)
                     self.versions[eupsPathDir].addProduct(product)
-
-                    try:
-                        self.versions[eupsPathDir].save(self.flavor)
-                    except CacheOutOfSync as e:
-                        if self.quiet <= 0:
-                            print("Note: " + str(e), file=utils.stdwarn)
-                            print("Correcting...", file=utils.stdwarn)
-                        self.versions[eupsPathDir].refreshFromDatabase()
+                    self._saveStack(eupsPathDir, self.flavor, "Note")
 
         if tag:
             # we just want to update the tag
@@ -2726,6 +3077,99 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if self.verbose > 1:
                     print("Copying %s to %s" % (fileNameIn, pathOut), file=utils.stdinfo)
 
+    def declareProducts(self, products, eupsPathDir=None, atomic=True):
+        """
+        Declare (and/or tag) a list of products as a single batch:  each
+        product is declared as by declare(), but the caches of the product
+        stacks are only saved once, when all the declarations are done.
+
+        If atomic is true, the declarations are a transaction:  if any of
+        them fails, the version and chain files of all the products are put
+        back as they were before the batch started, and the exception is
+        re-raised.  Otherwise, failures are reported (and the names of the
+        products that couldn't be declared are returned), but the other
+        declarations are kept.
+
+        Files imported into a product's "extra" directory are not removed on
+        failure.
+
+        @param products     a list of (productName, versionName, productDir,
+                              tablefile, tags) tuples;  the trailing elements
+                              may be omitted or None, with the same meanings
+                              as the arguments to declare().  tags may be a
+                              single tag name or a list of tag names.
+        @param eupsPathDir  the EUPS product stack to declare the products
+                              into;  see declare()
+        @param atomic       if true, undo all the declarations if any fails
+        @return the names of the products that couldn't be declared
+        """
+        if self._deferredSaves is not None:
+            raise EupsException("declareProducts() may not be called within a batch of declarations")
+
+        records = []
+        for rec in products:
+            rec = list(rec) + [None]*(5 - len(rec))
+            if len(rec) != 5:
+                raise EupsException("Expected (product, version, productDir, tablefile, tags): %s" %
+                                    (rec,))
+            tags = rec[4]
+            if not tags:
+                tags = [None]
+            elif utils.is_string(tags):
+                tags = [tags]
+            records.append((rec[0], rec[1], rec[2], rec[3], tags))
+        #
+        # Record the state of the databases that we might write to
+        #
+        snapshots = []
+        if atomic and not self.noaction:
+            productNames = sorted(set([rec[0] for rec in records]))
+            dirs = [d for d in self.path if utils.isDbWritable(self.getUpsDB(d))]
+            if self.userDataDir and os.path.isdir(self.getUpsDB(self.userDataDir)) and \
+                   self.userDataDir not in dirs:
+                dirs.append(self.userDataDir)
+            for d in dirs:
+                db = self._databaseFor(d)
+                snapshots.append((d, db, db.snapshot(productNames)))
+
+        failed = []
+        self._deferredSaves = {}
+        try:
+            try:
+                for productName, versionName, productDir, tablefile, tags in records:
+                    try:
+                        for i, tag in enumerate(tags):
+                            if i == 0:
+                                self.declare(productName, versionName, productDir, eupsPathDir,
+                                             tablefile, tag=tag)
+                            else:
+                                self.declare(productName, versionName, eupsPathDir=eupsPathDir, tag=tag)
+                    except EupsException as e:
+                        if atomic:
+                            raise
+                        print(e, file=utils.stderr)
+                        failed.append(productName)
+            except:
+                if snapshots:
+                    if self.verbose:
+                        print("Undoing the declarations of %s" % " ".join(productNames),
+                              file=utils.stdinfo)
+                    for d, db, snap in snapshots:
+                        restored = db.restore(snap)
+                        if restored and d in self.versions and self.versions[d]:
+                            self.versions[d].refreshProducts(restored, userTagDir=self._userStackCache(d))
+                            self._deferredSaves.setdefault(d, set()).update(self.versions[d].updated)
+                raise
+        finally:
+            deferred, self._deferredSaves = self._deferredSaves, None
+            self._dependencyGraph.clear()
+
+            for d, flavors in deferred.items():
+                if d in self.versions and self.versions[d]:
+                    self._saveStack(d, sorted(flavors))
+
+        return failed
+
     def undeclare(self, productName, versionName=None, eupsPathDir=None, tag=None,
                   undeclareVersionAndTag=False, undeclareCurrent=None):
         """
@@ -2761,6 +3205,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param undeclareCurrent  DEPRECATED; if True, and tag is None, this
                                 is equivalent to tag="current".
         """
+        self._dependencyGraph.clear()   # the products may be about to change
+
         # this is for backward compatibility
         if isinstance(tag, bool) or (tag is None and undeclareCurrent):
             tag = "current"
@@ -2829,14 +3275,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             self.versions[eupsPathDir].removeProduct(product.name,
                                                      product.flavor,
                                                      product.version)
-
-            try:
-                self.versions[eupsPathDir].save(product.flavor)
-            except CacheOutOfSync as e:
-                if self.quiet <= 0:
-                    print("Warning: " + str(e), file=utils.stdwarn)
-                    print("Correcting...", file=utils.stdwarn)
-                self.versions[eupsPathDir].refreshFromDatabase()
+            self._saveStack(eupsPathDir, product.flavor)
 
         return True
 
@@ -2960,13 +3399,12 @@ The what argument tells us what sort of state is expected (allowed values are de
                                     out.append(prod)
 
                     # select out matched versions
-                    vers = stack.getVersions(pname, flavor)
+                    vers = stack.getSortedVersions(pname, flavor, self.version_cmp)
                     if version:
                         if self.isLegalRelativeVersion(version): # version is actually an expression
-                            vers = [v for v in vers if self.version_match(v, version)]
+                            vers = self.version_filter(vers, version)
                         else:
                             vers = list(fnmatch.filter(vers, version))
-                    vers.sort(**cmp_or_key(self.version_cmp))
 
                     # only include latest if it passes the version constraint
                     if latest is not None and latest.version not in vers:
@@ -3016,7 +3454,7 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if version:
             if self.isLegalRelativeVersion(version):
-                out = [p for p in out if self.version_match(p.version, version)]
+                out = self.version_filter(out, version, lambda p: p.version)
             else:
                 out = [p for p in out if fnmatch.fnmatch(p.version, version)]
 
@@ -3054,6 +3492,13 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return dependencies
 
+    def getDependencyGraph(self):
+        """
+        Return the DependencyGraph that resolves (and remembers) products'
+        dependencies for this Eups instance
+        """
+        return self._dependencyGraph
+
     def getDependentProducts(self, topProduct, setup=False, shouldRaise=False,
                              followExact=None, productDictionary=None, topological=False, checkCycles=False,
                              requiredVersions={}):
@@ -3125,68 +3570,9 @@ The what argument tells us what sort of state is expected (allowed values are de
                                       followExact=False, productDictionary=productDictionary,
                                       requiredVersions=reqVersions)
             del q
-            # Create a dictionary from productDictionary that can be used as input to utils.topologicalSort
-            pdir = {}
-            #
-            # Remove the defaultProduct from productDictionary
-            #
-            defaultProduct = hooks.config.Eups.defaultProduct["name"]
-            if defaultProduct:
-                prods = [k for k in productDictionary.keys() if k.name == defaultProduct]
-                if prods:
-                    defaultProduct = prods[0]
-
-                    if defaultProduct:
-                        ptable = defaultProduct.getTable()
-                        if ptable:
-                            pdir[defaultProduct] = \
-                                                 set([p[0] for p in ptable.dependencies(self, recursive=True)])
-
-                    if topProduct in \
-                           (e[0] for e in defaultProduct.getTable().dependencies(self, recursive=True)):
-                        del productDictionary[defaultProduct]
-                        pdir[defaultProduct] = set()
-                else:
-                    defaultProduct = None
-
-            if not defaultProduct:
-                pdir[defaultProduct] = set()
-            #
-            # We have to a bit careful as we populate pdir.  There will be dependent cycles induced if
-            # there's an implicit dependency on a product that also appears in defaultProduct's dependencies
-            #
-            for k, values in productDictionary.items():
-                if k == defaultProduct:   # don't modify pdir[defaultProduct]; especially don't add defaultProduct
-                    continue
-
-                if k not in pdir:
-                    pdir[k] = set()
 
-                for v in values:
-                    p = v[0]             # the dependent product
-
-                    if p == defaultProduct and k in pdir[defaultProduct]:
-                        continue
-
-                    pdir[k].add(p)
-            #
-            # Actually do the topological sort
-            #
-            sortedProducts = [t for t in
-                              utils.topologicalSort(pdir,verbose=self.verbose,
-                                                    checkCycles=checkCycles)] # products sorted topologically
-            #
-            # Replace the recursion level by the topological depth
-            #
-            tsorted_depth = {}
-            nlevel = len(sortedProducts) + 1 # "+ 1" to allow for topProduct
-            for i, pp in enumerate(sortedProducts):
-                for p in pp:
-                    if p:
-                        tsorted_depth[p.name] = nlevel - i - 1
-
-            if defaultProduct:
-                tsorted_depth[defaultProduct] = nlevel
+            tsorted_depth = self._dependencyGraph.topologicalDepths(productDictionary, topProduct,
+                                                                    checkCycles=checkCycles)
 
             for p in dependentProducts:
                 pname = p[0].name
@@ -3375,19 +3761,37 @@ The what argument tells us what sort of state is expected (allowed values are de
         if not usesInfo:
             usesInfo = Uses()
 
+            indexes = self._loadUsesIndexes()
+            known = {}                  # the dependencies of the products that we know about
             for pi in productList:          # for every known product
-                try:
-                    deps = self.getDependentProducts(pi, shouldRaise=False, followExact=None, topological=True)
-                except TableError as e:
-                    if not self.quiet:
-                        print(("Warning: %s" % (e)), file=utils.stdwarn)
-                    continue
+                index = indexes.get(pi.stackRoot())
+                key = (pi.name, pi.version)
 
-                for dep_product, dep_optional, dep_depth in deps:
-                    assert not (pi.name == dep_product.name and pi.version == dep_product.version)
+                deps = None
+                if index:
+                    deps = index.dependencies.get(key)
+                if deps is None:
+                    try:
+                        deps = [(p.name, p.version, optional, recursionDepth) for p, optional, recursionDepth in
+                                self.getDependentProducts(pi, shouldRaise=False, followExact=None,
+                                                          topological=True)]
+                    except TableError as e:
+                        if not self.quiet:
+                            print(("Warning: %s" % (e)), file=utils.stdwarn)
+                        continue
+
+                    if index:
+                        index.updated = True
+                known.setdefault(pi.stackRoot(), {})[key] = deps
+
+                for dep in deps:
+                    assert not (pi.name == dep[0] and pi.version == dep[1])
 
-                    usesInfo.remember(pi.name, pi.version, (dep_product.name, dep_product.version,
-                                                            dep_optional, dep_depth))
+                    usesInfo.remember(pi.name, pi.version, dep)
+
+            for eupsPathDir, index in indexes.items():
+                index.dependencies = known.get(eupsPathDir, {})
+                index.save()
 
             usesInfo.invert(depth)
 
@@ -3400,6 +3804,66 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return usesInfo.users(productName, versionName)
 
+    def _loadUsesIndexes(self):
+        """
+        Return the saved UsesIndex for each directory in the EUPS_PATH, as a
+        dictionary keyed by directory.  An empty dictionary is returned if the
+        databases' journals can't say which products have changed since the
+        indexes were written.
+        """
+        generations = self._journalGenerations()
+        if generations is None:
+            return {}                   # we can't tell what's changed
+
+        settings = (self.flavor, tuple(self.setupType), tuple(self.getPreferredTags()),
+                    bool(self.ignore_versions), bool(self.exact_version),
+                    hooks.config.Eups.defaultProduct["name"])
+
+        indexes = {}
+        for eupsPathDir in self.path:
+            cacheDir = self._productCacheDir(eupsPathDir)
+            if not cacheDir or not os.path.isdir(cacheDir):
+                continue
+
+            index = UsesIndex(os.path.join(cacheDir, UsesIndex.persistFilename(self.flavor)),
+                              settings, generations)
+            index.load()
+            indexes[eupsPathDir] = index
+
+        return indexes
+
+    def _journalGenerations(self):
+        """
+        Return the current generation of the change journal of each database
+        on the EUPS_PATH (and of the user tags for each), as a dictionary keyed
+        by directory; None is returned if a database that has products has no
+        journal, as we can't then tell when it changes
+        """
+        generations = {}
+        for eupsPathDir in self.path:
+            dbpath = self.getUpsDB(eupsPathDir)
+            db = Database(dbpath)
+            generations[dbpath] = db.getGeneration()
+            if generations[dbpath] is None:
+                if os.path.isdir(dbpath) and db.findProductNames():
+                    return None
+                generations[dbpath] = 0 # nothing's been declared yet
+
+            userTagDir = self._userStackCache(eupsPathDir)
+            if userTagDir and os.path.isdir(userTagDir):
+                # no journal here just means no user tags were ever assigned
+                generations[userTagDir] = Database(userTagDir).getGeneration() or 0
+
+        return generations
+
+    def _productCacheDir(self, eupsPathDir):
+        """
+        Return the directory where the product cache for an EUPS_PATH directory is kept
+        """
+        if self.asAdmin and utils.isDbWritable(eupsPathDir):
+            return self.getUpsDB(eupsPathDir)
+        return self._makeUserCacheDir(eupsPathDir)
+
     def supportServerTags(self, tags, eupsPathDir=None):
         """
         support the list of tags provided by a server.  This function will
@@ -3836,6 +4300,59 @@ class _TagSet(object):
                 return True
         return False
 
+class _MessageRecorder(object):
+    """Write to a stream, remembering what was written (for Eups.cachedSetup())"""
+    def __init__(self, name, stream, messages):
+        self.name = name
+        self.stream = stream
+        self.messages = messages
+    def write(self, text):
+        self.messages.append((self.name, text))
+        self.stream.write(text)
+    def flush(self):
+        self.stream.flush()
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+_undoRecordVersion = "1"                # change whenever the format of undo records changes
+
+def _encodeUndoRecord(setupStr, record):
+    """
+    return an undo record (see Eups.recordUndo()) for the setup described by
+    setupStr (the value of $SETUP_PROD) as a string that's safe to put in the
+    environment, or None if it can't be encoded
+    """
+    import base64                       # only needed here, so don't slow down "import eups"
+
+    try:
+        data = zlib.compress(repr((setupStr, record)).encode("utf-8"))
+    except UnicodeError:
+        return None
+
+    return _undoRecordVersion + ":" + base64.urlsafe_b64encode(data).decode("ascii")
+
+def _decodeUndoRecord(value):
+    """
+    return the (setupStr, record) encoded by _encodeUndoRecord(), or None if
+    value isn't a valid undo record
+    """
+    import ast
+    import base64
+
+    version, sep, data = value.partition(":")
+    if version != _undoRecordVersion:
+        return None
+
+    try:
+        record = ast.literal_eval(zlib.decompress(base64.urlsafe_b64decode(data.encode("ascii"))).decode("utf-8"))
+    except Exception:
+        return None
+
+    if not isinstance(record, tuple) or len(record) != 2:
+        return None
+
+    return record
+
 def _set(iterable):
     """
     return the unique members of a given list.  This is used in lieu of
@@ -123,6 +123,15 @@ class Product(object):
     def tags(self, value):
         self._tags = value
 
+    def __getstate__(self):
+        # The ProductStack reference is only meaningful within this process;
+        # don't drag the whole stack along when a cached table (and hence
+        # its product) is pickled.
+        state = self.__dict__.copy()
+        state["_prodStack"] = None
+        state["_tags"] = self.tags
+        return state
+
     def __hash__(self):                 # needed for set operations (such as toplogicalSort)
         return (hash(self.name) ^
                 hash(self.version) ^
@@ -0,0 +1,159 @@
+"""
+the SetupCache class, which saves the outcome of setting up a product so that
+the same setup can be replayed without resolving its dependencies again
+"""
+from __future__ import absolute_import, print_function
+import os
+import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from . import utils
+
+class SetupCache(object):
+    """
+    A record of the outcome of a setup (the versions of the products that
+    were setup, and the changes to the environment and aliases), saved in the
+    user's data directory.
+
+    An outcome is only replayed if everything that it depends on is unchanged:
+    the settings of the setup (product, version, VRO, flavor, setup type...)
+    are used to name the file where it's kept, and the file records the
+    generations of the databases' change journals, the size and modification
+    time of each table file that was read, and the initial values of the
+    environment variables that the setup used.
+    """
+
+    fileExt = "pickleSetup"             # the extension of the files where outcomes are saved
+    version = 1                         # change whenever the format of the outcomes changes
+    maxEntries = 500                    # the maximum number of outcomes to keep
+
+    # environment variables that describe what's already setup
+    setupStateVarsRE = r"^(%s|EUPS_)|_DIR(_EXTRA)?$" % utils.setupEnvPrefix()
+    # environment variables whose values are always used
+    userVars = ["HOME", "LOGNAME", "USER",]
+
+    def __init__(self, cacheDir, settings, generations):
+        """
+        @param cacheDir     the directory where outcomes are saved
+        @param settings     the settings that the outcome depends on
+                              (product, version, flavor, setup type, VRO...)
+        @param generations  the current generation of each database's journal
+        """
+        import hashlib                  # only needed here, so don't slow down "import eups"
+
+        self.cacheDir = cacheDir
+        self.settings = settings
+        self.generations = generations
+
+        name = hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()
+        self.file = os.path.join(cacheDir, "%s.%s" % (name, SetupCache.fileExt))
+
+    def load(self, environ):
+        """
+        return the saved outcome, or None if there isn't one or anything that
+        it depends on has changed
+        @param environ   the environment that the setup would start from
+        """
+        try:
+            fd = open(self.file, "rb")
+            try:
+                data = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception:
+            return None                 # no usable outcome
+
+        if not isinstance(data, dict) or data.get("version") != SetupCache.version or \
+               data.get("settings") != self.settings or data.get("generations") != self.generations:
+            return None
+
+        if data["setupState"] != SetupCache._setupState(environ):
+            return None
+        for key, val in data["environ"].items():
+            if environ.get(key) != val:
+                return None
+        for fileName, stamp in data["files"].items():
+            if _stamp(fileName) != stamp:
+                return None
+
+        return data
+
+    def save(self, environ, productVersion, products, files, env, aliases, unaliases, messages):
+        """
+        save the outcome of a setup; failure is not an error
+        @param environ         the environment that the setup started from
+        @param productVersion  the version of the product that was setup
+        @param products        the (name, version) of each product that was setup
+        @param files           the table (and tag) files that were read
+        @param env             the (name, new value) of each environment variable
+                                 that changed, in order (the value is None if
+                                 it was unset)
+        @param aliases         the aliases that were set
+        @param unaliases       the aliases that were unset
+        @param messages        the (stream, text) of each message that was
+                                 printed, where stream is the name of a
+                                 stream in utils
+        """
+        #
+        # The setup used the variables that it changed, and those that the
+        # table files refer to
+        #
+        used = set([k for k, v in env]) | set(SetupCache.userVars)
+        for fileName in files:
+            try:
+                fd = open(fileName)
+                try:
+                    used.update(re.findall(r"\$\{?(\w+)", fd.read()))
+                finally:
+                    fd.close()
+            except (IOError, OSError):
+                pass
+
+        data = dict(version=SetupCache.version, settings=self.settings,
+                    generations=self.generations, setupState=SetupCache._setupState(environ),
+                    environ=dict((k, environ.get(k)) for k in used),
+                    files=dict((f, _stamp(f)) for f in files),
+                    productVersion=productVersion, products=products,
+                    env=env, aliases=aliases, unaliases=unaliases, messages=messages)
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            fd = utils.AtomicFile(self.file, "wb")
+            pickle.dump(data, fd, protocol=2)
+            fd.close()
+        except (IOError, OSError):
+            return
+
+        self.prune()
+
+    def prune(self):
+        """
+        remove the least recently saved outcomes if there are more than maxEntries
+        """
+        try:
+            files = [os.path.join(self.cacheDir, f) for f in os.listdir(self.cacheDir)
+                     if f.endswith("." + SetupCache.fileExt)]
+            if len(files) <= SetupCache.maxEntries:
+                return
+
+            files = sorted([(os.stat(f).st_mtime, f) for f in files])
+            for mtime, f in files[:len(files) - SetupCache.maxEntries]:
+                os.unlink(f)
+        except OSError:
+            pass
+
+    # @staticmethod   # requires python 2.4
+    def _setupState(environ):
+        """return the environment variables that describe what's already setup"""
+        return dict((k, v) for k, v in environ.items() if re.search(SetupCache.setupStateVarsRE, k))
+    _setupState = staticmethod(_setupState)
+
+def _stamp(fileName):
+    """return the size and modification time of a file, or None if it doesn't exist"""
+    try:
+        st = os.stat(fileName)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
@@ -1,8 +1,13 @@
 """
 the Uses class -- a class for tracking product dependencies (used by the remove()
-function).
+function), and the UsesIndex class that saves the information needed to build one.
 """
-import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from .db import Database
+from . import utils
 from .utils import cmp_or_key, cmp
 
 #
@@ -43,12 +48,14 @@ class Uses(object):
         """ Invert the dependencies to tell us who uses what, not who depends on what"""
 
         self._setup_by = {}
+        self._versions = {}             # the keys in _setup_by for each product name
         for k in self._depends_on.keys():
             productName, versionName = self._splitKey(k)
             for dname, dver, doptional, ddepth in self._depends_on[k]:
                 key = self._getKey(dname, dver)
                 if key not in self._setup_by:
                     self._setup_by[key] = []
+                    self._versions.setdefault(dname, []).append(key)
 
                 self._setup_by[key].append((productName, versionName, Props(dver, doptional, ddepth)))
 
@@ -73,18 +80,16 @@ class Uses(object):
         """Return a list of the users of productName/productVersion; each element of the list is:
         (user, userVersion, (productVersion, optional)"""
         if versionName:
-            versionName = re.escape(versionName)
+            keys = [self._getKey(productName, versionName)]
         else:
-            versionName = r"[\w.+\-]+"
+            try:
+                keys = self._versions.get(productName, [])
+            except AttributeError:      # e.g. unpickled from an older version
+                keys = [k for k in self._setup_by.keys() if self._splitKey(k)[0] == productName]
 
-        versionName = r"(?P<version>%s)" % versionName
-
-        pattern = re.compile(r"^%s$" % self._getKey(productName, versionName))
         consumerList = []
-        for k in self._setup_by.keys():
-            mat = pattern.match(k)
-            if mat:
-                consumerList += (self._setup_by[k])
+        for k in keys:
+            consumerList += self._setup_by.get(k, [])
         #
         # Be nice; sort list
         #
@@ -103,3 +108,91 @@ class Uses(object):
 
         return consumerList
 
+
+class UsesIndex(object):
+    """
+    A persistent record of the dependencies of each product declared in a
+    stack, as needed to build a Uses object, saved next to the stack's product
+    cache.  The index records the generations of the databases' change
+    journals when it was written, so that only products which depend on
+    products that have since changed need to be analysed again.
+    """
+
+    fileExt = "usesDB"                  # the extension of the files where indexes are saved
+    version = 1                         # change whenever the index's format changes
+
+    def __init__(self, file, settings, generations):
+        """
+        @param file         the file where the index is saved
+        @param settings     the settings that the dependencies depend on
+                              (flavor, setup type, VRO...); an index saved
+                              with different settings isn't used
+        @param generations  the current generation of each database's journal
+        """
+        self.file = file
+        self.settings = settings
+        self.generations = generations
+        self.updated = False
+
+        # the dependencies of each (productName, version), as a list of
+        # (productName, version, optional, depth)
+        self.dependencies = {}
+
+    # @staticmethod   # requires python 2.4
+    def persistFilename(flavor):
+        return "%s.%s" % (flavor, UsesIndex.fileExt)
+    persistFilename = staticmethod(persistFilename)
+
+    def load(self):
+        """
+        read the saved index, keeping the dependencies of products that can't
+        have changed since it was written
+        """
+        try:
+            fd = open(self.file, "rb")
+            try:
+                data = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception:
+            return                      # no usable index
+
+        if not isinstance(data, dict) or data.get("version") != UsesIndex.version or \
+               data.get("settings") != self.settings:
+            return
+
+        recorded = data["generations"]
+        if sorted(recorded.keys()) != sorted(self.generations.keys()):
+            return
+
+        changed = set()
+        for dir, gen in self.generations.items():
+            if recorded[dir] != gen:
+                changes = Database(dir).getJournal(recorded[dir])
+                if changes is None:
+                    return
+                changed.update(c[2] for c in changes)
+
+        for key, deps in data["dependencies"].items():
+            if key[0] in changed or [d for d in deps if d[0] in changed]:
+                self.updated = True
+            else:
+                self.dependencies[key] = deps
+
+    def save(self):
+        """
+        save the index, if it's changed; failure is not an error
+        """
+        if not self.updated:
+            return
+
+        data = dict(version=UsesIndex.version, settings=self.settings,
+                    generations=self.generations, dependencies=self.dependencies)
+        try:
+            fd = utils.AtomicFile(self.file, "wb")
+            pickle.dump(data, fd, protocol=2)
+            fd.close()
+        except (IOError, OSError):
+            pass
+        else:
+            self.updated = False
@@ -1,11 +1,18 @@
 import re
 
-from .utils import cmp
+from .utils import cmp, cmp_or_key, OrderedDict
 
 class VersionCompare(object):
     """
     A comparison function class that compares two product versions.
+
+    Sorting a list of versions by calling compare() for each pair means
+    reparsing both versions every time; key() parses each version once into
+    a tuple with the same ordering for most versions, and sortArgs() chooses
+    key() when it's safe (see keysAgree()).
     """
+
+    maxKeys = 10000                     # the maximum number of keys to remember
     def compare(self, v1, v2, mustReturnInt=True):
         """Compare two versions.
 
@@ -114,6 +121,114 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
         # So far, the two versions are identical.  The longer version should sort later
         return cmp(n1, n2)
 
+    def key(self, version):
+        """
+        Return a key for version, such that comparing two versions' keys gives
+        the same answer as stdCompare(), and so can be passed to sort().
+
+        The answers only differ when stdCompare() isn't self-consistent: it
+        compares version components made of digits numerically but other
+        components as strings, so (e.g.) 8.5a4 > 8.10 > 8.6 > 8.5a4;  the keys
+        compare numbers embedded in components numerically, giving
+        8.5a4 < 8.6 < 8.10.  Also, components such as "01" and "1" are
+        equal, but the keys compare suffixes such as "-1" and "+2" even if
+        the primary parts are spelt differently, which stdCompare() doesn't.
+        Use keyIsExact() to find out if a version's key can be trusted.
+        """
+        try:
+            keys = self._keys
+        except AttributeError:          # we don't insist that subclasses call our __init__
+            keys = self._keys = OrderedDict() # an LRU memo
+
+        try:
+            k = keys.pop(version)
+        except KeyError:
+            k = self._makeKey(version)
+            while len(keys) >= self.maxKeys:
+                keys.popitem(last=False)
+
+        keys[version] = k               # now the most recently used
+        return k
+
+    def _makeKey(self, version):
+        """
+        Return the (uncached) key for a version:  a tuple of
+          o  the keys for the primary components,
+          o  0 if there is a decrementing annotation, otherwise 1,
+          o  the key for the decrementing annotation (or ()),
+          o  the key for the incrementing annotation (or the key for "")
+        """
+        prim, sec, ter = self._splitVersion(version)
+        primKey = tuple([_componentKey(c) for c in re.split(r"[._]", prim)])
+
+        if not (sec or ter):
+            if not prim:
+                return (primKey, 1, (), ())
+            return (primKey, 1, (), self.key(""))
+
+        terKey = self.key(ter or "")
+        if sec:
+            return (primKey, 0, self.key(sec), terKey)
+        else:
+            return (primKey, 1, (), terKey)
+
+    def keyIsExact(self, version):
+        """
+        Return True iff comparing version's key() with that of any other
+        version for which keyIsExact() is True gives the same answer as
+        stdCompare().  This is the case unless a component of the version
+        mixes digits with other characters (e.g. 5a4 or rc1), is a number
+        with a leading 0, or the primary part uses "_" to separate its
+        components (as "1.1" and "1_1" are equal but their suffixes aren't
+        compared by stdCompare())
+        """
+        try:
+            exact = self._exact
+        except AttributeError:
+            exact = self._exact = {}
+
+        try:
+            return exact[version]
+        except KeyError:
+            pass
+
+        ok = True
+        for part in self._splitVersion(version):
+            if not part:
+                continue
+            if "_" in part:
+                ok = False
+                break
+            for c in part.split("."):
+                if c.isdigit():
+                    if len(c) > 1 and c.startswith("0"):
+                        ok = False
+                elif _digitRe.search(c):
+                    ok = False
+            if not ok:
+                break
+
+        if len(exact) >= self.maxKeys:
+            exact.clear()
+        exact[version] = ok
+
+        return ok
+
+    def hasKey(self):
+        """
+        Return True iff key() is consistent with compare(); i.e. unless a
+        subclass has redefined the comparison
+        """
+        for cls in type(self).__mro__:
+            if cls is VersionCompare:
+                return True
+
+            for name in ("compare", "stdCompare", "_splitVersion", "__call__"):
+                if name in cls.__dict__:
+                    return False
+
+        return False
+
     def _splitVersion(self, version):
         """
         Break a version string down into its 3 main components:
@@ -145,3 +260,66 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
         """
         return self.compare(v1, v2, mustReturnInt)
 
+
+_componentRe = re.compile(r"^([^\d]*)(\d*)(.*)$")
+_digitRe = re.compile(r"\d")
+
+def _componentKey(component):
+    """
+    Return a key for one component (e.g. 10, rc1, or v10) of a version's primary part:
+    (the leading non-digits, the number that follows them, the rest).  A "0" is
+    appended to the non-digits when a number follows so that e.g. "a5" sorts
+    before "a!5" as it does when compared as strings.
+    """
+    prefix, digits, rest = _componentRe.match(component).groups()
+    if digits:
+        return (prefix + "0", int(digits), rest)
+    else:
+        return (prefix, 0, rest)
+
+def keysAgree(version_cmp, versions):
+    """
+    Return True iff a list of versions can be ordered using version_cmp's
+    key(), giving the same order as calling version_cmp on each pair
+    @param version_cmp  the comparison function (usually hooks.version_cmp)
+    @param versions     the versions to be ordered
+    """
+    if not (isinstance(version_cmp, VersionCompare) and version_cmp.hasKey()):
+        return False
+
+    for v in versions:
+        if not version_cmp.keyIsExact(v):
+            return False
+
+    return True
+
+def sortArgs(version_cmp, elements, getVersion=None):
+    """
+    Return the keyword arguments to pass to sort() or sorted() to order a list
+    of versions using version_cmp, e.g. vers.sort(**sortArgs(self.version_cmp, vers))
+
+    If version_cmp is a VersionCompare and its key() orders the versions in
+    the same way as compare() (see keysAgree()), the key is used, so each
+    version is parsed once;  otherwise version_cmp is used to compare each
+    pair of versions.
+
+    @param version_cmp  the comparison function (usually hooks.version_cmp)
+    @param elements     the list to be sorted
+    @param getVersion   a function that returns the version of each element of
+                           the list; if None, the elements are the versions
+    """
+    if getVersion:
+        versions = [getVersion(e) for e in elements]
+    else:
+        versions = elements
+
+    if keysAgree(version_cmp, versions):
+        if getVersion:
+            return dict(key=lambda e: version_cmp.key(getVersion(e)))
+        else:
+            return dict(key=version_cmp.key)
+
+    if getVersion:
+        return cmp_or_key(lambda a, b: version_cmp(getVersion(a), getVersion(b)))
+    else:
+        return cmp_or_key(version_cmp)
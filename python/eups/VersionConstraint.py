@@ -0,0 +1,151 @@
+"""
+Version expressions (such as ">= 1.2 || < 0.5") compiled for repeated evaluation
+"""
+from __future__ import absolute_import, print_function
+import re
+
+from . import utils
+
+class VersionConstraint(object):
+    """
+    A version expression, as accepted by Eups.version_match(): a list of
+    terms such as ">= 2.0" or "1.2.3" (meaning "== 1.2.3") joined by || (or
+    "or") and && (or "and"), which are evaluated from left to right.
+
+    An expression is only parsed once, by VersionConstraint.compile(), and
+    the compiled constraints are cached by expression string.
+    """
+
+    relop_re = re.compile(r"<=?|>=?|==")
+
+    # static variable: compiled constraints, keyed by expression string
+    _compiled = {}
+
+    def __init__(self, expr):
+        """
+        Parse an expression; you probably want VersionConstraint.compile(expr)
+        @param expr   the expression to parse
+        """
+        self.expr = expr
+        self._steps = []                # ("and"|"term", logop, relop, version)
+        self._warnings = []             # problems with expr, reported when it's evaluated
+        self._error = None              # an exception to raise when it's evaluated
+
+        tokens = [x for x in re.split(r"\s*(%s|\|\||\s)\s*" % self.relop_re.pattern, expr)
+                  if not re.search(r"^\s*$", x)]
+
+        logop = None                    # the next logical operation to process
+        haveTerm = False                # have we seen a term yet?
+        i = -1
+        while i < len(tokens) - 1:
+            i += 1
+
+            if self.relop_re.search(tokens[i]):
+                relop = tokens[i]; i += 1
+                try:
+                    v = tokens[i]
+                except IndexError as e:
+                    self._error = e
+                    break
+            elif re.search(r"^[-+.:/\w]+$", tokens[i]) and tokens[i] not in ("and", "or"):
+                relop = "=="
+                v = tokens[i]
+            elif tokens[i] == "||" or tokens[i] == "or":
+                logop = "or"
+                continue
+            elif tokens[i] == "&&" or tokens[i] == "and":
+                self._steps.append(("and", logop, None, None))
+                logop = "and"
+                continue
+            else:
+                self._warnings.append("Unexpected operator %s in \"%s\"" % (tokens[i], expr))
+                break
+
+            if not logop and haveTerm:
+                self._warnings.append("Expected logical operator || or && in \"%s\" at %s" % (expr, v))
+            else:
+                self._steps.append(("term", logop, relop, v))
+                haveTerm = True
+
+    # @staticmethod   # requires python 2.4
+    def compile(expr):
+        """
+        Return the VersionConstraint for an expression, parsing it only if
+        it hasn't been seen before
+        @param expr   the expression to compile
+        """
+        try:
+            return VersionConstraint._compiled[expr]
+        except KeyError:
+            pass
+
+        constraint = VersionConstraint(expr)
+        VersionConstraint._compiled[expr] = constraint
+        return constraint
+    compile = staticmethod(compile)     # works since python2.2
+
+    def _evaluate(self, vname, compare):
+        value = None                    # the value of the expression so far
+        for what, logop, relop, v in self._steps:
+            if what == "and":
+                if not value:
+                    return False        # short circuit
+                continue
+
+            try:
+                rhs = compare(relop, vname, v)
+            except ValueError:          # no sort order is defined
+                return None
+
+            if not logop:
+                value = rhs
+            elif logop == "and":
+                value = bool(value and rhs)
+            elif logop == "or":
+                if value or rhs:
+                    return vname
+
+                value = False
+
+        if value:
+            return vname
+        else:
+            return None
+
+    def _report(self):
+        for msg in self._warnings:
+            print(msg, file=utils.stdwarn)
+
+        if self._error:
+            raise self._error
+
+    def match(self, vname, compare):
+        """
+        Return vname if it satisfies the constraint, otherwise None (or False)
+
+        @param vname     the version to check
+        @param compare   a function compare(relop, v1, v2) returning True if
+                           "v1 relop v2" is satisfied and raising ValueError
+                           if v1 and v2 can't be ordered;  usually
+                           Eups.version_match_prim
+        """
+        self._report()
+        return self._evaluate(vname, compare)
+
+    def filter(self, versions, compare, getVersion=None):
+        """
+        Return the elements of a list of versions that satisfy the constraint,
+        preserving their order
+
+        @param versions    the list to filter
+        @param compare     the function used to compare two versions; see match()
+        @param getVersion  a function that returns the version of each element of
+                             the list; if None, the elements are the versions
+        """
+        self._report()
+
+        evaluate = self._evaluate
+        if getVersion:
+            return [e for e in versions if evaluate(getVersion(e), compare)]
+        else:
+            return [v for v in versions if evaluate(v, compare)]
@@ -25,11 +25,17 @@ class VersionParser(object):
                ( expr )
 
 names are declared using VersionParser.define()
+
+An expression is only parsed once, by VersionParser.compile(), into a
+function that may then be evaluated cheaply for any set of names; the
+compiled functions are cached by expression string.
         """
+
+    # static variable: compiled expressions, keyed by expression string
+    _compiled = {}
+
     def __init__(self, exprStr):
-        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
-        self._tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
-        self._tokens = [p for p in self._tokens if p and not re.search(r"^\s*$", p)]
+        self._evaluate = VersionParser.compile(exprStr)
 
         self._symbols = {}
         self._caseSensitive = False
@@ -41,127 +47,170 @@ names are declared using VersionParser.define()
 
     def _lookup(self, key):
         """Attempt to lookup a key in the symbol table"""
-        key0 = key
-
-        try:
-            envVar, modifier, value = re.search(r"^\${([^:}]*)(:-([^\}*]*))?}", key).groups()
-
-            if not value or value == "false":
-                value = False
+        return _lookup(key, self._symbols, self._caseSensitive)
 
-            if envVar in os.environ:
-                return os.environ[envVar]
-            elif modifier:
-                return value
-            else:
-                raise RuntimeError("Environment variable $%s is not defined" % envVar)
-        except TypeError:
-            pass
-        except AttributeError:
-            pass
+    def eval(self):
+        """Evaluate the logical expression, returning a Bool"""
 
-        if not self._caseSensitive:
-            key = key.lower()
+        return self._evaluate(self._symbols, self._caseSensitive)
 
+    # @staticmethod   # requires python 2.4
+    def compile(exprStr):
+        """
+        Return a function that evaluates a logical expression.  The function
+        is called as func(symbols, caseSensitive=False), where symbols is a
+        dictionary of the values of names (see define()).  The function's
+        usesEnvironment attribute is True if the expression refers to
+        environment variables (so that its value depends on more than the
+        symbols).
+        @param exprStr   the expression to compile
+        """
         try:
-            return self._symbols[key]
+            return VersionParser._compiled[exprStr]
         except KeyError:
-            return key0
+            pass
 
-    def _peek(self):
-        """Return the next terminal symbol, but don't pop it off the lookahead stack"""
+        tokens = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
+        tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", tokens)
+        tokens = [p for p in tokens if p and not re.search(r"^\s*$", p)]
 
-        if not self._tokens:
-            return "EOF"
+        try:
+            if tokens:
+                expr = _Compiler(tokens).expr()
+            else:
+                expr = lambda symbols, caseSensitive: False
+        except RuntimeError as e:
+            # report the error when the expression is evaluated, as we always have
+            def expr(symbols, caseSensitive, e=e):
+                raise e
+
+        def evaluate(symbols, caseSensitive=False):
+            val = expr(symbols, caseSensitive) # n.b. may not have used all tokens as || and && short circuit
+            if val == "EOF":
+                return False
+            return val
+        evaluate.usesEnvironment = [t for t in tokens if t.startswith("$")] != []
 
-        tok = self._lookup(self._tokens[0])
+        VersionParser._compiled[exprStr] = evaluate
+        return evaluate
+    compile = staticmethod(compile)     # works since python2.2
 
-        try:                            # maybe it's an int
-            tok = int(tok)
-        except TypeError:
-            pass
-        except ValueError:
-            pass
+def _lookup(key, symbols, caseSensitive=False):
+    """Attempt to lookup a key in the symbol table"""
+    key0 = key
 
-        if tok == "True" or tok == "False": # or a bool
-            tok = (tok == "True")
+    try:
+        envVar, modifier, value = re.search(r"^\${([^:}]*)(:-([^\}*]*))?}", key).groups()
 
-        return tok
+        if not value or value == "false":
+            value = False
 
-    def _push(self, tok):
-        """Push a token back onto the lookahead stack"""
+        if envVar in os.environ:
+            return os.environ[envVar]
+        elif modifier:
+            return value
+        else:
+            raise RuntimeError("Environment variable $%s is not defined" % envVar)
+    except TypeError:
+        pass
+    except AttributeError:
+        pass
+
+    if not caseSensitive:
+        key = key.lower()
+
+    try:
+        return symbols[key]
+    except KeyError:
+        return key0
+
+def _value(tok, symbols, caseSensitive):
+    """Return the value of a terminal symbol"""
+
+    tok = _lookup(tok, symbols, caseSensitive)
+
+    try:                                # maybe it's an int
+        tok = int(tok)
+    except TypeError:
+        pass
+    except ValueError:
+        pass
+
+    if tok == "True" or tok == "False": # or a bool
+        tok = (tok == "True")
+
+    return tok
+
+class _Compiler(object):
+    """Parse a list of tokens into nested functions of (symbols, caseSensitive)
+
+    As when the expressions were interpreted directly, the operators are
+    evaluated from left to right, and evaluation stops as soon as an || or
+    && short circuits.
+    """
+
+    _comparisons = {
+        "==" : lambda lhs, rhs: (rhs in lhs) if isinstance(lhs, list) else (lhs == rhs),
+        "=~" : lambda lhs, rhs: re.search(rhs, lhs),
+        "!=" : lambda lhs, rhs: not (rhs in lhs) if isinstance(lhs, list) else (lhs != rhs),
+        "!~" : lambda lhs, rhs: not re.search(rhs, lhs),
+        "<"  : lambda lhs, rhs: lhs < rhs,
+        "<=" : lambda lhs, rhs: lhs <= rhs,
+        ">"  : lambda lhs, rhs: lhs > rhs,
+        ">=" : lambda lhs, rhs: lhs >= rhs,
+        }
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._i = 0
 
-        if tok != "EOF":
-            self._tokens = [tok] + self._tokens
+    def _peek(self):
+        if self._i < len(self._tokens):
+            return self._tokens[self._i]
+        return None
 
     def _next(self):
-        """Return the next terminal symbol, popping it off the lookahead stack"""
-
         tok = self._peek()
-        if tok != "EOF":
-            self._tokens.pop(0)
-
+        if tok is not None:
+            self._i += 1
         return tok
 
-    def eval(self):
-        """Evaluate the logical expression, returning a Bool"""
+    def expr(self):
+        lhs = self._term()
 
-        if isinstance(self._tokens, bool):
-            return self._tokens
+        terms = []
+        while self._peek() in ("||", "or", "&&", "and"):
+            terms.append((self._next() in ("||", "or"), self._term()))
 
-        val = self._expr()              # n.b. may not have consumed all tokens as || and && short circuit
+        if not terms:
+            return lhs
 
-        if val == "EOF":
-            return False
-        else:
+        def evaluate(symbols, caseSensitive):
+            val = lhs(symbols, caseSensitive)
+            for isOr, term in terms:
+                if isOr:
+                    if val:
+                        return val
+                elif not val:
+                    return val
+                val = term(symbols, caseSensitive)
             return val
 
-    def _expr(self):
-        lhs = self._term()
-
-        while True:
-            op = self._next()
-
-            if op == "||" or op == "or":
-                lhs = lhs or self._term()
-            elif op == "&&" or op == "and":
-                lhs = lhs and self._term()
-            else:
-                self._push(op)
-                return lhs
+        return evaluate
 
     def _term(self):
         lhs = self._prim()
-        op = self._next()
 
-        if op == "EOF":
+        op = self._peek()
+        if op not in self._comparisons:
             return lhs
+        self._next()
 
-        if op == "==":
-            if isinstance(lhs, list):
-                return self._prim() in lhs
-            else:
-                return lhs == self._prim()
-        elif op == "=~":
-            return re.search(self._prim(), lhs)
-        elif op == "!=":
-            if isinstance(lhs, list):
-                return not (self._prim() in lhs)
-            else:
-                return lhs != self._prim()
-        elif op == "!~":
-            return not re.search(self._prim(), lhs)
-        elif op == "<":
-            return lhs < self._prim()
-        elif op == "<=":
-            return lhs <= self._prim()
-        elif op == ">":
-            return lhs > self._prim()
-        elif op == ">=":
-            return lhs >= self._prim()
-        else:
-            self._push(op)
-            return lhs
+        compare = self._comparisons[op]
+        rhs = self._prim()
+
+        return lambda symbols, caseSensitive: \
+            compare(lhs(symbols, caseSensitive), rhs(symbols, caseSensitive))
 
     def _prim(self):
         next = self._peek()
@@ -169,15 +218,19 @@ names are declared using VersionParser.define()
         if next == "(" or (next == "!" or next == "not"):
             self._next()
 
-            term = self._expr()
+            term = self.expr()
 
             if next == "!" or next == "not":
-                term = not term
-            elif next == "(":
+                return lambda symbols, caseSensitive: not term(symbols, caseSensitive)
+            else:
                 next = self._next()
                 if next != ")":
                     raise RuntimeError("Saw next = \"%s\" in prim" % next)
 
             return term
 
-        return self._next()
+        tok = self._next()
+        if tok is None:
+            return lambda symbols, caseSensitive: "EOF"
+
+        return lambda symbols, caseSensitive: _value(tok, symbols, caseSensitive)
@@ -10,7 +10,6 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
-from .distrib import builder
 from .Eups           import Eups
 from .exceptions     import ProductNotFound
 from .tags           import Tag, checkTagsList
@@ -19,7 +18,7 @@ from .VersionParser  import VersionParser
 from .stack          import ProductStack, persistVersionName as cacheVersion
 from . import utils, table, hooks
 from .exceptions import EupsException
-from .utils import cmp_or_key, cmp
+from .utils import cmp
 
 def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
                   tags=None, setup=False, tablefile=False, directory=False,
@@ -412,6 +411,8 @@ def expandBuildFile(ofd, ifd, product, version, svnroot=None, cvsroot=None, repo
     @param verbose  an integer verbosity level where larger values result
                        in more messages
     """
+    from .distrib import builder
+
     builderVars = hooks.config.distrib["builder"]["variables"]
 
     if cvsroot:
@@ -509,6 +510,27 @@ def declare(productName, versionName, productDir=None, eupsPathDir=None,
     return eupsenv.declare(productName, versionName, productDir, eupsPathDir,
                            tablefile, externalFileList=externalFileList, tag=tag)
 
+def declareProducts(products, eupsPathDir=None, eupsenv=None, atomic=True):
+    """
+    Declare (and/or tag) a list of products as a single batch, updating the
+    caches only once;  if atomic is true, the declarations are undone if any
+    of them fails.  See Eups.declareProducts() for details.
+
+    @param products      a list of (productName, versionName, productDir,
+                           tablefile, tags) tuples;  trailing elements may
+                           be omitted
+    @param eupsPathDir   the EUPS product stack to declare the products into.
+                           If None, then the first writable stack in
+                           EUPS_PATH will be installed into.
+    @param eupsenv       the Eups instance to assume.  If None, a default
+                           will be created.
+    @param atomic        if true, undo all the declarations if any fails
+    @return the names of the products that couldn't be declared
+    """
+    if not eupsenv:
+        eupsenv = Eups()
+    return eupsenv.declareProducts(products, eupsPathDir, atomic=atomic)
+
 def undeclare(productName, versionName=None, eupsPathDir=None, tag=None,
               eupsenv=None, undeclareVersionAndTag=False):
     """
@@ -629,8 +651,7 @@ def listCache(path=None, verbose=0, flavor=None):
             continue
 
         for productName in productNames:
-            versionNames = cache.getVersions(productName)
-            versionNames.sort(**cmp_or_key(hooks.version_cmp))
+            versionNames = cache.getSortedVersions(productName, version_cmp=hooks.version_cmp)
 
             print("  %-20s %s" % (productName, " ".join(versionNames)))
 
@@ -684,7 +705,7 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         return osetup(productName, version, prefTags, productRoot, productName.setupType)
 
     if not eupsenv:
-        eupsenv = Eups(readCache=False, exact_version=exact_version)
+        eupsenv = Eups(readCache="readonly", exact_version=exact_version)
         if version:
             eupsenv.selectVRO(versionName=version)
 
@@ -704,8 +725,8 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         checkTagsList(eupsenv, postTags)
 
     versionRequested = version
-    ok, version, reason = eupsenv.setup(productName, version, fwd,
-                                        productRoot=productRoot, tablefile=tablefile)
+    ok, version, reason = eupsenv.cachedSetup(productName, version, fwd,
+                                              productRoot=productRoot, tablefile=tablefile)
 
     cmds = []
     if ok:
@@ -742,100 +763,7 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
                         print("No versions of %s are tagged%s %s; setup version is %s" % \
                               (productName, extra, ",".join(prefTags + postTags), version), file=utils.stdwarn)
 
-        #
-        # Set new variables
-        #
-        for key, val in os.environ.items():
-            try:
-                if val == eupsenv.oldEnviron[key]:
-                    continue
-            except KeyError:
-                pass
-
-            if val and not re.search(r"^['\"].*['\"]$", val) and \
-                   re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
-                val = "'%s'" % val
-
-            if eupsenv.shell in ("sh", "zsh",):
-                cmd = "export %s=%s" % (key, val)
-            elif eupsenv.shell in ("csh",):
-                cmd = "setenv %s %s" % (key, val)
-
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # these variables are an implementation detail
-
-                cmd = "echo \"%s\"" % cmd
-
-            cmds += [cmd]
-        #
-        # Extra environment variables that EUPS uses
-        #
-        if not fwd and productName == "eups":
-            for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
-                if k in os.environ:
-                    del os.environ[k]
-        #
-        # unset ones that have disappeared
-        #
-        for key in eupsenv.oldEnviron.keys():
-            if productName != "eups":   # the world will break if we delete these
-                if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
-                    continue
-
-            if key in os.environ:
-                continue
-
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unsetenv %s" % (key)
-
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # an implementation detail
-
-                cmd = "echo \"%s\"" % cmd
-
-            cmds += [cmd]
-        #
-        # Now handle aliases
-        #
-        for key in eupsenv.aliases.keys():
-            value = eupsenv.aliases[key]
-
-            try:
-                if value == eupsenv.oldAliases[key]:
-                    continue
-            except KeyError:
-                pass
-
-            if eupsenv.shell == "sh":
-                cmd = "%s() { %s ; }" % (key, value)
-            elif eupsenv.shell == "csh":
-                value = re.sub(r'"?\$@"?', r"\!*", value)
-                cmd = "alias %s \'%s\'" % (key, value)
-
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
-
-            cmds += [cmd]
-        #
-        # and unset ones that used to be present, but are now gone
-        #
-        for key in eupsenv.oldAliases.keys():
-            if key in eupsenv.aliases:
-                continue
-
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unalias %s" % (key)
-
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % cmd
-
-            cmds += [cmd]
+        cmds += _shellCommands(eupsenv, productName, fwd)
     elif fwd and version is None:
         print("Unable to find an acceptable version of", productName, file=utils.stderr)
         if eupsenv.verbose and os.path.exists(productName):
@@ -866,6 +794,247 @@ def unsetup(productName, version=None, eupsenv=None):
     """
     return setup(productName, version, fwd=False)
 
+def freeze(productName, version=None, prefTags=None, eupsenv=None, shell=None, postTags=[]):
+    """
+    Return the lines of a script which, when sourced, will reproduce the
+    environment (including the SETUP_* and *_DIR variables) and aliases that
+    setting up a product would, without running eups.  The product is
+    resolved as setup() would in the current environment, which is left
+    unchanged.  Path-like variables that the setup extends are extended when
+    the script is sourced rather than replaced, so the script may be used in
+    environments that differ a little from the current one.  The script
+    doesn't rely on the product (or any of its dependencies) already being
+    setup, even if it is in the current environment.
+
+    @param productName     the name of the desired product
+    @param version         the desired version of the product;  see setup()
+    @param prefTags        the list of requested tags (n.b. the VRO already knows about them)
+    @param eupsenv         the Eups instance to use to do the setup.  If
+                             None, one will be created for it.
+    @param shell           the shell that the script is for: "sh", "csh", or
+                             "zsh" (default: eupsenv.shell)
+    @param postTags        the list of requested post-tags (n.b. the VRO already knows about them)
+    """
+    if not eupsenv:
+        eupsenv = Eups(readCache="readonly")
+        if version:
+            eupsenv.selectVRO(versionName=version)
+
+    if not shell:
+        shell = eupsenv.shell
+    if shell not in ("sh", "csh", "zsh"):
+        raise EupsException("Unknown shell type %s" % shell)
+
+    if utils.is_string(prefTags):
+        prefTags = prefTags.split()
+    elif isinstance(prefTags, Tag):
+        prefTags = [prefTags]
+
+    if prefTags:
+        checkTagsList(eupsenv, prefTags)
+    if postTags:
+        checkTagsList(eupsenv, postTags)
+
+    environObj, environ = os.environ, os.environ.copy() # setup may replace os.environ
+    oldEnviron, aliases, oldAliases = eupsenv.oldEnviron, eupsenv.aliases, eupsenv.oldAliases
+    try:
+        requestedVersion = version
+        ok, version, reason = eupsenv.cachedSetup(productName, requestedVersion)
+        if not ok:
+            if isinstance(reason, Exception):
+                raise reason
+            raise EupsException("Failed to setup %s: %s" % (productName, reason))
+        #
+        # The commands only change what differs from the current environment, so if any of the products
+        # that we set up were already setup, unsetup them and start again from there
+        #
+        product = eupsenv.findSetupProduct(productName)
+        q = utils.Quiet(eupsenv)
+        products = [productName] + [p.name for p, optional, depth in
+                                    eupsenv.getDependentProducts(product, setup=True)]
+        del q
+
+        wasSetup = [p for p in products if eupsenv.findSetupVersion(p, environ)[0] is not None]
+        if wasSetup:
+            _restoreEnviron(environObj, environ)
+            os.environ = environObj
+            for p in wasSetup:
+                eupsenv.unsetupSetupProduct(p, noRecursion=True)
+
+            eupsenv.oldEnviron = os.environ.copy()
+            eupsenv.aliases, eupsenv.oldAliases = {}, {}
+
+            ok, version, reason = eupsenv.cachedSetup(productName, requestedVersion)
+            if not ok:
+                if isinstance(reason, Exception):
+                    raise reason
+                raise EupsException("Failed to setup %s: %s" % (productName, reason))
+
+        cmds = _shellCommands(eupsenv, productName, shell=shell, frozen=True)
+    finally:
+        eupsenv.oldEnviron, eupsenv.aliases, eupsenv.oldAliases = oldEnviron, aliases, oldAliases
+        os.environ = environObj
+        _restoreEnviron(os.environ, environ)
+
+    return ["# The environment for %s %s (flavor %s), frozen by \"eups freeze\"" %
+            (productName, version, eupsenv.flavor),
+            "# EUPS_PATH=%s" % ":".join(eupsenv.path)] + cmds
+
+def _restoreEnviron(environObj, environ):
+    """
+    Make environObj (e.g. os.environ) hold just the variables in the dict environ
+    """
+    for key in list(environObj.keys()):
+        if key not in environ:
+            del environObj[key]
+    environObj.update(environ)
+
+def _shellCommands(eupsenv, productName, fwd=True, shell=None, frozen=False):
+    """
+    Return the shell commands which change the environment variables and
+    aliases from their values when eupsenv was created (eupsenv.oldEnviron
+    and eupsenv.oldAliases) to their current values (os.environ and
+    eupsenv.aliases).
+
+    @param productName     the name of the product that was setup
+    @param fwd             False if the product was unsetup
+    @param shell           the shell to generate commands for (default: eupsenv.shell)
+    @param frozen          if True, the commands are for a script to be sourced
+                             later (see freeze()):  they aren't affected by
+                             eupsenv.noaction, and path-like variables are
+                             extended rather than replaced if possible
+    """
+    if not shell:
+        shell = eupsenv.shell
+    noaction = eupsenv.noaction and not frozen
+
+    cmds = []
+    #
+    # Set new variables
+    #
+    for key, val in os.environ.items():
+        try:
+            oldVal = eupsenv.oldEnviron[key]
+            if val == oldVal:
+                continue
+        except KeyError:
+            oldVal = None
+
+        if frozen and _extendedPath(val, oldVal):
+            prefix, suffix = _extendedPath(val, oldVal)
+            val = "\"%s${%s}%s\"" % (prefix, key, suffix)
+        elif val and not re.search(r"^['\"].*['\"]$", val) and \
+               re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
+            val = "'%s'" % val
+
+        if shell in ("sh", "zsh",):
+            cmd = "export %s=%s" % (key, val)
+        elif shell in ("csh",):
+            cmd = "setenv %s %s" % (key, val)
+
+        if noaction:
+            if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # these variables are an implementation detail
+
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
+    #
+    # Extra environment variables that EUPS uses
+    #
+    if not fwd and productName == "eups":
+        for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
+            if k in os.environ:
+                del os.environ[k]
+    #
+    # unset ones that have disappeared
+    #
+    for key in eupsenv.oldEnviron.keys():
+        if productName != "eups":   # the world will break if we delete these
+            if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
+                continue
+
+        if key in os.environ:
+            continue
+
+        if shell == "sh" or shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif shell == "csh":
+            cmd = "unsetenv %s" % (key)
+
+        if noaction:
+            if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # an implementation detail
+
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
+    #
+    # Now handle aliases
+    #
+    for key in eupsenv.aliases.keys():
+        value = eupsenv.aliases[key]
+
+        try:
+            if value == eupsenv.oldAliases[key]:
+                continue
+        except KeyError:
+            pass
+
+        if shell == "sh" or shell == "zsh":
+            cmd = "%s() { %s ; }" % (key, value)
+        elif shell == "csh":
+            value = re.sub(r'"?\$@"?', r"\!*", value)
+            cmd = "alias %s \'%s\'" % (key, value)
+
+        if noaction:
+            cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
+
+        cmds += [cmd]
+    #
+    # and unset ones that used to be present, but are now gone
+    #
+    for key in eupsenv.oldAliases.keys():
+        if key in eupsenv.aliases:
+            continue
+
+        if shell == "sh" or shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif shell == "csh":
+            cmd = "unalias %s" % (key)
+
+        if noaction:
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
+
+    return cmds
+
+def _extendedPath(val, oldVal, delim=":"):
+    """
+    If the path-like value val is oldVal with elements prepended and/or
+    appended, return the (prefix, suffix) that were added (each including the
+    delimiter), otherwise None.  None is also returned if the prefix or suffix
+    contains characters that are special inside double quotes.
+    """
+    if not oldVal or not val:
+        return None
+
+    if val.startswith(oldVal + delim):
+        prefix, suffix = "", val[len(oldVal):]
+    elif val.endswith(delim + oldVal):
+        prefix, suffix = val[:-len(oldVal)], ""
+    else:
+        ind = val.find(delim + oldVal + delim)
+        if ind < 0:
+            return None
+        prefix, suffix = val[:ind + 1], val[ind + 1 + len(oldVal):]
+
+    if re.search(r"[\"$`\\!]", prefix + suffix):
+        return None
+
+    return prefix, suffix
+
 def findProduct(productName, versionName=None, eupsenv=None):
     """
     return the specified product.  None is returned if no matching product can be found
@@ -41,9 +41,11 @@ import eups
 from . import lock
 from . import tags
 from . import utils
-from . import distrib
 from . import hooks
-from .distrib.server import ServerConf, Mapping, importClass
+#
+# eups.distrib (and the urllib/http/ssl modules that it pulls in) is only imported by the
+# commands that use it, so as not to slow down the startup of every other command
+#
 
 _errstrm = utils.stderr
 
@@ -78,6 +80,7 @@ Supported commands are:
 	expandtable	Insert explicit version tags into a table file
 	flags		Show the value of $EUPS_FLAGS
 	flavor		Return the current flavor
+	freeze		Write a script that reproduces the setup of a product
         help            Provide help on eups commands
 	list            List some or all products
         path [n]        Print the current eups path, or an element thereof
@@ -1152,6 +1155,96 @@ For example, the make target in a ups directory might contain the line:
         return 0
 
 
+class FreezeCmd(EupsCmd):
+
+    usage = "%prog freeze [-h|--help] [options] product [version]"
+
+    # set this to True if the description is preformatted.  If false, it
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = True
+
+    description = \
+"""Resolve the setup of a product, and write a script that reproduces the
+environment (and aliases) that the setup would produce.  Sourcing the
+script is much faster than running setup, and doesn't need eups (or python),
+e.g.
+      eups freeze -t w_2024_10 -s sh -o pipe.sh lsst_apps
+      source pipe.sh
+
+The script sets the SETUP_* and *_DIR variables, so "eups list -s" knows what
+is setup.  Path-like variables such as PATH are extended, rather than
+replaced, if possible.  The current environment is used to resolve the
+setup, so products that are already setup are taken into account.
+"""
+
+    def addOptions(self):
+        # these are specific to this command
+        self.clo.add_option("-e", "--exact", dest="exact_version", action="store_true", default=False,
+                            help="Use the exact versions of dependencies given in the table files")
+        self.clo.add_option("-o", "--output", dest="outFile", action="store", metavar="FILE",
+                            help="Write the script to FILE (default: standard out)")
+        self.clo.add_option("-s", "--shell", dest="shell", action="store", metavar="SHELL",
+                            help="The shell that the script is for (sh, csh, or zsh; default: $EUPS_SHELL)")
+        self.clo.add_option("-t", "--tag", dest="tag", action="append",
+                            help="Put TAG near the start of the VRO (may be repeated)")
+
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        # these options are used to configure the Eups instance
+        self.addEupsOptions()
+
+    def execute(self):
+        if len(self.args) == 0:
+            self.err("Please specify a product name")
+            return 3
+        productName = self.args[0]
+        versionName = None
+        if len(self.args) > 1:
+            versionName = self.args[1]
+
+        shell = self.opts.shell
+        if shell:
+            shell = re.sub(r"^.*/", "", shell)
+            if shell in ("bash", "ksh"):
+                shell = "sh"
+            elif shell == "tcsh":
+                shell = "csh"
+            if shell not in ("sh", "csh", "zsh"):
+                self.err("Unknown shell type %s" % self.opts.shell)
+                return 3
+
+        try:
+            myeups = self.createEups(versionName=versionName)
+        except eups.EupsException as e:
+            e.status = 9
+            raise
+
+        try:
+            lines = eups.freeze(productName, versionName, self.opts.tag, myeups, shell=shell)
+        except eups.EupsException as e:
+            e.status = 2
+            raise
+
+        if self.opts.outFile:
+            try:
+                ofd = open(self.opts.outFile, "w")
+            except IOError as e:
+                self.err('Failed to open file "%s" for write: %s' % (self.opts.outFile, e))
+                return 6
+        else:
+            ofd = sys.stdout
+
+        try:
+            for line in lines:
+                print(line, file=ofd)
+        finally:
+            if ofd is not sys.stdout:
+                ofd.close()
+
+        return 0
+
+
 class DeclareCmd(EupsCmd):
 
     usage = "%prog declare [-h|--help] [options] product version"
@@ -1171,6 +1264,13 @@ If there is no table file, give "none" to the -m option.  If the product is
 already declared, attempts to redeclare will fail unless -F is used.  If you
 only wish to assign a tag, you should use the -t option but not include
 -r.
+
+Many products may be declared at once with --from-file FILE, where each line
+of FILE (which may be "-" for stdin) reads "product version [dir [tablefile
+[tag,...]]]"; a "-" means that the field isn't given, and blank lines and
+comments (starting #) are ignored.  Any -t/-c tag is assigned to all of the
+products.  The declarations are made together, and are all undone if any
+of them fails.
 """
 
     def addOptions(self):
@@ -1186,6 +1286,8 @@ only wish to assign a tag, you should use the -t option but not include
                             help='table file location (may be "none" for no table file)')
         self.clo.add_option("-t", "--tag", dest="tag", action="append",
                             help="assign TAG to the specified product")
+        self.clo.add_option("--from-file", dest="fromFile", action="store", metavar="FILE",
+                            help="declare the products listed in FILE (\"-\" for stdin)")
 
         # these options are used to configure the Eups instance
         self.addEupsOptions()
@@ -1221,6 +1323,9 @@ only wish to assign a tag, you should use the -t option but not include
 
             self.opts.tag = self.opts.tag[0]
 
+        if self.opts.fromFile:
+            return self.declareFromFile(myeups)
+
         if not product:
             if self.opts.tablefile == "none":
                 self.err("Unable to guess product name from table file name %s" % self.opts.tablefile)
@@ -1342,6 +1447,73 @@ only wish to assign a tag, you should use the -t option but not include
 
         return 0
 
+    def declareFromFile(self, myeups):
+        """Declare the products listed in the file given by --from-file"""
+
+        if self.args or self.opts.productDir or self.opts.tablefile or \
+               self.opts.externalTablefile or self.opts.externalFileList:
+            self.err("You may not specify products, -r, -m, -M, or -L with --from-file")
+            return 3
+
+        fileName = self.opts.fromFile
+        try:
+            if fileName == "-":
+                fd = sys.stdin
+            else:
+                fd = open(fileName, "r")
+        except IOError as e:
+            self.err("Error opening %s: %s" % (fileName, e))
+            return 4
+
+        products = []
+        try:
+            for lineNo, line in enumerate(fd):
+                line = re.sub(r"#.*$", "", line).strip()
+                if not line:
+                    continue
+
+                fields = [f if f != "-" else None for f in line.split()]
+                if len(fields) < 2 or len(fields) > 5 or not fields[0] or not fields[1]:
+                    self.err("%s:%d: expected \"product version [dir [tablefile [tag,...]]]\": %s" %
+                             (fileName, lineNo + 1, line))
+                    return 2
+
+                fields += [None]*(5 - len(fields))
+                tags = []
+                if fields[4]:
+                    tags = [t for t in fields[4].split(",") if t]
+                if self.opts.tag and self.opts.tag not in tags:
+                    tags.append(self.opts.tag)
+                fields[4] = tags
+
+                products.append(tuple(fields))
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+
+        for tag in set([t for p in products for t in p[4]]):
+            try:
+                if myeups.isReservedTag(myeups.tags.getTag(tag)):
+                    if self.opts.force:
+                        self.err("%s is a reserved tag, but proceeding anyway)" % tag)
+                    else:
+                        self.err("%s is a reserved tag (use --force to set)" % tag)
+                        return 1
+            except eups.TagNotRecognized:
+                self.err("%s: Unsupported tag name" % tag)
+                return 1
+
+        if self.opts.verbose:
+            print("Declaring %d products from %s" % (len(products), fileName), file=utils.stdinfo)
+
+        try:
+            eups.declareProducts(products, eupsenv=myeups)
+        except eups.EupsException as e:
+            e.status = 2
+            raise
+
+        return 0
+
 
 class UndeclareCmd(EupsCmd):
 
@@ -1519,7 +1691,7 @@ where it is installed.
 
 class AdminCmd(EupsCmd):
 
-    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show] [-h|--help] [-r root]"
+    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show|startDaemon|stopDaemon] [-h|--help] [-r root]"
 
     # set this to True if the description is preformatted.  If false, it
     # will be automatically reformatted to fit the screen
@@ -1590,7 +1762,14 @@ class AdminBuildCacheCmd(EupsCmd):
             return 1
 
         eups.clearCache(inUserDir=not self.opts.asAdmin, verbose=self.opts.verbose)
-        eups.Eups(readCache=True, asAdmin=self.opts.asAdmin)
+        eupsenv = eups.Eups(readCache=True, asAdmin=self.opts.asAdmin)
+        #
+        # Rebuild the indexes of the databases that we can write to
+        #
+        for p in eupsenv.path:
+            db = eupsenv._databaseFor(p)
+            if db.isWritable():
+                db.buildIndex()
 
         return 0
 
@@ -1692,6 +1871,84 @@ class AdminListLocksCmd(EupsCmd):
 
         return 0
 
+class AdminStartDaemonCmd(EupsCmd):
+
+    usage = "%prog admin startDaemon [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Start an eups daemon that keeps eups loaded between commands, so that
+eups and setup commands run in the same environment start faster.  The daemon
+exits after being idle for a while (see --idle-timeout), or when stopped with
+"eups admin stopDaemon".
+"""
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("--foreground", dest="foreground", action="store_true", default=False,
+                            help="Run the daemon in the foreground rather than detaching it")
+        self.clo.add_option("--idle-timeout", dest="idleTimeout", action="store", type="int", default=3600,
+                            help="Exit after this many seconds without a command (<= 0: never)")
+        self.clo.add_option("--socket", dest="socket", action="store", default=None,
+                            help="The socket to listen on (default: $EUPS_DAEMON_SOCKET or one in the user data directory)")
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 2
+
+        from . import daemon
+        try:
+            pid = daemon.startDaemon(self.opts.socket, self.opts.idleTimeout,
+                                     foreground=self.opts.foreground, verbose=self.opts.verbose)
+        except RuntimeError as e:
+            self.err(str(e))
+            return 1
+
+        if self.opts.verbose and not self.opts.foreground:
+            print("Started eups daemon (pid %d) on %s" %
+                  (pid, self.opts.socket or daemon.socketPath()), file=utils.stdinfo)
+
+        return 0
+
+class AdminStopDaemonCmd(EupsCmd):
+
+    usage = "%prog admin stopDaemon [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Stop a running eups daemon
+"""
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("--socket", dest="socket", action="store", default=None,
+                            help="The daemon's socket (default: $EUPS_DAEMON_SOCKET or one in the user data directory)")
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 2
+
+        from . import daemon
+        if not daemon.EupsDaemon(self.opts.socket).stop():
+            if self.opts.verbose:
+                print("No eups daemon is running", file=utils.stdinfo)
+
+        return 0
+
 class AdminClearServerCacheCmd(EupsCmd):
 
     usage = "%prog admin clearServerCache [-h|--help] [options]"
@@ -1712,6 +1969,7 @@ class AdminClearServerCacheCmd(EupsCmd):
                             "(may be a URL or scp specification).  Default: find in $EUPS_PKGROOT")
 
     def execute(self):
+        from .distrib.server import ServerConf
         self.args.pop(0)                # remove the "admin"
 
         if len(self.args) > 0:
@@ -1980,6 +2238,8 @@ If no product or version is provided, all defined tags are defined.
         EupsCmd.addOptions(self)
 
     def execute(self):
+        from . import distrib
+        from .distrib.server import importClass
         # get rid of sub-command arg
         self.args.pop(0)
 
@@ -2089,6 +2349,7 @@ slowly as each product's availability will be checked.
                             help="equivalent to --server-dir (deprecated)")
 
     def execute(self):
+        from . import distrib
         myeups = eups.Eups(readCache=False)
         if self.opts.tag:
             # Note: tag may not yet be registered locally, yet; though it may be
@@ -2182,6 +2443,7 @@ tag will be installed.
 """
 
     def addOptions(self):
+        from . import distrib
         self.clo.enable_interspersed_args()
 
         self.clo.add_option("-d", "--declareAs", dest="alsoTag", action="append", metavar="TAG",
@@ -2200,6 +2462,8 @@ tag will be installed.
         self.clo.add_option("-j", "--nodepend", dest="depends", action="store_const",
                             const=distrib.Repositories.DEPS_NONE,
                             help="Just install product, but not its dependencies")
+        self.clo.add_option("-J", "--jobs", dest="jobs", action="store", type="int", default=1, metavar="N",
+                            help="Build up to N packages at once, each as soon as its dependencies are installed")
         self.clo.add_option("-o", "--onlydepend", dest="depends", action="store_const",
                             const=distrib.Repositories.DEPS_ONLY,
                             help="Just install product dependencies, not the product itself")
@@ -2241,6 +2505,7 @@ tag will be installed.
                             help="Make top level product current (equivalent to --tag current)")
 
     def execute(self):
+        from . import distrib
         try:
             _opts = copy.deepcopy(self.opts)
             _opts.tag = None
@@ -2364,7 +2629,7 @@ tag will be installed.
             repos.install(productName, versionName, updateTags,
                           self.opts.alsoTag, self.opts.depends,
                           self.opts.noclean, self.opts.noeups, dopts,
-                          self.opts.manifest, self.opts.searchDep)
+                          self.opts.manifest, self.opts.searchDep, jobs=self.opts.jobs)
         except eups.EupsException as e:
             e.status = 1
             if log:
@@ -2391,7 +2656,7 @@ tag will be installed.
 
 class DistribCleanCmd(EupsCmd):
 
-    usage = "%prog distrib clean [-h|--help] [options] product version"
+    usage = "%prog distrib clean [-h|--help] [options] [--cache] product version"
 
     # set this to True if the description is preformatted.  If false, it
     # will be automatically reformatted to fit the screen
@@ -2402,11 +2667,15 @@ class DistribCleanCmd(EupsCmd):
 This will remove the build directory as well as (if possible) a partially
 installed product if they exist.  If the -R is provided, the installed
 product will be fully removed, even if its installation was successful.
+If --cache is provided, the files kept from earlier downloads are removed;
+the product and version may then be omitted.
 """
 
     def addOptions(self):
         self.clo.enable_interspersed_args()
 
+        self.clo.add_option("--cache", dest="cache", action="store_true", default=False,
+                            help="Remove the files kept from earlier downloads")
         self.clo.add_option("-P", "--product-dir", dest="pdir", action="store", metavar="DIR",
                             help="Assume the DIR is the product's installation/root directory")
         self.clo.add_option("-R", "--remove", dest="remove", action="store_true", default=False,
@@ -2435,9 +2704,20 @@ product will be fully removed, even if its installation was successful.
                             help="equivalent to --repository (deprecated)")
 
     def execute(self):
+        from . import distrib
         # get rid of sub-command arg
         self.args.pop(0)
 
+        if self.opts.cache:
+            cache = distrib.server.DownloadCache.default()
+            if cache:
+                if self.opts.verbose > 0:
+                    print("Removing %s" % cache.cacheDir, file=utils.stdinfo)
+                if not self.opts.noaction:
+                    cache.clear()
+            if len(self.args) == 0:
+                return 0
+
         if len(self.args) == 0:
             self.err("Please specify a product name and version")
             return 2
@@ -2566,6 +2846,8 @@ class DistribCreateCmd(EupsCmd):
 
 
     def execute(self):
+        from . import distrib
+        from .distrib.server import Mapping
         # get rid of sub-command arg
         self.args.pop(0)
 
@@ -2831,6 +3113,7 @@ The tagname may be a glob pattern.
                             help="equivalent to --server-dir (deprecated)")
 
     def execute(self):
+        from . import distrib
         myeups = eups.Eups(readCache=False)
 
         # get rid of sub-command arg
@@ -3183,6 +3466,7 @@ register("pkg-config",   PkgconfigCmd, lockType=lock.LOCK_SH)
 register("uses",         UsesCmd, lockType=lock.LOCK_SH)
 register("expandbuild",  ExpandbuildCmd, lockType=lock.LOCK_SH)
 register("expandtable",  ExpandtableCmd, lockType=lock.LOCK_SH)
+register("freeze",       FreezeCmd, lockType=lock.LOCK_SH)
 register("declare",      DeclareCmd)
 register("undeclare",    UndeclareCmd)
 register("remove",       RemoveCmd)
@@ -3195,6 +3479,8 @@ register("admin listLocks",        AdminListLocksCmd, lockType=None)
 register("admin listCache",        AdminListCacheCmd, lockType=lock.LOCK_SH)
 register("admin info",             AdminInfoCmd, lockType=lock.LOCK_SH)
 register("admin show",             AdminShowCmd, lockType=None)
+register("admin startDaemon",      AdminStartDaemonCmd, lockType=None)
+register("admin stopDaemon",       AdminStopDaemonCmd, lockType=None)
 register("distrib",         DistribCmd, lockType=None) # must be None, as subcommands take locks
 register("distrib clean",   DistribCleanCmd)
 register("distrib create",  DistribCreateCmd)
@@ -0,0 +1,388 @@
+"""
+an optional, long-lived eups server that keeps EUPS "warm" between commands.
+
+Every eups and setup command normally pays a constant start-up cost before
+doing any work:  importing the eups modules, loading the site and user
+customizations, and loading the product stacks.  When a daemon has been
+started (with "eups admin startDaemon"), bin/eups and bin/eups_setup load
+just eups.daemon_client (which doesn't import the eups package), and hand
+their command line, environment, working directory, and standard I/O file
+descriptors over a local Unix-domain socket to the daemon.  The daemon
+forks a child which, having inherited the already-imported modules, the
+loaded customizations, and the product stacks loaded by the daemon, runs the
+command in the caller's environment and writes directly to the caller's
+terminal; the exit status is sent back to the client.  As each command runs
+in its own child process, nothing it does can leak into later commands.
+
+The product stacks held by the daemon are checked against the databases
+before each use (see ProductStack.fromCache()), so changes made to a
+database are picked up.  A client whose environment would lead to a
+different configuration than the daemon's (e.g. a different $EUPS_PATH or
+$EUPS_USERDATA), or whose command line selects different databases, is told
+to run the command itself; if any of the customization files the daemon
+loaded has changed, the daemon shuts itself down.  If no daemon is
+running, or it cannot be reached, commands simply run in-process as usual.
+
+Set $EUPS_DAEMON_SOCKET to use a socket other than the default (see
+socketPath()), or $EUPS_NO_DAEMON to bypass the daemon altogether.
+"""
+from __future__ import absolute_import, print_function
+import array
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from . import utils
+from . import daemon_client
+from .daemon_client import socketPath, forward
+
+# environment variables which determine the customizations that are loaded
+# (see hooks.loadCustomization()); a client must agree with the daemon on them
+_configEnvVars = ["EUPS_DIR", "EUPS_PATH", "EUPS_SITEDATA", "EUPS_STARTUP", "EUPS_USERDATA", "HOME"]
+
+# command-line options that select the databases, and hence customizations
+_pathOptions = ["-Z", "--database", "--with-eups", "-z", "--select-db"]
+
+def _normPath(path):
+    # normalize a colon-separated path list as Eups.setEupsPath() would
+    out = []
+    for p in path.split(":"):
+        if p:
+            p = os.path.normpath(p)
+            if p not in out:
+                out.append(p)
+    return ":".join(out)
+
+def _configKey(environ):
+    # the parts of an environment that determine the eups configuration
+    key = {}
+    for k in _configEnvVars:
+        v = environ.get(k)
+        if v is not None and k in ("EUPS_PATH", "EUPS_STARTUP"):
+            v = _normPath(v)
+        key[k] = v
+    return key
+
+class EupsDaemon(object):
+    """
+    the eups daemon:  a server that accepts commands on a Unix-domain socket
+    and runs each in a forked child.  See the module documentation for
+    details.
+    """
+
+    def __init__(self, path=None, idleTimeout=3600, verbose=0):
+        """
+        @param path          the socket to listen on (default: socketPath())
+        @param idleTimeout   the number of seconds without any requests
+                                after which to exit; if <= 0, never exit.
+        @param verbose       the verbosity of messages to stderr
+        """
+        if not path:
+            path = socketPath()
+        self.path = path
+        self.idleTimeout = idleTimeout
+        self.verbose = verbose
+
+        self._sock = None
+        self._configKey = None
+        self._configFiles = {}          # customization files and their mtimes
+        self._children = set()
+
+    def isRunning(self):
+        """
+        return true if a daemon is accepting connections on our socket
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def stop(self):
+        """
+        ask the daemon listening on our socket to exit, returning false if
+        there wasn't one
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall((json.dumps(dict(stop=True)) + "\n").encode())
+            sock.recv(1024)
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def warm(self):
+        """
+        load everything that we can share with the commands that we run:  the
+        eups modules, the customizations, and the product stacks on $EUPS_PATH
+        """
+        import eups
+        import eups.cmd
+        import eups.setupcmd
+        import eups.debug
+        from eups import hooks
+        from eups.stack import ProductStack
+
+        configFiles = hooks.loadCustomization(self.verbose, path=eups.Eups.setEupsPath())
+        if self._configKey is None:
+            self._configKey = _configKey(os.environ)
+            # include the startup files that don't exist (yet)
+            configFiles = configFiles + [os.path.join(d, hooks.config.Eups.startupFileName)
+                                         for d in hooks.customisationDirs]
+            for f in configFiles:
+                self._configFiles[f] = os.stat(f).st_mtime if os.path.exists(f) else None
+
+        ProductStack.keepWarm()
+        try:
+            eups.Eups(readCache=True, quiet=1)
+        except Exception as e:
+            if self.verbose:
+                print("Unable to load product stacks: %s" % e, file=utils.stdwarn)
+
+    def serve(self, ready=None):
+        """
+        listen for and execute commands until told to stop, or idle for too
+        long.
+        @param ready   a function to call once we are listening
+        """
+        if self.isRunning():
+            raise RuntimeError("An eups daemon is already listening on %s" % self.path)
+        if os.path.exists(self.path):
+            os.remove(self.path)        # left over from a daemon that died
+
+        self.warm()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldmask = os.umask(0o077)       # only we may talk to the daemon
+        try:
+            self._sock.bind(self.path)
+        finally:
+            os.umask(oldmask)
+        self._sock.listen(32)
+        self._sock.settimeout(60)
+
+        if self.verbose:
+            print("eups daemon listening on %s" % self.path, file=utils.stdinfo)
+        if ready:
+            ready()
+
+        lastRequest = time.time()
+        try:
+            while True:
+                self._reap()
+                try:
+                    conn = self._sock.accept()[0]
+                except socket.timeout:
+                    if self.idleTimeout > 0 and time.time() - lastRequest > self.idleTimeout:
+                        break
+                    continue
+                except socket.error as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                lastRequest = time.time()
+                if not self._handle(conn):
+                    break
+
+                # have the stacks up-to-date for the next command
+                self.warm()
+        finally:
+            self._sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _reap(self):
+        for pid in list(self._children):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    self._children.discard(pid)
+            except OSError:
+                self._children.discard(pid)
+
+    def _declineReason(self, request):
+        # return why we can't run a request, or None if we can
+        if request.get("eupsDir") != os.path.dirname(os.path.abspath(__file__)):
+            return "the client uses a different eups installation"
+        if _configKey(request["env"]) != self._configKey:
+            return "the client's environment selects a different configuration"
+        for a in request["args"]:
+            if a.split("=")[0] in _pathOptions or \
+                    (a.startswith("-Z") or a.startswith("-z")) and not a.startswith("--"):
+                return "the command line selects databases"
+        return None
+
+    def _configChanged(self):
+        for f, mtime in self._configFiles.items():
+            if (os.stat(f).st_mtime if os.path.exists(f) else None) != mtime:
+                return f
+        return None
+
+    def _handle(self, conn):
+        # handle one connection, returning false if we should exit
+        conn.settimeout(None)
+        fds = []
+        try:
+            data = b""
+            while not data.endswith(b"\n"):
+                if hasattr(conn, "recvmsg"):
+                    chunk, ancdata = conn.recvmsg(65536, socket.CMSG_LEN(3*array.array("i").itemsize))[:2]
+                    for level, type, cdata in ancdata:
+                        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                            a = array.array("i")
+                            a.frombytes(cdata[:len(cdata) - len(cdata) % a.itemsize])
+                            fds.extend(a)
+                else:
+                    chunk = conn.recv(65536)
+                if not chunk:
+                    return True
+                data += chunk
+            request = json.loads(data.decode())
+
+            if request.get("stop"):
+                self._sock.close()      # so that we're seen to have stopped once we reply
+                conn.sendall(b"{}\n")
+                return False
+
+            changed = self._configChanged()
+            if changed:
+                self._reply(conn, fallback="%s has changed; the eups daemon is exiting" % changed)
+                return False
+
+            reason = self._declineReason(request)
+            if not reason and len(fds) != 3:
+                reason = "the client's standard I/O was not received"
+            if reason:
+                self._reply(conn, fallback=reason)
+                return True
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self._sock.close()
+                self._runChild(conn, request, fds) # never returns
+
+            self._children.add(pid)
+            return True
+        except (socket.error, ValueError, KeyError) as e:
+            if self.verbose:
+                print("Bad request to eups daemon: %s" % e, file=utils.stdwarn)
+            return True
+        finally:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+
+    def _reply(self, conn, **kwargs):
+        conn.sendall((json.dumps(kwargs) + "\n").encode())
+
+    def _runChild(self, conn, request, fds):
+        # run a request in a forked child, and send its status to the client
+        daemon_client.inDaemon = True
+
+        status = 9
+        try:
+            os.setpgid(0, 0)            # so the client can interrupt us and our children
+            self._reply(conn, pid=os.getpid())
+
+            for i, fd in enumerate(fds):
+                os.dup2(fd, i)
+            for f in (utils.stderr, utils.stdinfo, utils.stdwarn, utils.stdok):
+                f._isatty = os.isatty(2)
+
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            os.umask(request["umask"])
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+            import runpy
+            sys.argv = [request["script"]] + request["args"]
+            try:
+                runpy.run_path(request["script"], run_name="__main__")
+                status = 0
+            except SystemExit as e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+        except KeyboardInterrupt:
+            status = 130
+        except BaseException as e:
+            print("eups daemon: %s" % e, file=utils.stderr)
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                self._reply(conn, status=status)
+            finally:
+                os._exit(0)
+
+def startDaemon(path=None, idleTimeout=3600, foreground=False, verbose=0):
+    """
+    start an eups daemon listening on a given socket, detaching it from the
+    terminal unless foreground is True (in which case this only returns when
+    the daemon exits).  Returns the daemon's process ID (or ours, if
+    foreground is True)
+    @param path          the socket to listen on (default: socketPath())
+    @param idleTimeout   the number of idle seconds after which to exit
+    @param foreground    run in this process, rather than in the background
+    @param verbose       the verbosity of messages
+    """
+    daemon = EupsDaemon(path, idleTimeout, verbose)
+    if daemon.isRunning():
+        raise RuntimeError("An eups daemon is already listening on %s" % daemon.path)
+
+    if foreground:
+        daemon.serve()
+        return os.getpid()
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid:
+        # wait for the daemon to be listening, and report its pid
+        os.close(wfd)
+        reader = os.fdopen(rfd)
+        msg = reader.read()
+        reader.close()
+        os.waitpid(pid, 0)
+        if not msg.startswith("pid="):
+            raise RuntimeError("Unable to start eups daemon: %s" % msg.strip())
+        return int(msg[len("pid="):])
+
+    # the usual double fork to detach from the terminal
+    os.close(rfd)
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for i in range(3):
+            os.dup2(devnull, i)
+
+        def ready():
+            # tell the parent that we're up
+            os.write(wfd, ("pid=%d" % os.getpid()).encode())
+            os.close(wfd)
+
+        daemon.serve(ready)
+    except BaseException as e:
+        try:
+            os.write(wfd, str(e).encode())
+        except OSError:
+            pass
+    os._exit(0)
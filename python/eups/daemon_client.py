@@ -0,0 +1,118 @@
+"""
+the client side of the eups daemon (see eups.daemon):  hand a command over
+to a running daemon.
+
+This module only uses the standard library, and doesn't import the eups
+package, so that bin/eups and bin/eups_setup can load it by path (as
+"eups.daemon_client") and forward their commands without paying for
+importing eups; the eups modules are only imported if no daemon runs the
+command.
+"""
+from __future__ import absolute_import, print_function
+import array
+import json
+import os
+import signal
+import socket
+import sys
+
+# set in the daemon's children, so that the commands they run don't try to
+# hand themselves back to the daemon
+inDaemon = False
+
+def socketPath():
+    """
+    return the path to the daemon's socket:  $EUPS_DAEMON_SOCKET, if set;
+    otherwise a file in the user data directory (as returned by
+    eups.utils.defaultUserDataDir()) named after this host (so that a home
+    directory shared between machines may be used).
+    """
+    if os.environ.get("EUPS_DAEMON_SOCKET"):
+        return os.environ["EUPS_DAEMON_SOCKET"]
+
+    if "EUPS_USERDATA" in os.environ:
+        userDataDir = os.environ["EUPS_USERDATA"]
+    else:
+        home = os.path.expanduser("~")
+        if home[0] == "~":              # failed to expand
+            raise RuntimeError("Unable to find your home directory")
+        userDataDir = os.path.join(home, ".eups")
+
+    return os.path.join(userDataDir, "eupsd-%s.sock" % socket.gethostname())
+
+def forward(tool, script, args=None, fds=(0, 1, 2), verbose=0):
+    """
+    ask a running daemon to execute a command on our behalf, returning the
+    command's exit status, or None if the command should be run in-process
+    (there is no daemon, it could not be reached, or it declined).
+
+    @param tool      the name of the tool ("eups" or "setup"), for messages
+    @param script    the path to the script (e.g. bin/eups) implementing the
+                       tool; the daemon will run it with our arguments
+    @param args      the command-line arguments (default: sys.argv[1:])
+    @param fds       the file descriptors to hand over as the command's
+                       standard input, output, and error
+    @param verbose   if > 1, report why the daemon wasn't used
+    """
+    if inDaemon or os.environ.get("EUPS_NO_DAEMON"):
+        return None
+    if not hasattr(socket, "AF_UNIX") or not hasattr(socket.socket, "sendmsg"):
+        return None                     # we can't pass file descriptors
+
+    try:
+        path = socketPath()
+    except RuntimeError:
+        return None
+    if not os.path.exists(path):
+        return None
+
+    if args is None:
+        args = sys.argv[1:]
+
+    request = dict(script=os.path.abspath(script), args=args, cwd=os.getcwd(),
+                   env=dict(os.environ), eupsDir=os.path.dirname(os.path.abspath(__file__)))
+    umask = os.umask(0o022)
+    os.umask(umask)
+    request["umask"] = umask
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        data = (json.dumps(request) + "\n").encode()
+        n = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        sock.sendall(data[n:])
+
+        reader = sock.makefile("r")
+        try:
+            pid = None
+            while True:
+                try:
+                    line = reader.readline()
+                except KeyboardInterrupt:
+                    # pass the interrupt on to the command
+                    if pid:
+                        os.killpg(pid, signal.SIGINT)
+                    continue
+
+                if not line:
+                    # the daemon died; we don't know whether the command ran
+                    print("%s: lost contact with the eups daemon" % tool, file=sys.stderr)
+                    return 9
+
+                reply = json.loads(line)
+                if "fallback" in reply:
+                    if verbose > 1:
+                        print("Not using the eups daemon: %s" % reply["fallback"], file=sys.stderr)
+                    return None
+                elif "pid" in reply:
+                    pid = reply["pid"]
+                elif "status" in reply:
+                    return reply["status"]
+        finally:
+            reader.close()
+    except (socket.error, EnvironmentError, ValueError) as e:
+        if verbose > 1:
+            print("Unable to use the eups daemon at %s: %s" % (path, e), file=sys.stderr)
+        return None
+    finally:
+        sock.close()
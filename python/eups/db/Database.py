@@ -1,13 +1,19 @@
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
 import os
 import re
+import threading
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from .VersionFile import VersionFile
 from .ChainFile import ChainFile
 import eups.tags
 from eups.Product import Product
 from eups.exceptions import UnderSpecifiedProduct, ProductNotFound, TableFileNotFound
-from eups.utils import xrange, cmp_or_key, is_string
+from eups.utils import xrange, cmp_or_key, is_string, OrderedDict
 
 versionFileExt = "version"
 versionFileTmpl = "%s." + versionFileExt
@@ -15,12 +21,107 @@ versionFileRe = re.compile(r'^(\w.*)\.%s$' % versionFileExt)
 tagFileExt = "chain"
 tagFileTmpl = "%s." + tagFileExt
 tagFileRe = re.compile(r'^(\w.*)\.%s$' % tagFileExt)
+journalFileName = "_journal_"           # the change journal kept in the database directory
+indexFileName = "_index_"               # the index of the database's contents
+indexVersion = 1                        # change whenever the index's format changes
 
 try:
     _databases
 except NameError:
     _databases = {}                     # the actual Database objects, making Database(XXX) a singleton
 
+class _ParsedFiles(object):
+    """
+    A bounded, least-recently-used cache of parsed VersionFiles and ChainFiles,
+    shared by all the Databases in a process.  Each entry is validated against
+    its file's modification time and size whenever it's used, and the Databases
+    forget the files that they write themselves.
+
+    The cached objects are shared, so must not be modified; use VersionFile
+    or ChainFile directly to read a file that is to be changed.
+    """
+
+    maxSize = 2000                      # the maximum number of files to remember
+
+    def __init__(self, maxSize=None):
+        if maxSize is None:
+            maxSize = _ParsedFiles.maxSize
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cls, file, *args):
+        """
+        return the parsed contents of a file, as returned by cls(file, *args)
+        @param cls    the class to parse the file with (VersionFile or ChainFile)
+        @param file   the file to read
+        @param args   further arguments to pass to cls
+        """
+        try:
+            st = os.stat(file)
+        except OSError:
+            return cls(file, *args)     # let cls decide what a missing file means
+
+        key = (cls, file) + args
+        stamp = (getattr(st, "st_mtime_ns", st.st_mtime), st.st_size)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] == stamp:
+                self._entries[key] = entry # now the most recently used
+                self.hits += 1
+                return entry[1]
+        finally:
+            self._lock.release()
+
+        parsed = cls(file, *args)
+
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self._entries[key] = (stamp, parsed)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+        return parsed
+
+    def forget(self, file):
+        """
+        forget any parsed contents of a file (e.g. because it's been rewritten)
+        """
+        self._lock.acquire()
+        try:
+            for key in [k for k in self._entries if k[1] == file]:
+                del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        return a string summarising how well the cache is working
+        """
+        lookups = self.hits + self.misses
+        return "%d hits and %d misses (%.0f%%) among %d cached version and chain files" % \
+            (self.hits, self.misses, (100.0*self.hits/lookups if lookups else 0), len(self._entries))
+
+try:
+    parsedFiles
+except NameError:
+    parsedFiles = _ParsedFiles()        # the parsed version and chain files
+
 def Database(dbpath, userTagRoot=None, defStackRoot=None, owner=None):
     """Return the singleton _Database object identified by this function call's arguments
 
@@ -87,6 +188,29 @@ class _Database(object):
     main database directory with the assignments recorded as chain files.
     (Any version files there will be ignored.)
 
+    Every change made through declare(), undeclare(), assignTag(), and
+    unassignTag() is also appended to a small change journal (a file named
+    "_journal_") in the directory that was written to.  Each record carries
+    a monotonically increasing generation number, so that a cache of the
+    database can be validated by reading the last generation (see
+    getGeneration()) rather than by checking the modification time of every
+    file in the database, and can be brought up-to-date by reloading only
+    the products named in the records it has not yet seen (see getJournal()).
+    Changes made by other means (e.g. by hand or by older versions of EUPS)
+    are not journaled; if the journal cannot be written it is removed so that
+    clients fall back to the full check (see isNewerThan()).
+
+    A database with a journal may also have an index (a file named "_index_")
+    listing the versions, flavors, and tag assignments of every product, so
+    that questions such as "which versions of X are declared?" can be answered
+    without listing the directories and reading every version and chain file.
+    The index records the journal generation that it is current with, so it
+    can be checked cheaply; if it is missing or out of date, the product
+    directories are read instead.  The index is only written by processes
+    that change the database: it is kept up to date by the changes that are
+    journaled (and rebuilt by the first of them if needed), and can be
+    rebuilt with buildIndex() (e.g. by "eups admin buildCache").
+
     @author Raymond Plante
     """
 
@@ -98,6 +222,9 @@ class _Database(object):
         self.dbpath = dbpath
         self.defStackRoot = defStackRoot
 
+        # the indexes that we've read, keyed by directory (see _getIndex())
+        self._indexes = {}
+
         self.addUserTagDb(None, defStackRoot)
 
     def addUserTagDb(self, userTagRoot, upsdb, userId=None):
@@ -173,7 +300,7 @@ class _Database(object):
         if vfile is None:
             return None
 
-        verdata = VersionFile(vfile, name, version)
+        verdata = parsedFiles.get(VersionFile, vfile, name, version)
         product = None
         try:
             product = verdata.makeProduct(flavor, self.defStackRoot,
@@ -209,6 +336,11 @@ class _Database(object):
     def _findTagsInDir(self, dir, productName, version, flavor):
         # look tag assignments via chain files in a given directory
 
+        index = self._getIndex(os.path.dirname(dir))
+        if index is not None:
+            tags = index.get(productName, {}).get("tags", {})
+            return [t for t in tags if tags[t].get(flavor) == version]
+
         tagFiles = [x for x in os.listdir(dir) if not x.startswith('.')]
 
         tags = []
@@ -218,7 +350,7 @@ class _Database(object):
                 continue
 
             tag = mat.group(1)
-            cf = ChainFile(os.path.join(dir,file), productName, tag)
+            cf = parsedFiles.get(ChainFile, os.path.join(dir,file), productName, tag)
             if cf.getVersion(flavor) == version:
                 tags.append(tag)
 
@@ -228,6 +360,10 @@ class _Database(object):
         """
         return a list of the names of all products declared in this database
         """
+        index = self._getIndex()
+        if index is not None:
+            return [p for p in index if index[p]["versions"]]
+
         dirs = [z for z in os.listdir(self.dbpath) if os.path.isdir(os.path.join(self.dbpath,z))]
 
         out = []
@@ -247,6 +383,10 @@ class _Database(object):
         @param string productName : the name of the product to find
         @return string[] :
         """
+        index = self._getIndex()
+        if index is not None:
+            return list(index.get(productName, {}).get("versions", {}).keys())
+
         versions = []
         pdir = self._productDir(productName)
         if not os.path.exists(pdir):
@@ -275,11 +415,16 @@ class _Database(object):
         if not isinstance(versions, list):
             versions = [versions]
 
+        index = self._getIndex()
+
         out = []
         for version in versions:
-            vfile = self._versionFile(productName, version)
-            vfile = VersionFile(vfile, productName, version)
-            flavors = vfile.getFlavors()
+            if index is not None:
+                flavors = index.get(productName, {}).get("versions", {}).get(version, [])
+            else:
+                vfile = self._versionFile(productName, version)
+                vfile = parsedFiles.get(VersionFile, vfile, productName, version)
+                flavors = vfile.getFlavors()
             for f in flavors:
                 if f not in out:  out.append(f)
 
@@ -311,7 +456,7 @@ class _Database(object):
             vfile = self._versionFile(name, vers)
             if not os.path.exists(vfile):
                 continue
-            vfile = VersionFile(vfile, name, vers)
+            vfile = parsedFiles.get(VersionFile, vfile, name, vers)
 
             flavs = flavors
             declared = vfile.getFlavors()
@@ -371,11 +516,19 @@ class _Database(object):
                 if not os.path.exists(loc[i]):
                     continue
 
+            index = self._getIndex(os.path.dirname(loc[i]))
+            if index is not None:
+                tags = index.get(productName, {}).get("tags", {})
+                for tag in tags:
+                    for flavor, vers in tags[tag].items():
+                        out.append( (tgroup+tag, vers, flavor) )
+                continue
+
             for file in os.listdir(loc[i]):
                 mat = tagFileRe.match(file)
                 if mat:
                     tag = mat.group(1)
-                    file = ChainFile(os.path.join(loc[i],file), productName,tag)
+                    file = parsedFiles.get(ChainFile, os.path.join(loc[i],file), productName, tag)
                     for flavor in file.getFlavors():
                         vers = file.getVersion(flavor)
                         out.append( (tgroup+tag, vers, flavor) )
@@ -398,6 +551,13 @@ class _Database(object):
         if not os.path.exists(pdir):
             return False
 
+        index = self._getIndex()
+        if index is not None:
+            versions = index.get(productName, {}).get("versions", {})
+            if version is None:
+                return flavor is None or [v for v in versions if flavor in versions[v]] != []
+            return version in versions and (flavor is None or flavor in versions[version])
+
         if version is None:
             if flavor is None:
                 return True
@@ -405,7 +565,7 @@ class _Database(object):
             vfiles = os.listdir(pdir)
             for file in vfiles:
                 if (versionFileRe.match(file)):
-                    file = VersionFile(os.path.join(pdir,file))
+                    file = parsedFiles.get(VersionFile, os.path.join(pdir,file))
                     if file.hasFlavor(flavor):
                         return True
 
@@ -416,7 +576,7 @@ class _Database(object):
                 return False
             if flavor is None:
                 return True
-            file = VersionFile(file)
+            file = parsedFiles.get(VersionFile, file)
             return file.hasFlavor(flavor)
 
 
@@ -465,6 +625,8 @@ class _Database(object):
                 trimDir = None
 
         versionFile.write(trimDir)
+        parsedFiles.forget(vfile)
+        self._journal([("declare", prod.name, prod.version, prod.flavor, None)])
 
         # now assign any tags
         for tag in prod.tags:
@@ -504,7 +666,9 @@ class _Database(object):
                 self.unassignTag(tag, product.name, product.flavor)
 
         changed = versionFile.removeFlavor(product.flavor)
-        if changed:  versionFile.write()
+        if changed:
+            versionFile.write()
+            parsedFiles.forget(vfile)
 
         # do a little clean up: if we got rid of the version file, try
         # deleting the directory
@@ -514,12 +678,17 @@ class _Database(object):
             except:
                 pass
 
+        if changed:
+            self._journal([("undeclare", product.name, product.version,
+                            product.flavor, None)])
+
         return changed
 
     def getChainFile(self, tag, productName, searchUserDB=False):
         """
         return the ChainFile for the version name of the product that has the given tag assigned
-        to it.  None is return if the tag is not assigned to any version.
+        to it.  None is return if the tag is not assigned to any version.  The ChainFile may be
+        shared with other callers, so must not be modified.
         ProductNotFound is raised if no version of the product is declared.
         @param tag          the string name for the tag.  A user tag must be
                               prepended by a "user:" label to be found
@@ -543,7 +712,7 @@ class _Database(object):
         for pdir in pdirs:
             tfile = self._tagFileInDir(pdir, tag.name)
             if os.path.exists(tfile):
-                return ChainFile(tfile)
+                return parsedFiles.get(ChainFile, tfile)
 
         return None
 
@@ -581,7 +750,7 @@ class _Database(object):
         if is_string(tag):
             tag = eups.tags.Tag(tag)
 
-        vf = VersionFile(self._versionFile(productName, version))
+        vf = parsedFiles.get(VersionFile, self._versionFile(productName, version))
         declaredFlavors = vf.getFlavors()
         if len(declaredFlavors) == 0:
             raise ProductNotFound(productName, version)
@@ -624,6 +793,10 @@ class _Database(object):
 
         tagFile.setVersion(version, flavors)
         tagFile.write()
+        parsedFiles.forget(tfile)
+
+        self._journal([("assignTag", productName, version, f, str(tag)) for f in flavors],
+                      writeableDB)
 
 
     def unassignTag(self, tag, productNames, flavors=None):
@@ -655,7 +828,13 @@ class _Database(object):
         if flavors is not None and not isinstance(flavors, list):
             flavors = [flavors]
 
+        if dbroot != self.dbpath:
+            tagName = "user:" + tag
+        else:
+            tagName = tag
+
         unassigned = False
+        records = []
         for prod in productNames:
             tfile = self._tagFileInDir(self._productDir(prod,dbroot), tag)
             if not os.path.exists(tfile):
@@ -664,21 +843,113 @@ class _Database(object):
             if flavors is None:
                 # remove all flavors
                 os.remove(tfile)
+                parsedFiles.forget(tfile)
                 unassigned = True
+                records.append(("unassignTag", prod, None, None, tagName))
                 continue
 
             tf = ChainFile(tfile)
-            changed = False
+            changed = []
             for flavor in flavors:
                 if tf.removeVersion(flavor):
-                    changed = True
+                    changed.append(flavor)
 
             if changed:
                 tf.write()
+                parsedFiles.forget(tfile)
                 unassigned = True
+                records.extend(("unassignTag", prod, None, f, tagName) for f in changed)
+
+        if records:
+            self._journal(records, dbroot)
 
         return unassigned
 
+    def snapshot(self, productNames):
+        """
+        return a record of the version and chain files of the given products,
+        both in the database and in its user tag directories, that may be
+        passed to restore() to undo any changes made to them in the meantime.
+        @param productNames   the names of the products to record
+        """
+        dirs = [self.dbpath] + [d for d in self._getUserTagDb(values=True) if d]
+
+        snap = {}
+        for dbroot in dirs:
+            for productName in productNames:
+                pdir = self._productDir(productName, dbroot)
+                if not os.path.isdir(pdir):
+                    snap[(dbroot, productName)] = None
+                    continue
+
+                files = {}
+                for file in os.listdir(pdir):
+                    if versionFileRe.match(file) or tagFileRe.match(file):
+                        fd = open(os.path.join(pdir, file), "rb")
+                        try:
+                            files[file] = fd.read()
+                        finally:
+                            fd.close()
+                snap[(dbroot, productName)] = files
+
+        return snap
+
+    def restore(self, snap):
+        """
+        put back the version and chain files recorded by snapshot(), returning
+        the names of the products that had changed.  Each restored product
+        is recorded in the change journal of the directory it's in.
+        @param snap   the record returned by snapshot()
+        """
+        records = {}                    # journal records, keyed by directory
+        for (dbroot, productName), files in snap.items():
+            pdir = self._productDir(productName, dbroot)
+            if not os.path.isdir(pdir):
+                if files is not None:
+                    os.makedirs(pdir)
+                else:
+                    continue
+
+            if files is None:
+                files = {}
+
+            changed = False
+            for file in os.listdir(pdir):
+                if (versionFileRe.match(file) or tagFileRe.match(file)) and file not in files:
+                    os.remove(os.path.join(pdir, file))
+                    parsedFiles.forget(os.path.join(pdir, file))
+                    changed = True
+
+            for file, contents in files.items():
+                path = os.path.join(pdir, file)
+                if os.path.exists(path):
+                    fd = open(path, "rb")
+                    try:
+                        if fd.read() == contents:
+                            continue
+                    finally:
+                        fd.close()
+
+                fd = open(path, "wb")
+                fd.write(contents)
+                fd.close()
+                parsedFiles.forget(path)
+                changed = True
+
+            if not files:
+                try:
+                    os.rmdir(pdir)
+                except OSError:
+                    pass
+
+            if changed:
+                records.setdefault(dbroot, []).append(("restore", productName, None, None, None))
+
+        for dbroot, recs in records.items():
+            self._journal(recs, dbroot)
+
+        return sorted(set([rec[1] for recs in records.values() for rec in recs]))
+
     def isNewerThan(self, timestamp, dbrootdir=None):
         """
         return true if the state of this database is newer than a given time
@@ -714,6 +985,289 @@ class _Database(object):
 
         return False
 
+    def _journalFile(self, dbroot=None):
+        if not dbroot:
+            dbroot = self.dbpath
+        return os.path.join(dbroot, journalFileName)
+
+    def getGeneration(self):
+        """
+        return the generation number of the last change recorded in this
+        database's change journal, or None if the database has no journal
+        (in which case its state can only be determined via isNewerThan()).
+        Only the end of the journal is read.
+        """
+        return _lastGeneration(self._journalFile())
+
+    def getJournal(self, since=0):
+        """
+        return the change records written after a given generation as a list
+        of (generation, operation, productName, version, flavor, tag) tuples,
+        in the order the changes were made.  operation is one of "declare",
+        "undeclare", "assignTag", "unassignTag", or "restore"; version, flavor, and tag
+        are None when they do not apply (e.g. a tag removed from all flavors).
+        None is returned if the journal cannot account for every change since
+        that generation (e.g. it does not exist or has been reset).
+        A "restore" record (see restore()) means that the product's version
+        and chain files were put back as they were before some earlier
+        changes.
+
+        @param since    the generation of the last change already known to
+                           the caller; 0 means "before the journal was
+                           started".
+        """
+        try:
+            fd = open(self._journalFile())
+        except IOError:
+            return None
+
+        out = []
+        last = 0
+        try:
+            for line in fd:
+                if not line.endswith("\n"):
+                    break             # a record still being written
+                fields = [f or None for f in line[:-1].split("\t")]
+                last = int(fields[0])
+                if last > since:
+                    out.append(tuple([last] + fields[1:]))
+        finally:
+            fd.close()
+
+        if since > last or (since and out and out[0][0] != since + 1):
+            return None
+
+        return out
+
+    def _journal(self, records, dbroot=None):
+        """
+        append change records, each a tuple of (operation, productName,
+        version, flavor, tag), to the change journal in dbroot (default:
+        the database directory).
+        """
+        jfile = self._journalFile(dbroot)
+        gen = _lastGeneration(jfile)
+        gen0 = gen
+        if not gen:
+            # start a new journal from the clock so that its generations
+            # can't be confused with those of a journal that was removed
+            gen = int(time.time()*1000000)
+
+        lines = []
+        for rec in records:
+            gen += 1
+            lines.append("\t".join([str(gen)] + [f or "" for f in rec]) + "\n")
+
+        try:
+            # a single write to a file opened for appending, so that readers
+            # never see records out of order
+            fd = os.open(jfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(fd, "".join(lines).encode())
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            # an incomplete journal is worse than none at all
+            try:
+                os.remove(jfile)
+            except OSError:
+                pass
+            if os.path.exists(jfile):
+                print("Unable to update change journal %s: %s; caches may appear up-to-date when they are not" %
+                      (jfile, e), file=eups.utils.stdwarn)
+            else:
+                self.clearIndex(dbroot)
+            return
+
+        self._updateIndex(dbroot, gen0, gen, set([rec[1] for rec in records]))
+
+    def _indexFile(self, dbroot=None):
+        if not dbroot:
+            dbroot = self.dbpath
+        return os.path.join(dbroot, indexFileName)
+
+    def _getIndex(self, dbroot=None):
+        """
+        return the index of the products in dbroot (default: the database
+        directory), a dictionary mapping product names to dictionaries with
+        keys "versions" (mapping versions to lists of flavors) and "tags"
+        (mapping tag names to dictionaries of version names keyed by flavor),
+        or None if there is no index that's current with the journal (in which
+        case the caller should read the product directories).  Reading never
+        builds or saves an index; see buildIndex().
+        """
+        if not dbroot:
+            dbroot = self.dbpath
+
+        state = []
+        for f in (self._journalFile(dbroot), self._indexFile(dbroot)):
+            try:
+                st = os.stat(f)
+            except OSError:
+                self._indexes.pop(dbroot, None)
+                return None
+            state.append((st.st_size, st.st_mtime))
+        state = tuple(state)
+
+        if dbroot in self._indexes and self._indexes[dbroot][0] == state:
+            return self._indexes[dbroot][1]
+
+        index = _readIndex(self._indexFile(dbroot))
+        if index and index["generation"] == _lastGeneration(self._journalFile(dbroot)):
+            products = index["products"]
+        else:
+            products = None
+
+        self._indexes[dbroot] = (state, products)
+        return products
+
+    def buildIndex(self, dbroot=None):
+        """
+        build the index of the products in dbroot (default: the database
+        directory) from its product directories, and save it if we are allowed
+        to.  Nothing is done if there is no journal to tell readers whether
+        the index is current.
+        """
+        if not dbroot:
+            dbroot = self.dbpath
+        self._indexes.pop(dbroot, None)
+
+        gen = _lastGeneration(self._journalFile(dbroot)) # n.b. before we look at the database
+        if gen is None:
+            return
+
+        index = dict(version=indexVersion, generation=gen, products={})
+        for productName in os.listdir(dbroot):
+            entry = _indexProduct(os.path.join(dbroot, productName))
+            if entry:
+                index["products"][productName] = entry
+
+        _writeIndex(self._indexFile(dbroot), index)
+
+    def _updateIndex(self, dbroot, gen0, gen, productNames):
+        """
+        bring the index in dbroot up to date with the changes to the named
+        products recorded in the journal, provided that it was current as of
+        generation gen0; otherwise rebuild it.
+        """
+        if not dbroot:
+            dbroot = self.dbpath
+        self._indexes.pop(dbroot, None)
+
+        index = _readIndex(self._indexFile(dbroot))
+        if not index or not gen0 or index["generation"] != gen0:
+            self.buildIndex(dbroot)
+            return
+
+        for productName in productNames:
+            entry = _indexProduct(self._productDir(productName, dbroot))
+            if entry:
+                index["products"][productName] = entry
+            else:
+                index["products"].pop(productName, None)
+
+        index["generation"] = gen
+        _writeIndex(self._indexFile(dbroot), index)
+
+    def clearIndex(self, dbroot=None):
+        """
+        remove the index of the products in dbroot (default: the database
+        directory), if there is one; it will be rebuilt by the next journaled
+        change or by buildIndex().
+        """
+        if not dbroot:
+            dbroot = self.dbpath
+        self._indexes.pop(dbroot, None)
+
+        try:
+            os.remove(self._indexFile(dbroot))
+        except OSError:
+            pass
+
+def _indexProduct(pdir):
+    """
+    return the index entry for the product whose version and chain files are
+    in pdir (see _Database._getIndex()), or None if there are none.
+    """
+    try:
+        files = [f for f in os.listdir(pdir) if not f.startswith('.')]
+    except OSError:
+        return None
+
+    versions, tags = {}, {}
+    for file in files:
+        mat = versionFileRe.match(file)
+        if mat:
+            versions[mat.group(1)] = parsedFiles.get(VersionFile, os.path.join(pdir, file)).getFlavors()
+            continue
+
+        mat = tagFileRe.match(file)
+        if mat:
+            cf = parsedFiles.get(ChainFile, os.path.join(pdir, file))
+            tags[mat.group(1)] = dict([(f, cf.getVersion(f)) for f in cf.getFlavors()])
+
+    if not versions and not tags:
+        return None
+
+    return dict(versions=versions, tags=tags)
+
+def _readIndex(ifile):
+    """
+    return the index saved in a file, or None if it is missing or unreadable
+    """
+    try:
+        fd = open(ifile, "rb")
+        try:
+            index = pickle.load(fd)
+        finally:
+            fd.close()
+    except Exception:
+        return None
+
+    if not isinstance(index, dict) or index.get("version") != indexVersion:
+        return None
+
+    return index
+
+def _writeIndex(ifile, index):
+    """
+    save an index to a file, if we are allowed to
+    """
+    try:
+        fd = eups.utils.AtomicFile(ifile, "wb")
+        pickle.dump(index, fd, protocol=2)
+        fd.close()
+    except (IOError, OSError):
+        pass
+
+def _lastGeneration(jfile):
+    """
+    return the generation of the last complete record in a change journal
+    file, 0 if it has none, or None if the file does not exist.
+    """
+    try:
+        fd = open(jfile, "rb")
+    except IOError:
+        return None
+
+    try:
+        fd.seek(0, os.SEEK_END)
+        size = fd.tell()
+        chunk = b""
+        while size > 0:
+            # read backward until we have the last complete record
+            n = min(size, 512)
+            size -= n
+            fd.seek(size)
+            chunk = fd.read(n) + chunk
+            lines = chunk.split(b"\n")[:-1]   # drop any incomplete trailing record
+            if len(lines) > 1 or (lines and size == 0):
+                return int(lines[-1].split(b"\t", 1)[0])
+    finally:
+        fd.close()
+
+    return 0
+
 def _cmp_by_verflav(a, b):
     c = _cmp_str(a.version,b.version)
     if c == 0:
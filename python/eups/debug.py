@@ -4,9 +4,12 @@ Support for debugging
 N.b. can't go in utils.py as utils is imported be eups, and we need to import eups.Eups here
 """
 from __future__ import print_function
+import atexit
 import re
 import sys
 import eups.Eups
+from eups.db.Database import parsedFiles
+from eups import utils
 
 def parseDebugOption(debugOpts):
     """Parse the options passed on the command line as --debug=..."""
@@ -20,6 +23,8 @@ def parseDebugOption(debugOpts):
             sys.exit(1)
     # n.b. these may be reset later in a cmdHook
     eups.Eups.debugFlag = "debug" in debugOptions
+    if eups.Eups.debugFlag:
+        atexit.register(_reportCacheStats)
     eups.Eups.allowRaise = "raise" in debugOptions
     eups.Eups.profile = False
     for o in debugOptions:
@@ -28,3 +33,8 @@ def parseDebugOption(debugOpts):
             eups.Eups.profile = mat.group(1)
             if not eups.Eups.profile:
                 eups.Eups.profile = "eups.prof"
+
+def _reportCacheStats():
+    """Report how well the per-process caches worked"""
+    if eups.Eups.debugFlag:
+        print("Database files read: %s" % parsedFiles.stats(), file=utils.stdinfo)
@@ -242,6 +242,18 @@ class Distrib(object):
         """
         self.unimplemented("installPackage");
 
+    def prefetchPackage(self, location, product, version):
+        """Retrieve the files from the server that installPackage() will
+        need, so that they are already in the server's file cache when
+        it is called.  This may be called in a thread of its own.  This
+        implementation does nothing.
+        @param location     the location of the package on the server (see
+                               installPackage())
+        @param product      the name of the product installed by the package
+        @param version      the name of the product version
+        """
+        pass
+
     def cleanPackage(self, product, version, productRoot, location):
         """remove any distribution-specific remnants of a package installation.
         Some distrib mechanisms (namely, Pacman) maintain some of their own
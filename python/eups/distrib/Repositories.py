@@ -6,6 +6,8 @@ from __future__ import absolute_import, print_function
 import sys
 import os
 import re
+import signal
+import time
 import traceback
 
 import eups.utils as utils
@@ -135,6 +137,9 @@ class Repositories(object):
         # used by install() to control repeated error messages
         self._msgs = {}
 
+        # the packages being built in parallel by install(), if requested
+        self._jobs = None
+
     def listPackages(self, productName=None, versionName=None, flavor=None, tag=None):
         """Return a list of tuples (pkgroot, package-list)"""
 
@@ -270,7 +275,7 @@ class Repositories(object):
 
     def install(self, product, version=None, updateTags=None, alsoTag=None,
                 depends=DEPS_ALL, noclean=False, noeups=False, options=None,
-                manifest=None, searchDep=None):
+                manifest=None, searchDep=None, jobs=1):
         """
         Install a product and all its dependencies.
         @param product     the name of the product to install
@@ -321,6 +326,12 @@ class Repositories(object):
                             the choice to recurse is left up to the server
                             where the manifest comes from (which usually
                             defaults to False).
+        @param jobs        the maximum number of packages to build at once.
+                            If > 1, each package is built in a separate
+                            process as soon as the packages it depends on
+                            (according to its manifest) have been installed;
+                            declaring and tagging the installed products is
+                            still done one at a time, by this process.
         """
         if alsoTag is not None:
             if utils.is_string(alsoTag):
@@ -353,9 +364,66 @@ class Repositories(object):
             raise EupsException("You asked to install %s %s but it is not in the manifest\nCheck manifest.remap (see \"eups startup\") and/or increase the verbosity" % (product, version))
 
         self._msgs = {}
-        self._recursiveInstall(0, man, product, version, flavor, pkgroot,
-                               productRoot, updateTags, alsoTag, options,
-                               depends, noclean, noeups)
+        if not self.eups.noaction:
+            self._prefetch(man, product, version, flavor, options, depends, noeups)
+
+        if jobs > 1:
+            self._jobs = _InstallJobs(jobs, self.log, self.verbose)
+        try:
+            self._recursiveInstall(0, man, product, version, flavor, pkgroot,
+                                   productRoot, updateTags, alsoTag, options,
+                                   depends, noclean, noeups)
+            if self._jobs:
+                self._jobs.wait()
+        finally:
+            if self._jobs:
+                self._jobs.abort()
+            self._jobs = None
+
+    def _prefetch(self, manifest, product, version, flavor, opts=None, depends=DEPS_ALL, noeups=False):
+        """Download the packages in a manifest that will need to be installed, several at
+        a time, so that they're waiting in the servers' file caches when we get to them.
+        product, version, and depends select the packages as in _recursiveInstall()"""
+
+        nthread = hooks.config.distrib.get("prefetch", 0)
+        if not nthread:
+            return
+
+        instflavor = flavor
+        if instflavor == "generic":
+            instflavor = self.eups.flavor
+
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+
+        fetches = []
+        for prod in manifest.getProducts():
+            if not prod.distId or prod.product == defaultProduct or prod.version == "dummy":
+                continue
+
+            is_product = (prod.product == product and prod.version == version)
+            if depends == self.DEPS_NONE and not is_product:
+                continue
+            elif depends == self.DEPS_ONLY and is_product:
+                continue
+
+            if not noeups and not self.eups.force and \
+                   self.eups.findProduct(prod.product, prod.version, flavor=instflavor):
+                continue
+
+            pkg = self.findPackage(prod.product, prod.version, prod.flavor)
+            if not pkg or self.repos[pkg[3]].distServer.NOCACHE:
+                continue
+            try:
+                distrib = self.repos[pkg[3]].getDistribFor(prod.distId, opts, instflavor)
+            except RuntimeError:
+                continue
+
+            fetches.append((distrib.prefetchPackage,
+                            (distrib.parseDistID(prod.distId), prod.product, prod.version)))
+
+        if self.verbose > 1 and fetches:
+            print("Prefetching %d packages" % len(fetches), file=self.log)
+        server.prefetch(fetches, nthread, self.verbose, self.log)
 
     def _recursiveInstall(self, recursionLevel, manifest, product, version,
                           flavor, pkgroot, productRoot, updateTags=None,
@@ -542,44 +610,58 @@ class Repositories(object):
                     if nprod:
                         prod = nprod
 
-                    self._doInstall(pkgroot, prod, productRoot, instflavor, opts, noclean, setups, tag)
+                    deps = [(p.product, p.version) for p in dman.getProducts()
+                            if p.product != prod.product or p.version != prod.version]
+                    self._doInstall(pkgroot, prod, productRoot, instflavor, opts, noclean, setups, tag, deps)
 
                     if pver not in ances:
                         ances.append(pver)
 
             if self.verbose >= 0:
+                if self._jobs and self._jobs.isPending(prod.product, prod.version):
+                    done = "queued."
+                else:
+                    done = "done."
                 if self.log.isatty():
-                    print("\r", msg, " "*(70-len(msg)), "done. ", file=self.log)
+                    print("\r", msg, " "*(70-len(msg)), done, file=self.log)
                 else:
-                    print("done.", file=self.log)
+                    print(done, file=self.log)
 
-            # Whether or not we just installed the product, we need to...
-            # ...add the product to the setups
-            setups.append("setup --just --type=build %s %s" % (prod.product, prod.version))
-
-            # ...update the tags
-            self._updateServerTags(prod, productRoot, instflavor, installCurrent=opts["installCurrent"],
-                                   desiredTag=updateTags)
-            if alsoTag:
-                if self.verbose > 1:
-                    print("Assigning Tags to %s %s: %s" % \
-                          (prod.product, prod.version, ", ".join([str(t) for t in alsoTag])), file=self.log)
-                for tag in alsoTag:
-                    try:
-                        self.eups.assignTag(tag, prod.product, prod.version, productRoot)
-                    except Exception as e:
-                        msg = str(e)
-                        if msg not in self._msgs:
-                            print(msg, file=self.log)
-                        self._msgs[msg] = 1
+            # Whether or not we just installed the product, we need to add it to the setups
+            # and update its tags, once it's been installed
+            if self._jobs:
+                self._jobs.whenInstalled([(prod.product, prod.version)], self._tagInstalled,
+                                         prod, productRoot, instflavor, opts, updateTags, alsoTag, setups)
+            else:
+                self._tagInstalled(prod, productRoot, instflavor, opts, updateTags, alsoTag, setups)
 
             # ...note that this package is now installed
             installed.append(pver)
 
         return True
 
+    def _tagInstalled(self, prod, productRoot, instflavor, opts, updateTags, alsoTag, setups):
+        # ...add the product to the setups
+        setups.append("setup --just --type=build %s %s" % (prod.product, prod.version))
+
+        # ...update the tags
+        self._updateServerTags(prod, productRoot, instflavor, installCurrent=opts["installCurrent"],
+                               desiredTag=updateTags)
+        if alsoTag:
+            if self.verbose > 1:
+                print("Assigning Tags to %s %s: %s" % \
+                      (prod.product, prod.version, ", ".join([str(t) for t in alsoTag])), file=self.log)
+            for tag in alsoTag:
+                try:
+                    self.eups.assignTag(tag, prod.product, prod.version, productRoot)
+                except Exception as e:
+                    msg = str(e)
+                    if msg not in self._msgs:
+                        print(msg, file=self.log)
+                    self._msgs[msg] = 1
+
     def _doInstall(self, pkgroot, prod, productRoot, instflavor, opts,
-                   noclean, setups, tag):
+                   noclean, setups, tag, deps=None):
 
         if prod.instDir:
             installdir = prod.instDir
@@ -607,6 +689,17 @@ class Repositories(object):
         if self.verbose > 1 and hasattr(distrib, 'NAME'):
             print("Using Distrib type:", distrib.NAME, file=self.log)
 
+        if self._jobs:
+            # build it in the background; we'll declare it when it's done
+            self._jobs.add(prod.product, prod.version, deps,
+                           self._buildPackage, (distrib, prod, productRoot, setups, builddir),
+                           self._declareInstalled, (pkgroot, prod, productRoot, instflavor, opts,
+                                                    noclean, distrib, setups))
+        else:
+            self._buildPackage(distrib, prod, productRoot, setups, builddir)
+            self._declareInstalled(pkgroot, prod, productRoot, instflavor, opts, noclean, distrib, setups)
+
+    def _buildPackage(self, distrib, prod, productRoot, setups, builddir):
         try:
             distrib.installPackage(distrib.parseDistID(prod.distId),
                                    prod.product, prod.version,
@@ -620,6 +713,7 @@ class Repositories(object):
         except RuntimeError as e:
             raise e
 
+    def _declareInstalled(self, pkgroot, prod, productRoot, instflavor, opts, noclean, distrib, setups):
         # declare the newly installed package, if necessary
         if not instflavor:
             instflavor = opts["flavor"]
@@ -1063,3 +1157,212 @@ class Repositories(object):
         location = distrib.parseDistID(distId)
         productRoot = self.getInstallRoot()
         return distrib.cleanPackage(product, version, productRoot, location)
+
+
+class _InstallJobs(object):
+    """
+    the packages being built in parallel by Repositories.install().  Each
+    package is built in a forked process once the packages that it depends
+    on have been installed, with at most maxJobs builds running at once.
+    Everything else (declaring and tagging the products) is done in the
+    calling process as each build finishes, so it's serialized under the
+    locks held by the eups command.
+    """
+
+    pollInterval = 0.1                  # seconds between checks for finished builds
+
+    def __init__(self, maxJobs, log=sys.stderr, verbose=0):
+        """
+        @param maxJobs   the maximum number of builds to run at once
+        @param log       the destination for progress messages
+        @param verbose   if >= 0, report the progress of each build
+        """
+        self.maxJobs = maxJobs
+        self.log = log
+        self.verbose = verbose
+
+        self._queued = []               # jobs waiting to be started
+        self._running = {}              # jobs being built, keyed by pid
+        self._pending = set()           # (product, version)s queued or being built
+        self._callbacks = []            # (keys, func, args) to call once keys are installed
+        self._failure = None            # a message describing the first failure
+        self._total = 0                 # the number of jobs added
+        self._started = 0               # the number of jobs started
+
+    def isPending(self, product, version):
+        """Return True if a product is waiting to be, or being, built"""
+        return (product, version) in self._pending
+
+    def add(self, product, version, deps, build, buildArgs, finish, finishArgs):
+        """
+        Build a product, in a forked process, once the products it depends on
+        have been installed
+        @param product     the product's name
+        @param version     the product's version
+        @param deps        a list of the (product, version)s that it depends on
+        @param build       the function that builds the product, called
+                              as build(*buildArgs) in the forked process
+        @param finish      the function that installs the built product,
+                              called as finish(*finishArgs) in this process
+        """
+        if self._failure:
+            self.wait()                 # raises the failure
+
+        key = (product, version)
+        self._total += 1
+        self._pending.add(key)
+        self._queued.append(dict(key=key, deps=deps or [], build=build, buildArgs=buildArgs,
+                                 finish=finish, finishArgs=finishArgs))
+        self._reap(block=False)
+        self._schedule()
+
+    def whenInstalled(self, keys, func, *args):
+        """
+        Call func(*args) once all the given (product, version)s have been
+        installed (i.e. now, if none is waiting to be built)
+        """
+        if [k for k in keys if k in self._pending]:
+            self._callbacks.append((keys, func, args))
+        else:
+            func(*args)
+
+    def wait(self):
+        """
+        Wait for all the builds to finish, raising RuntimeError if any failed
+        """
+        while self._running or (self._queued and not self._failure):
+            self._reap(block=True)
+            self._schedule()
+
+        if self._failure:
+            raise RuntimeError(self._failure)
+
+    def abort(self):
+        """Kill any builds that are still running, along with the processes they started"""
+        for pid in list(self._running.keys()):
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                pass
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            os.close(self._running.pop(pid)["fd"])
+        self._queued = []
+
+    def _schedule(self):
+        # start as many of the queued jobs as we can
+        if self._failure:
+            return
+
+        for job in list(self._queued):
+            if len(self._running) >= self.maxJobs:
+                break
+            if not [d for d in job["deps"] if d in self._pending]:
+                self._queued.remove(job)
+                self._start(job)
+
+        if self._queued and not self._running:
+            # the queued jobs are waiting for each other (circular dependencies);
+            # build them in the order that they were found, as a serial install would
+            self._start(self._queued.pop(0))
+
+    def _start(self, job):
+        rfd, wfd = os.pipe()
+        for fd in (self.log, sys.stdout, sys.stderr):
+            fd.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            # run the build in its own process group, so that abort() can kill
+            # the commands it runs as well.  The handlers we inherited (e.g. the
+            # one that gives up the locks held by the eups command) aren't ours
+            os.setpgid(0, 0)
+            for s in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(s, signal.SIG_DFL)
+            os.close(rfd)
+            status = 0
+            try:
+                job["build"](*job["buildArgs"])
+            except BaseException as e:
+                status = 1
+                os.write(wfd, (str(e) or e.__class__.__name__).encode()[:4096])
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(status)
+
+        try:
+            os.setpgid(pid, pid)        # in case we get to abort() first
+        except OSError:
+            pass                        # the child got there first
+        os.close(wfd)
+        self._started += 1
+        job.update(fd=rfd, start=time.time(), n=self._started)
+        self._running[pid] = job
+
+        self._report(job, "building")
+
+    def _finished(self):
+        # return the (pid, status) of a build that has finished, or None.  We only
+        # wait for our own builds, as other children of this process are none
+        # of our business
+        for pid in list(self._running.keys()):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done == pid:
+                return pid, status
+        return None
+
+    def _reap(self, block):
+        # collect finished builds, waiting for one if block is True
+        while self._running:
+            finished = self._finished()
+            if finished is None:
+                if not block:
+                    return
+                time.sleep(self.pollInterval)
+                continue
+            block = False               # just collect any others that have finished
+
+            pid, status = finished
+            job = self._running.pop(pid)
+
+            fd = os.fdopen(job["fd"], "rb")
+            msg = fd.read().decode("utf-8", "replace")
+            fd.close()
+
+            product, version = job["key"]
+            if status != 0:
+                self._report(job, "FAILED")
+                if not self._failure:
+                    self._failure = "Failed to install %s %s: %s" % \
+                                    (product, version, msg or "exit status %d" % (status >> 8))
+                continue
+
+            self._report(job, "done")
+            try:
+                job["finish"](*job["finishArgs"])
+            except Exception as e:
+                if not self._failure:
+                    self._failure = "Failed to install %s %s: %s" % (product, version, e)
+                continue
+
+            self._pending.discard(job["key"])
+            for cb in list(self._callbacks):
+                keys, func, args = cb
+                if not [k for k in keys if k in self._pending]:
+                    self._callbacks.remove(cb)
+                    func(*args)
+
+    def _report(self, job, what):
+        if self.verbose < 0:
+            return
+
+        msg = "  [ job %2d/%-2d ]  %s %s: %s" % ((job["n"], self._total) + job["key"] + (what,))
+        if what != "building":
+            msg += " (%ds)" % (time.time() - job["start"])
+        print(msg, file=self.log)
+        self.log.flush()
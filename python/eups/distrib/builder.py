@@ -294,6 +294,13 @@ DIST_URL = %%(base)s/builds/%%(path)s
                                                              flavor))
         return os.path.exists(os.path.join(serverDir, "builds", location))
 
+    def prefetchPackage(self, location, product, version):
+        """Retrieve the build file that installPackage() will need into the
+        server's file cache
+        """
+        self.distServer.getFileForProduct(location, product, version, self.Eups.flavor,
+                                          ftype="build")
+
     def installPackage(self, location, product, version, productRoot,
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
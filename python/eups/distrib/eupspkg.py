@@ -890,6 +890,13 @@ TAGLIST_DIR = tags
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, "products", location))
 
+    def prefetchPackage(self, location, product, version):
+        """Retrieve the package that installPackage() will need into the
+        server's file cache
+        """
+        self.distServer.getFileForProduct(location, product, version, self.Eups.flavor,
+                                          ftype="eupspkg")
+
     def installPackage(self, location, product, version, productRoot,
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
@@ -9,13 +9,25 @@ import os
 import re
 import atexit
 import fnmatch
+import hashlib
 import shutil
+import socket
 import tempfile
+import threading
+import time
 try:
-    from urllib2 import urlopen, HTTPError, URLError
+    import cPickle as pickle
 except ImportError:
-    from urllib.request import urlopen
+    import pickle
+try:
+    from urllib2 import urlopen, HTTPError, URLError, getproxies, proxy_bypass
+    from urlparse import urlsplit, urljoin
+    import httplib
+except ImportError:
+    from urllib.request import urlopen, getproxies, proxy_bypass
     from urllib.error import HTTPError, URLError
+    from urllib.parse import urlsplit, urljoin
+    import http.client as httplib
 import eups
 import eups.hooks as hooks
 import eups.utils as utils
@@ -368,7 +380,8 @@ class DistribServer(object):
         @param source      the name of the remote file to obtain a copy of
         @param noaction    if True, simulate the retrieval
         """
-        if not self.NOCACHE and source in self._fileCache:
+        if not self.NOCACHE and source in self._fileCache and \
+               os.path.exists(self._fileCache[source]):
             if self.verbose > 1:
                 msg = "%s has already been retrieved" % source
                 if self.verbose > 2:
@@ -376,7 +389,7 @@ class DistribServer(object):
 
                 print(msg, file=utils.stdinfo)
 
-            shutil.copy(self._fileCache[source], filename)
+            linkFile(self._fileCache[source], filename)
 
             return filename
 
@@ -387,7 +400,26 @@ class DistribServer(object):
         if parent and not os.path.isdir(parent):
             os.makedirs(parent)
 
-        trx.cacheToFile(filename, noaction=noaction) # this is not a cache! It's "copy to local file"
+        # we may have a copy from an earlier process, if the server says that it's still good
+        cache, cached = None, None
+        if not self.NOCACHE and not noaction:
+            cache = DownloadCache.default()
+            if cache:
+                cached = cache.lookup(source)
+
+        modified, validator = trx.cacheToFileIfChanged(filename, cached and cached[0],
+                                                       noaction=noaction)
+        if not modified:
+            if self.verbose > 1:
+                print("%s is unchanged since it was cached" % source, file=utils.stdinfo)
+
+            linkFile(cached[1], filename)
+        elif cache and validator:
+            try:
+                cache.add(source, filename, validator)
+            except (IOError, OSError) as e:
+                if self.verbose > 0:
+                    print("Unable to cache %s: %s" % (source, e), file=utils.stdwarn)
 
         self._fileCache[source] = filename
 
@@ -981,6 +1013,22 @@ class Transporter(object):
         """
         self.unimplemented("cacheToFile");
 
+    def cacheToFileIfChanged(self, filename, validator=None, noaction=False):
+        """cache the source to a local file, unless it hasn't changed since it
+        was retrieved along with the given validator (e.g. an HTTP ETag).
+        Return a tuple (modified, validator); if modified is False the file
+        was not written.  The returned validator identifies this version of
+        the source, or is None if this transporter has no way of telling
+        whether the source has changed.
+
+        This implementation always retrieves the file.
+        @param filename      the name of the file to cache to
+        @param validator     the validator returned by an earlier retrieval
+        @param noaction      if True, simulate the result (default: False)
+        """
+        self.cacheToFile(filename, noaction)
+        return True, None
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -991,8 +1039,30 @@ class Transporter(object):
     def unimplemented(self, name):
         raise Exception("%s: unimplemented (abstract) method" % name)
 
+class _HttpConnections(threading.local):
+    """the keep-alive HTTP connections opened by the current thread, keyed by
+    (scheme, host)"""
+
+    def __init__(self):
+        self.connections = {}
+
 class WebTransporter(Transporter):
-    """a class that can return files via an HTTP or FTP URL"""
+    """a class that can return files via an HTTP or FTP URL
+
+    HTTP(S) files are streamed to disk via a connection to the server that
+    is kept open for the next file retrieved (by the same thread) from the
+    same server.  A file is first written to filename.part; if the transfer
+    is interrupted it is retried, resuming from the end of the partial file,
+    and a partial file left behind by an earlier process is resumed too
+    (provided that the server says that the file hasn't changed).
+    """
+
+    chunkSize = 1 << 16                 # bytes to read at a time
+    retries = 3                         # number of times to retry an interrupted transfer
+    timeout = 60                        # seconds to wait for the server
+    maxRedirects = 5
+
+    _connections = _HttpConnections()
 
     # @staticmethod   # requires python 2.4
     def canHandle(source):
@@ -1009,6 +1079,17 @@ class WebTransporter(Transporter):
         @param filename      the name of the file to cache to
         @param noaction      if True, simulate the result (default: False)
         """
+        self.cacheToFileIfChanged(filename, None, noaction)
+
+    def cacheToFileIfChanged(self, filename, validator=None, noaction=False):
+        """cache the source to a local file, unless it hasn't changed since it
+        was retrieved along with the given validator (an HTTP ETag or
+        Last-Modified date).  Return a tuple (modified, validator); see
+        Transporter.cacheToFileIfChanged()
+        @param filename      the name of the file to cache to
+        @param validator     the validator returned by an earlier retrieval
+        @param noaction      if True, simulate the result (default: False)
+        """
         if filename is None:
             raise RuntimeError("filename is None")
 
@@ -1016,23 +1097,188 @@ class WebTransporter(Transporter):
             if self.verbose > 0:
                 system("touch " + filename)
                 print("Simulated web retrieval from", self.loc, file=self.log)
-        else:
-            url = None
-            out = None
+            return True, None
+
+        scheme, host = urlsplit(self.loc)[0:2]
+        if scheme not in ("http", "https") or \
+               (scheme in getproxies() and not proxy_bypass(host.split("@")[-1])):
+            self._urlopenToFile(filename)
+            return True, None
+
+        partial = filename + ".part"
+        try:
+            attempt = 0
+            while True:
+                try:
+                    modified, validator = self._httpToFile(self.loc, partial, validator)
+                    break
+                except socket.gaierror as e:
+                    raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e))
+                except (socket.error, httplib.HTTPException) as e:
+                    if getattr(e, "filename", None): # a problem with the local file
+                        raise
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise ServerNotResponding("Failed to retrieve URL %s (%s)" % (self.loc, e))
+                    if self.verbose > 0:
+                        print("Retrying %s (%s)" % (self.loc, e), file=self.log)
+                    time.sleep(0.5*2**(attempt - 1))
+        except KeyboardInterrupt:
+            raise EupsException("^C")
+
+        if modified:
+            os.rename(partial, filename)
+        elif os.path.exists(partial):
+            os.unlink(partial)
+        if os.path.exists(partial + ".validator"):
+            os.unlink(partial + ".validator")
+
+        return modified, validator or None
+
+    def _httpToFile(self, url, partial, validator=None):
+        """Retrieve url, appending to the partially-retrieved file partial if possible.
+        Return (modified, validator) (see cacheToFileIfChanged())"""
+
+        for i in range(self.maxRedirects + 1):
+            headers = {}
+
+            # A partial file's validator is the value of the ETag or Last-Modified
+            # header sent with its start; we only want the rest of the file if it
+            # hasn't changed since
+            offset = 0
+            partialValidator = None
+            if os.path.exists(partial) and os.path.exists(partial + ".validator"):
+                fd = open(partial + ".validator")
+                partialValidator = fd.read().strip()
+                fd.close()
+
+                offset = os.path.getsize(partial)
+                if offset > 0 and partialValidator:
+                    headers["Range"] = "bytes=%d-" % offset
+                    headers["If-Range"] = partialValidator
+                else:
+                    offset = 0
+
+            if not offset and validator:
+                if re.search(r'^(W/)?"', validator):
+                    headers["If-None-Match"] = validator
+                else:
+                    headers["If-Modified-Since"] = validator
+
+            response = self._request(url, headers)
             try:
-                try:                               # for python 2.4 compat
-                    url = urlopen(self.loc)
-                    out = open(filename, 'wb')
-                    out.write(url.read())
-                except HTTPError as e:
-                    raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, e.reason))
-                except URLError as e:
-                    raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e.reason))
-                except KeyboardInterrupt:
-                    raise EupsException("^C")
-            finally:
-                if url is not None: url.close()
-                if out is not None: out.close()
+                if response.status in (301, 302, 303, 307, 308):
+                    url = urljoin(url, response.getheader("Location"))
+                    response.read()
+                    continue
+                elif response.status == 304:
+                    response.read()
+                    return False, validator
+                elif response.status == 416 and offset: # Range Not Satisfiable; start again
+                    response.read()
+                    os.unlink(partial + ".validator")
+                    return self._httpToFile(url, partial, validator)
+                elif response.status == 206:
+                    start = re.search(r"^bytes\s+(\d+)-", response.getheader("Content-Range", ""))
+                    if not start or int(start.group(1)) != offset:
+                        response.read()
+                        os.unlink(partial + ".validator")
+                        return self._httpToFile(url, partial, validator)
+
+                    out = open(partial, "ab")
+                elif response.status == 200:
+                    partialValidator = response.getheader("ETag") or \
+                                       response.getheader("Last-Modified") or ""
+
+                    fd = open(partial + ".validator", "w")
+                    fd.write(partialValidator)
+                    fd.close()
+
+                    out = open(partial, "wb")
+                else:
+                    response.read()
+                    raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, response.reason))
+
+                try:
+                    nread = 0
+                    while True:
+                        data = response.read(self.chunkSize)
+                        if not data:
+                            break
+                        out.write(data)
+                        nread += len(data)
+                finally:
+                    out.close()
+
+                length = response.getheader("Content-Length")
+                if length is not None and nread < int(length):
+                    raise httplib.IncompleteRead(b"", int(length) - nread)
+
+                return True, partialValidator
+            except:
+                # we don't know how much of the response is still to come, so we can't reuse
+                # the connection
+                self._disconnect(url)
+                raise
+
+        raise RemoteFileNotFound("Failed to open URL %s (too many redirections)" % self.loc)
+
+    def _request(self, url, headers):
+        """Send a GET request for url to its server, reusing this thread's connection to the
+        server if there is one, and return the response"""
+
+        scheme, host, path, query = urlsplit(url)[0:4]
+        if not path:
+            path = "/"
+        if query:
+            path += "?" + query
+
+        headers["User-Agent"] = "eups"
+
+        connections = self._connections.connections
+        while True:
+            conn = connections.get((scheme, host))
+            reused = conn is not None
+            if not reused:
+                if scheme == "https":
+                    conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+                else:
+                    conn = httplib.HTTPConnection(host, timeout=self.timeout)
+                connections[(scheme, host)] = conn
+
+            try:
+                conn.request("GET", path, headers=headers)
+                return conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                self._disconnect(url)
+                if not reused:          # else the server may have closed an idle connection
+                    raise
+
+    def _disconnect(self, url):
+        """Close this thread's connection to url's server"""
+
+        conn = self._connections.connections.pop(tuple(urlsplit(url)[0:2]), None)
+        if conn is not None:
+            conn.close()
+
+    def _urlopenToFile(self, filename):
+        """Retrieve the source using urlopen (e.g. for ftp:// URLs)"""
+        url = None
+        out = None
+        try:
+            try:                               # for python 2.4 compat
+                url = urlopen(self.loc, timeout=self.timeout)
+                out = open(filename, 'wb')
+                shutil.copyfileobj(url, out, self.chunkSize)
+            except HTTPError as e:
+                raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, e.reason))
+            except URLError as e:
+                raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e.reason))
+            except KeyboardInterrupt:
+                raise EupsException("^C")
+        finally:
+            if url is not None: url.close()
+            if out is not None: out.close()
 
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
@@ -2319,12 +2565,275 @@ class ServerConf(object):
 
     makeServer = staticmethod(makeServer)  # should work as of python 2.2
 
+class DownloadCache(object):
+    """a cache of the files retrieved from remote servers that persists
+    between eups processes, kept in the user's data directory.
+
+    Entries are keyed by the source URL, and record the validator (e.g. HTTP
+    ETag or Last-Modified date) returned along with the file; a cached copy
+    is only used once the server has confirmed that it is still current
+    (see Transporter.cacheToFileIfChanged()), so files whose source cannot
+    provide a validator aren't cached.  The files themselves are stored
+    under the SHA-1 checksum of their contents (so a file retrieved from
+    several URLs is only stored once), and are hard-linked (or, across
+    filesystems, copied) to where they are wanted.
+
+    When the cached files' total size exceeds maxSize bytes, the least
+    recently used files are removed.
+    """
+
+    # the caches created by default(), keyed by directory
+    _caches = {}
+    # the largest difference between a cached file's modification time and
+    # that recorded in its entry for which the file is considered unchanged
+    mtimeTolerance = 1e-3
+
+    def __init__(self, cacheDir, maxSize=None):
+        """
+        @param cacheDir    the directory holding the cache
+        @param maxSize     the maximum total size of the cached files in bytes
+                             (default: hooks.config.distrib["downloadCacheSize"])
+        """
+        if maxSize is None:
+            maxSize = hooks.config.distrib.get("downloadCacheSize", 0)
+
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self._size = None               # the total size of the files; unknown
+        self._lock = threading.Lock()
+
+    # @staticmethod   # requires python 2.4
+    def default():
+        """return the cache in the user's data directory, or None if downloads
+        should not be cached (hooks.config.distrib["downloadCacheSize"] is 0)
+        """
+        if not hooks.config.distrib.get("downloadCacheSize", 0):
+            return None
+        try:
+            userDataDir = utils.defaultUserDataDir()
+        except RuntimeError:
+            return None
+        if not userDataDir:
+            return None
+
+        cacheDir = os.path.join(userDataDir, "_caches_", "_downloads_")
+        if cacheDir not in DownloadCache._caches:
+            DownloadCache._caches[cacheDir] = DownloadCache(cacheDir)
+
+        return DownloadCache._caches[cacheDir]
+
+    default = staticmethod(default)  # should work as of python 2.2
+
+    def _entryFile(self, source):
+        name = hashlib.sha1(source.encode("utf-8")).hexdigest()
+        return os.path.join(self.cacheDir, "entries", name[:2], name)
+
+    def _objectFile(self, checksum):
+        return os.path.join(self.cacheDir, "objects", checksum[:2], checksum)
+
+    def lookup(self, source):
+        """return (validator, filename) for a cached copy of a source URL, or
+        None if it is not in the cache
+        @param source      the URL of the remote file
+        """
+        entryFile = self._entryFile(source)
+
+        self._lock.acquire()
+        try:
+            try:
+                fd = open(entryFile, "rb")
+                try:
+                    entry = pickle.load(fd)
+                finally:
+                    fd.close()
+            except Exception:
+                return None
+
+            # Check that the cached file hasn't been removed or written to (e.g. via a
+            # hard link to it) since it was cached.  Setting the access time below
+            # may round the modification time (e.g. to microseconds in python 2),
+            # so allow for that
+            objectFile = self._objectFile(entry["checksum"])
+            try:
+                st = os.stat(objectFile)
+            except OSError:
+                st = None
+            if entry.get("source") != source or not st or st.st_size != entry["size"] or \
+                   abs(st.st_mtime - entry["mtime"]) > DownloadCache.mtimeTolerance:
+                self._remove(entryFile)
+                return None
+
+            os.utime(objectFile, (time.time(), st.st_mtime)) # we use the access time to find the LRU files
+        finally:
+            self._lock.release()
+
+        return entry["validator"], objectFile
+
+    def add(self, source, filename, validator):
+        """add a file retrieved from a source URL to the cache
+        @param source      the URL of the remote file
+        @param filename    the retrieved file; it should not be modified
+                             after being added to the cache
+        @param validator   the source's validator, as returned along with
+                             the file
+        """
+        h = hashlib.sha1()
+        fd = open(filename, "rb")
+        try:
+            while True:
+                data = fd.read(1 << 16)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            fd.close()
+
+        checksum = h.hexdigest()
+        objectFile = self._objectFile(checksum)
+        entryFile = self._entryFile(source)
+
+        self._lock.acquire()
+        try:
+            for d in (os.path.dirname(objectFile), os.path.dirname(entryFile)):
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+
+            if not os.path.exists(objectFile):
+                tmpFile = "%s.%d.tmp" % (objectFile, os.getpid())
+                linkFile(filename, tmpFile)
+                os.rename(tmpFile, objectFile)
+
+                if self._size is not None:
+                    self._size += os.path.getsize(objectFile)
+
+            st = os.stat(objectFile)
+            fd = utils.AtomicFile(entryFile, "wb")
+            pickle.dump(dict(source=source, validator=validator, checksum=checksum,
+                             size=st.st_size, mtime=st.st_mtime), fd, protocol=2)
+            fd.close()
+
+            if self._size is None or self._size > self.maxSize:
+                self.prune()
+        finally:
+            self._lock.release()
+
+    def prune(self, maxSize=None):
+        """remove the least recently used files until the cache's total size is
+        no more than maxSize bytes, along with any entries for files that are no
+        longer cached
+        @param maxSize     the desired maximum size (default: self.maxSize)
+        """
+        if maxSize is None:
+            maxSize = self.maxSize
+
+        objects = []                    # (atime, size, filename)
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.cacheDir, "objects")):
+            for f in filenames:
+                objectFile = os.path.join(dirpath, f)
+                try:
+                    st = os.stat(objectFile)
+                except OSError:
+                    continue
+                objects.append((st.st_atime, st.st_size, objectFile))
+        objects.sort()
+
+        self._size = sum([size for atime, size, objectFile in objects])
+        nremoved = 0
+        for atime, size, objectFile in objects:
+            if self._size <= maxSize:
+                break
+            self._remove(objectFile)
+            self._size -= size
+            nremoved += 1
+
+        if nremoved:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.cacheDir, "entries")):
+                for f in filenames:
+                    entryFile = os.path.join(dirpath, f)
+                    try:
+                        fd = open(entryFile, "rb")
+                        try:
+                            entry = pickle.load(fd)
+                        finally:
+                            fd.close()
+                        if os.path.exists(self._objectFile(entry["checksum"])):
+                            continue
+                    except Exception:
+                        pass
+                    self._remove(entryFile)
+
+        return nremoved
+
+    def clear(self):
+        """remove everything from the cache"""
+        if os.path.exists(self.cacheDir):
+            shutil.rmtree(self.cacheDir)
+        self._size = 0
+
+    def _remove(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+def linkFile(src, dest):
+    """make dest a copy of src, as a hard link if possible
+    @param src       the file to copy
+    @param dest      the name of the copy
+    """
+    if os.path.exists(dest):
+        if os.path.samefile(src, dest):
+            return
+        os.unlink(dest)
+
+    try:
+        os.link(src, dest)
+    except (OSError, AttributeError):    # e.g. a different filesystem
+        shutil.copy(src, dest)
+
 def makeTempFile(prefix):
     (fd, filename) = tempfile.mkstemp("", prefix, utils.createTempDir("distrib"))
     os.close(fd);
     atexit.register(os.unlink, filename)
     return filename
 
+def prefetch(fetches, nthread=4, verbosity=0, log=sys.stderr):
+    """call a set of functions that retrieve files, nthread at a time.  This
+    is used to download files before they are needed (the functions are
+    expected to leave them in DistribServer's file cache), so failures are
+    reported but otherwise ignored; the files will be retrieved again when
+    they are needed.
+    @param fetches     a list of (function, args) tuples
+    @param nthread     the number of functions to run at once
+    @param verbosity   if > 0, report failures
+    @param log         the destination for status messages
+    """
+    fetches = list(fetches)
+
+    def worker():
+        while True:
+            try:
+                func, args = fetches.pop(0)
+            except IndexError:
+                return
+
+            try:
+                func(*args)
+            except Exception as e:
+                if verbosity > 0:
+                    print("Unable to prefetch %s: %s" % (" ".join([str(a) for a in args]), e), file=log)
+
+    threads = []
+    for i in range(min(nthread, len(fetches))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True            # don't wait for them after a ^C
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)            # a plain join() would block ^C
+
 def importClass(classname):
     """import and return the constructor for the given class name.
     @param classname    the full module classname to import
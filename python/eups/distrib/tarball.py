@@ -170,6 +170,13 @@ DIST_URL = %s
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, location))
 
+    def prefetchPackage(self, location, product, version):
+        """Retrieve the tarball that installPackage() will need into the
+        server's file cache
+        """
+        self.distServer.getFileForProduct(location, product, version, self.Eups.flavor,
+                                          ftype="dist")
+
     def installPackage(self, location, product, version, productRoot,
                        installDir=None, setups=None, buildDir=None):
         """Install a package with a given server location into a given
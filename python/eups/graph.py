@@ -0,0 +1,240 @@
+"""
+A directed graph whose nodes are stored in integer-indexed tables, with
+iterative (i.e. non-recursive) algorithms to find its strongly connected
+components and to sort it topologically.  Used by utils.topologicalSort()
+and the DependencyGraph.
+"""
+from __future__ import absolute_import, print_function
+
+from . import utils
+
+class Graph(object):
+    """
+    A directed graph.  Each node is given an integer index when it's added,
+    and the edges are stored as lists of indices, so the nodes (typically
+    Products) only need to be hashed once, however many edges they have.
+
+    The graph may be built from a dictionary mapping each node to its
+    successors (e.g. the products that it depends on); successors that
+    aren't keys are added as nodes with no successors.
+    """
+
+    def __init__(self, graph=None):
+        """
+        @param graph    a dictionary mapping nodes to lists (or sets) of successor nodes
+        """
+        self.nodes = []                 # the nodes, indexed by their indices
+        self.index = {}                 # the index of each node
+        self.successors = []            # the indices of each node's successors
+
+        if graph:
+            for node in graph:
+                self.addNode(node)
+            for node, successors in graph.items():
+                self.addEdges(node, successors)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def addNode(self, node):
+        """
+        Add a node to the graph (if it isn't already present) and return its index
+        """
+        try:
+            return self.index[node]
+        except KeyError:
+            i = self.index[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.successors.append([])
+            return i
+
+    def addEdges(self, node, successors):
+        """
+        Add edges from node to each of successors, adding the nodes as needed.
+        Duplicate edges are ignored.
+        """
+        i = self.addNode(node)
+        succ = self.successors[i]
+        known = set(succ)
+        for s in successors:
+            j = self.addNode(s)
+            if j not in known:
+                known.add(j)
+                succ.append(j)
+
+    def addEdge(self, node, successor):
+        """Add an edge from node to successor"""
+        self.addEdges(node, [successor])
+
+    def stronglyConnectedComponents(self):
+        """
+        Return the strongly connected components of the graph as a list of
+        lists of node indices, using an iterative version of Tarjan's
+        algorithm.  Each component is listed after all the components that
+        it can reach, so the list is in reverse topological order.
+        """
+        successors = self.successors
+        nnode = len(successors)
+        unvisited = -1
+        order = [unvisited]*nnode       # the order in which each node was visited
+        low = [0]*nnode                 # the lowest order reachable from each node
+        onStack = [False]*nnode
+
+        components = []
+        stack = []                      # the nodes whose components are unknown
+        counter = 0
+        for root in range(nnode):
+            if order[root] != unvisited:
+                continue
+
+            order[root] = low[root] = counter; counter += 1
+            stack.append(root); onStack[root] = True
+            work = [(root, 0)]          # (node, index of next successor to visit)
+            while work:
+                v, i = work[-1]
+                succ = successors[v]
+                while i < len(succ):
+                    w = succ[i]; i += 1
+                    if order[w] == unvisited:
+                        work[-1] = (v, i)
+                        order[w] = low[w] = counter; counter += 1
+                        stack.append(w); onStack[w] = True
+                        work.append((w, 0))
+                        break
+                    elif onStack[w] and order[w] < low[v]:
+                        low[v] = order[w]
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        if low[v] < low[u]:
+                            low[u] = low[v]
+
+                    if low[v] == order[v]:
+                        pos = len(stack) - 1
+                        while stack[pos] != v:
+                            pos -= 1
+                        component = stack[pos:]
+                        del stack[pos:]
+                        for w in component:
+                            onStack[w] = False
+                        components.append(component)
+
+        return components
+
+    def cycles(self, components=None):
+        """
+        Return the cycles in the graph, as a list of lists of nodes
+
+        @param components   The graph's strongly connected components, if already known
+        """
+        if components is None:
+            components = self.stronglyConnectedComponents()
+
+        return [[self.nodes[i] for i in c] for c in components if len(c) > 1]
+
+    def layers(self, components=None):
+        """
+        Sort the graph topologically, returning a list of layers each of
+        which is a list of node indices.  The first layer contains the nodes
+        with no successors, and each later layer contains the nodes whose
+        successors all lie in earlier layers; the nodes in a layer are thus
+        independent of each other, and may (e.g.) be built concurrently.
+
+        The members of a cycle are placed together in the same layer.
+
+        @param components   The graph's strongly connected components, if already known
+        """
+        if components is None:
+            components = self.stronglyConnectedComponents()
+        #
+        # The components are in reverse topological order, so we can find the
+        # depth of each in a single pass
+        #
+        component = [0]*len(self.nodes) # the component each node belongs to
+        for ic, c in enumerate(components):
+            for i in c:
+                component[i] = ic
+
+        successors = self.successors
+        depth = [0]*len(components)
+        layers = []
+        for ic, c in enumerate(components):
+            d = 0
+            for i in c:
+                for j in successors[i]:
+                    jc = component[j]
+                    if jc != ic and depth[jc] >= d:
+                        d = depth[jc] + 1
+            depth[ic] = d
+
+            if d == len(layers):
+                layers.append([])
+            layers[d] += c
+
+        return layers
+
+    def topologicalLayers(self, verbose=False, checkCycles=False):
+        """
+        Return the nodes sorted topologically, as a list of layers each of
+        which is a list of nodes; see layers()
+
+        @param verbose      Report any cycles to stdwarn
+        @param checkCycles  Raise RuntimeError if there are any cycles
+        """
+        components = self.stronglyConnectedComponents()
+
+        cycles = self.cycles(components)
+        if cycles:
+            msg = "(%s)" % "), (".join([", ".join([_nameVersion(p) for p in c]) for c in cycles])
+            if verbose:
+                print("Detected cycle%s: %s" % ("s" if len(cycles) > 1 else "", msg), file=utils.stdwarn)
+            if checkCycles:
+                raise RuntimeError(msg)
+
+        nodes = self.nodes
+        return [[nodes[i] for i in layer] for layer in self.layers(components)]
+
+def _nameVersion(p):
+    """Return "[name version]" if p is a Product, otherwise str(p)"""
+    try:
+        return "[%s %s]" % (p.name, p.version)
+    except AttributeError:
+        return str(p)
+
+if __name__ == "__main__":
+    #
+    # A micro-benchmark:  sort synthetic 10000-node graphs (run as "python -m eups.graph [nnode]")
+    #
+    import random
+    import sys
+    import time
+
+    def timeit(what, func, *args):
+        t0 = time.time()
+        result = func(*args)
+        print("%-45s %8.3fs" % (what, time.time() - t0))
+        return result
+
+    nnode = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(666)
+
+    wide = {}                           # a random DAG with a few cycles
+    for i in range(nnode):
+        wide[i] = set(random.sample(range(i), min(i, 5)))
+    for i in range(0, nnode, 1000):
+        wide[i].add(min(i + 10, nnode - 1))
+
+    deep = dict((i, [i + 1]) for i in range(nnode - 1)) # a single chain
+    deep[nnode - 1] = []
+
+    for name, data in [("random", wide), ("chain", deep)]:
+        g = timeit("%d-node %s graph: build" % (nnode, name), Graph, data)
+        comps = timeit("%d-node %s graph: components" % (nnode, name), g.stronglyConnectedComponents)
+        layers = timeit("%d-node %s graph: layers" % (nnode, name), g.layers, comps)
+        timeit("%d-node %s graph: utils.topologicalSort" % (nnode, name),
+               lambda: list(utils.topologicalSort(dict(data))))
+        print("  %d components, %d layers" % (len(comps), len(layers)))
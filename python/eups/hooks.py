@@ -34,7 +34,7 @@ def defineProperties(names, parentName=None):
 
 # various configuration properties settable by the user
 config = defineProperties("Eups distrib site user")
-config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize", "Eups")
+config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize cacheTables cacheSetups", "Eups")
 config.Eups.setType("verbose", int)
 
 config.Eups.userTags = []
@@ -71,6 +71,16 @@ config.Eups.defaultProduct = {"name" : "implicitProducts", "version" : None, "ta
 
 config.Eups.colorize = False
 #
+# Cache parsed table files in the user's data directory (see table.tableCacheFile())
+#
+config.Eups.cacheTables = True
+#
+# Save the outcome of each setup in the user's data directory, and replay it when the same setup is
+# repeated and nothing that it depends on has changed (see SetupCache).  If "verify", carry out the
+# setup anyway and report any differences from the saved outcome
+#
+config.Eups.cacheSetups = False
+#
 # Configure things that apply to the entire site
 #
 config.site = defineProperties("lockDirectoryBase", "site")
@@ -83,6 +93,16 @@ config.site.lockDirectoryBase = _defaultLockDirectoryBase
 # name.
 config.distrib = {}
 config.distrib["builder"] = dict(variables = {})
+#
+# The number of packages listed in a manifest to download at once before installing
+# any of them (0: don't download them ahead of time)
+#
+config.distrib["prefetch"] = 4
+#
+# The maximum total size, in bytes, of the files downloaded by earlier "eups distrib"
+# commands that are kept in the user's data directory (0: don't keep them)
+#
+config.distrib["downloadCacheSize"] = 2*1024**3
 
 config.Eups.startupFileName = "startup.py"
 
@@ -20,6 +20,7 @@ from .cmd import EupsOptionParser
 from .exceptions import EupsException
 import eups
 from . import lock
+from . import table
 from . import hooks
 from . import utils
 
@@ -142,6 +143,9 @@ product and all its dependencies into the environment so that it can be used.
                             help="Print extra messages about progress (repeat for ever more chat)")
         self.clo.add_option("-V", "--version", dest="version", action="store_true", default=False,
                             help="Print eups version number")
+        self.clo.add_option("--verify-cache", dest="verifyCache", action="store_true", default=False,
+                            help="Carry out the setup even if it was saved in the setup cache, " +
+                            "and report any differences")
         self.clo.add_option("--vro", dest="vro", action="store", metavar="LIST",
                             help="Set the Version Resolution Order")
 
@@ -231,7 +235,7 @@ product and all its dependencies into the environment so that it can be used.
             try:
                 Eups = eups.Eups(flavor=self.opts.flavor, path=self.opts.path,
                                  dbz=self.opts.dbz, # root=self.opts.productDir,
-                                 readCache=False, force=self.opts.force,
+                                 readCache="readonly", force=self.opts.force,
                                  quiet=self.opts.quiet, verbose=self.opts.verbose,
                                  noaction=self.opts.noaction, keep=self.opts.keep,
                                  ignore_versions=self.opts.ignoreVer, setupType=self.opts.setupType,
@@ -239,6 +243,8 @@ product and all its dependencies into the environment so that it can be used.
                                  exact_version=self.opts.exact_version, cmdName="setup")
 
                 Eups._processDefaultTags(self.opts)
+                if self.opts.verifyCache:
+                    Eups.cacheSetups = "verify"
 
                 if not self.opts.noCallbacks:
                     try:
@@ -288,6 +294,8 @@ product and all its dependencies into the environment so that it can be used.
         finally:
             lock.giveLocks(locks, self.opts.verbose)
 
+        if Eups.verbose > 0:
+            print("Table cache: %(hits)d hits, %(misses)d misses" % table.tableCacheStats, file=utils.stdinfo)
         if Eups.verbose > 3:
             print("\n\t".join(["Issuing commands:"] + cmds), file=sys.stderr)
 
@@ -2,15 +2,28 @@ import os
 from eups import utils
 from eups.Product import Product
 import eups.tags
+from eups import hooks
 from eups.exceptions import ProductNotFound, TableFileNotFound
 from eups.table import Table
+from eups.VersionCompare import VersionCompare, sortArgs, keysAgree
 
 class ProductFamily(object):
     """
     a set of different versions of a named product.  When this refers to
     installed products, it is assumed that all versions are of the same flavor.
+
+    The version names are also kept in version order (as defined by
+    VersionCompare), so the latest version can be found without sorting
+    them.
     """
 
+    # the version names in version order, or None if they need sorting
+    # (families pickled before the order was maintained don't have it)
+    _sorted = None
+    # True iff _sorted was ordered using VersionCompare.key(), so versions
+    # can be inserted into it (see VersionCompare.keysAgree())
+    _keyed = False
+
     def __init__(self, name):
         """
         create a product family with a given product name
@@ -29,12 +42,71 @@ class ProductFamily(object):
         # value is the version name assigned to the tag.
         self.tags = {}
 
+        # the version names, sorted into version order
+        self._sorted = []
+        self._keyed = True
+
     def getVersions(self):
         """
         return a list containing the verison names in this product family
         """
         return list(self.versions.keys())
 
+    def _sortedVersions(self):
+        if self._sorted is None or len(self._sorted) != len(self.versions):
+            vc = _versionCompare()
+            vers = list(self.versions.keys())
+            self._keyed = keysAgree(vc, vers)
+            self._sorted = sorted(vers, **sortArgs(vc, vers))
+        return self._sorted
+
+    def getSortedVersions(self, version_cmp=None):
+        """
+        return a list of the version names in this product family, sorted
+        into version order (oldest first)
+
+        @param version_cmp   the function to order the versions (e.g.
+                               hooks.version_cmp).  If None, or a
+                               VersionCompare, the maintained order is used.
+        """
+        if version_cmp is None or \
+               (isinstance(version_cmp, VersionCompare) and version_cmp.hasKey()):
+            return list(self._sortedVersions())
+
+        vers = list(self.versions.keys())
+        return sorted(vers, **sortArgs(version_cmp, vers))
+
+    def getLatestVersion(self, version_cmp=None, match=None):
+        """
+        return the name of the latest version in this product family, or None
+        if there are no (matching) versions.
+
+        @param version_cmp   the function to order the versions; see getSortedVersions()
+        @param match         if not None, a function that's passed a version name
+                               and returns True if the version is acceptable;
+                               the versions are tried newest first, and
+                               the rest aren't considered.
+        """
+        if version_cmp is None or \
+               (isinstance(version_cmp, VersionCompare) and version_cmp.hasKey()):
+            vers = self._sortedVersions()
+            if self._keyed or match is None:
+                for v in reversed(vers):
+                    if match is None or match(v):
+                        return v
+
+                return None
+
+            version_cmp = _versionCompare()
+        #
+        # The order mayn't be consistent, so sort just the acceptable versions
+        #
+        vers = [v for v in self.versions.keys() if match is None or match(v)]
+        if not vers:
+            return None
+
+        return sorted(vers, **sortArgs(version_cmp, vers))[-1]
+
     def getProduct(self, version, dbpath=None, flavor=None):
         """
         return the Product of the requested version or None if not found.
@@ -137,6 +209,13 @@ class ProductFamily(object):
             msg = "Missing version name while registering new version " + \
                 "for product %s: %s"
             raise RuntimeError(msg % (self.name, version))
+
+        if version not in self.versions and self._sorted is not None:
+            vc = _versionCompare()
+            if self._keyed and keysAgree(vc, [version]):
+                _insort(self._sorted, version, vc.key)
+            else:
+                self._sorted = None
         self.versions[version] = (installdir, tablefile, table)
 
     def hasVersion(self, version):
@@ -156,10 +235,15 @@ class ProductFamily(object):
         @return bool :
         """
         if self.hasVersion(version):
-            itsTags = [y[0] for y in [x for x in self.versions.items() if x[1] == version]]
+            itsTags = [tag for tag, v in self.tags.items() if v == version]
             for tag in itsTags:
                 self.unassignTag(tag)
             del self.versions[version]
+            if self._sorted is not None:
+                if self._keyed and version in self._sorted:
+                    self._sorted.remove(version)
+                else:           # the order may depend on which versions are present
+                    self._sorted = None
             return True
         else:
             return False
@@ -226,3 +310,29 @@ class ProductFamily(object):
         for ver in self.getVersions():
             self.loadTableFor(ver)
 
+
+_defaultVersionCompare = VersionCompare()
+
+def _versionCompare():
+    """
+    return the VersionCompare used to keep versions in order; the user's
+    version_cmp is used if it's a VersionCompare, so its keys are shared
+    """
+    vc = hooks.version_cmp
+    if not (isinstance(vc, VersionCompare) and vc.hasKey()):
+        vc = _defaultVersionCompare
+    return vc
+
+def _insort(vers, version, key):
+    """
+    insert version into the sorted list vers, after any equal versions
+    """
+    k = key(version)
+    lo, hi = 0, len(vers)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if k < key(vers[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    vers.insert(lo, version)
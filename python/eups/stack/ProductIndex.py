@@ -0,0 +1,281 @@
+from __future__ import absolute_import
+import mmap
+import os
+import struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from eups import utils
+
+class ProductIndex(MutableMapping):
+    """
+    a lookup of ProductFamily instances by product name that is backed by a
+    memory-mapped cache file.  Records are only decoded when the product is
+    actually looked up, so loading a cache costs little more than opening the
+    file no matter how many products are in the stack.
+
+    The file (written by ProductIndex.write()) is laid out as follows (all
+    integers are big-endian):
+       * a header:  the 8-byte magic string "EUPSIDX1" and the number of
+                    products as a 4-byte integer
+       * an offset table:  one fixed-size entry per product, sorted by product
+                    name, giving the offset and length of the name and
+                    the offset and length of the product's record
+       * the product names, encoded as UTF-8
+       * the records:  each a ProductFamily pickled on its own.
+
+    Products can be added, replaced, and removed as with a dictionary; these
+    changes are held in memory until the lookup is written out again, at
+    which time the records of products that were never decoded are copied
+    over without decoding them.
+
+    Changes to a few products may instead be appended to a delta file kept
+    alongside the index (see appendDelta()), and replayed when the index is
+    next opened (see replayDelta()), so that they needn't cost a rewrite of
+    the whole index.  A delta file is a sequence of pickles:  a header
+    identifying the index file that it applies to, followed by one record
+    per change giving a product name and its new ProductFamily (or None if
+    the product was removed).
+    """
+
+    # static variable: the string identifying the file format
+    magic = b"EUPSIDX1"
+
+    _header = struct.Struct("!8sI")
+    _entry = struct.Struct("!QIQQ")     # name offset, name length, record offset, record length
+
+    # static variable: the string identifying the delta file format
+    deltaMagic = "EUPSDELTA1"
+
+    def __init__(self, file):
+        """
+        open the index in a given file
+        @param file   the path to the cache file
+        @throws ValueError  if the file is not a product index
+        """
+        self.file = file
+
+        fd = open(file, "rb")
+        try:
+            # identifies this version of the file to its delta file
+            self.token = ProductIndex._token(os.fstat(fd.fileno()))
+            try:
+                self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # e.g. a filesystem that doesn't support mapping; the mapping
+                # stays valid after the file is closed (or replaced)
+                self._data = fd.read()
+        finally:
+            fd.close()
+
+        if len(self._data) < self._header.size:
+            raise ValueError("%s: not a product index file" % file)
+        magic, self._count = self._header.unpack_from(self._data, 0)
+        if magic != self.magic:
+            raise ValueError("%s: not a product index file" % file)
+
+        # the ProductFamilys that have been decoded or set, by product name
+        self._families = {}
+
+        # the names of products in the file that have since been removed
+        self._removed = set()
+
+        # the names of all products in the file, once needed
+        self._names = None
+
+    def _name(self, i):
+        noff, nlen = self._entry.unpack_from(self._data, self._header.size + i*self._entry.size)[:2]
+        return self._data[noff:noff+nlen].decode("utf-8")
+
+    def _find(self, name):
+        # binary search of the offset table; return the entry index or None
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mname = self._name(mid)
+            if mname < name:
+                lo = mid + 1
+            elif mname > name:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _record(self, name):
+        # return the undecoded record for a product or None if not in the file
+        if name in self._removed:
+            return None
+        i = self._find(name)
+        if i is None:
+            return None
+        roff, rlen = self._entry.unpack_from(self._data, self._header.size + i*self._entry.size)[2:]
+        return self._data[roff:roff+rlen]
+
+    def _fileNames(self):
+        if self._names is None:
+            self._names = [self._name(i) for i in utils.xrange(self._count)]
+        return self._names
+
+    def __getitem__(self, name):
+        try:
+            return self._families[name]
+        except KeyError:
+            pass
+
+        rec = self._record(name)
+        if rec is None:
+            raise KeyError(name)
+        self._families[name] = pickle.loads(rec)
+        return self._families[name]
+
+    def __setitem__(self, name, family):
+        self._families[name] = family
+        self._removed.discard(name)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._families.pop(name, None)
+        if self._find(name) is not None:
+            self._removed.add(name)
+
+    def __contains__(self, name):
+        if name in self._families:
+            return True
+        return name not in self._removed and self._find(name) is not None
+
+    def __iter__(self):
+        for name in self._fileNames():
+            if name not in self._removed and name not in self._families:
+                yield name
+        for name in list(self._families.keys()):
+            yield name
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def decodedCount(self):
+        """
+        return the number of products whose records have been decoded (or
+        set) since the file was opened
+        """
+        return len(self._families)
+
+    def replayDelta(self, deltaFile):
+        """
+        apply the changes recorded in a delta file (see appendDelta()) to
+        this lookup, returning the size of the file and the number of changes
+        that were applied.  None is returned if the delta file is unusable
+        (e.g. it was written for an earlier version of the index, or ends with
+        an incomplete record); the index should then be rewritten, which makes
+        the delta file redundant.
+        @param deltaFile   the path to the delta file
+        """
+        try:
+            fd = open(deltaFile, "rb")
+        except IOError:
+            return (0, 0)               # no changes since the index was written
+
+        nchange = 0
+        try:
+            try:
+                magic, token = pickle.load(fd)
+                if magic != self.deltaMagic or token != self.token:
+                    return None
+
+                size = os.fstat(fd.fileno()).st_size
+                while fd.tell() < size:
+                    name, family = pickle.load(fd)
+                    if family is None:
+                        if name in self:
+                            del self[name]
+                    else:
+                        self[name] = family
+                    nchange += 1
+            except Exception:
+                return None             # e.g. EOFError from a partly written record
+            return (fd.tell(), nchange)
+        finally:
+            fd.close()
+
+    # @staticmethod   # requires python 2.4
+    def appendDelta(deltaFile, file, changes):
+        """
+        append changes to the delta file for an index, returning the new size
+        of the delta file.  It's up to the caller to ensure that the delta
+        file (if any) applies to the current version of the index.
+        @param deltaFile   the path to the delta file
+        @param file        the path to the index file the changes apply to
+        @param changes     a list of (product name, ProductFamily) pairs; the
+                              family is None if the product was removed
+        """
+        data = []
+        if not os.path.exists(deltaFile) or os.stat(deltaFile).st_size == 0:
+            token = ProductIndex._token(os.stat(file))
+            data.append(pickle.dumps((ProductIndex.deltaMagic, token), protocol=2))
+        for name, family in changes:
+            data.append(pickle.dumps((name, family), protocol=2))
+
+        # a single write, so that readers see few (if any) partial records
+        fd = open(deltaFile, "ab")
+        try:
+            fd.write(b"".join(data))
+            fd.flush()
+            return fd.tell()
+        finally:
+            fd.close()
+    appendDelta = staticmethod(appendDelta)    # works since python2.2
+
+    # @staticmethod   # requires python 2.4
+    def _token(st):
+        return (st.st_ino, st.st_size, st.st_mtime)
+    _token = staticmethod(_token)
+
+    # @staticmethod   # requires python 2.4
+    def write(file, lookup):
+        """
+        write a lookup of ProductFamily instances by product name to a file
+        in the product index format.  The file is replaced atomically.
+        @param file     the path to the file to write
+        @param lookup   a dictionary (or ProductIndex) of ProductFamily
+                           instances keyed by product name
+        """
+        names = sorted(lookup.keys())
+        encoded = [n.encode("utf-8") for n in names]
+
+        records = []
+        for name in names:
+            rec = None
+            if isinstance(lookup, ProductIndex) and name not in lookup._families:
+                rec = lookup._record(name)
+            if rec is None:
+                rec = pickle.dumps(lookup[name], protocol=2)
+            records.append(rec)
+
+        # lay out the name and record regions after the offset table
+        offset = ProductIndex._header.size + len(names)*ProductIndex._entry.size
+        nameOffsets = []
+        for n in encoded:
+            nameOffsets.append(offset)
+            offset += len(n)
+        recOffsets = []
+        for rec in records:
+            recOffsets.append(offset)
+            offset += len(rec)
+
+        fd = utils.AtomicFile(file, "wb")
+        fd.write(ProductIndex._header.pack(ProductIndex.magic, len(names)))
+        for i in utils.xrange(len(names)):
+            fd.write(ProductIndex._entry.pack(nameOffsets[i], len(encoded[i]),
+                                              recOffsets[i], len(records[i])))
+        for n in encoded:
+            fd.write(n)
+        for rec in records:
+            fd.write(rec)
+        fd.close()
+    write = staticmethod(write)    # works since python2.2
@@ -1,12 +1,15 @@
 from __future__ import absolute_import, print_function
-import re, os, sys
+import re, os, sys, time
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 from eups import utils
 from eups import Product
+from eups import hooks
+from eups.VersionCompare import sortArgs
 from .ProductFamily import ProductFamily
+from .ProductIndex import ProductIndex
 from eups.exceptions import EupsException,ProductNotFound, UnderSpecifiedProduct
 from eups.db import Database
 from ..utils import xrange
@@ -16,7 +19,11 @@ from ..utils import xrange
 
 # the version name for the persistence format used by this implementation.
 # It is intended to match the version of EUPS when this format was introduced
-persistVersionName = "1.3.0"
+persistVersionName = "2.2.0"
+
+# the version name of the older (pickled dictionary) persistence format,
+# which is still read if no cache in the current format is available
+legacyPersistVersionName = "1.3.0"
 
 # the prefix to a tag name that labels it as a user tag.  Anything left over is
 # considered a global tag.
@@ -25,6 +32,11 @@ userPrefix = "user:"
 dotre = re.compile(r'\.')
 who = utils.getUserName()
 
+# ProductStacks kept loaded by a long-lived process (see eups.daemon) for
+# reuse by fromCache(), keyed by its arguments; None unless enabled by
+# ProductStack.keepWarm()
+_warmStacks = None
+
 class ProductStack(object):
     """
     a lookup for products installed into a software "stack" managed by
@@ -45,19 +57,50 @@ class ProductStack(object):
 
     Note that this class does not keep track of what are considered allowed
     tag names.  The user of this class should manage this.
+
+    The product data for each flavor is cached in a ProductIndex file which
+    is memory-mapped when reloaded, so that only the products that are
+    actually looked up get decoded.  Caches in the older format (a pickled
+    dictionary of all products) are still read when no ProductIndex cache
+    is available, but are never written.
+
+    When only a few products have changed since a cache was read (e.g. after
+    a declare), save() appends them to a delta file next to the cache rather
+    than rewriting it, so the cost of an update doesn't depend on the size of
+    the stack; the deltas are replayed when the cache is reloaded.  Once a
+    delta file holds more than maxDeltaRecords changes, it is compacted into
+    the cache.
     """
     # static variable: version of Product stack cache, set to the EUPS
     # version when the format was introduced
     persistVersion = persistVersionName
 
     # static variable: name of file extension to use to persist data
-    persistFileExt = "pickleDB%s" % dotre.sub('_', persistVersionName)
+    persistFileExt = "indexDB%s" % dotre.sub('_', persistVersionName)
 
     # static variable: regexp for cache file names
     persistFileRe = re.compile(r'^(\w\S*)\.%s$' % persistFileExt)
 
+    # static variable: name of file extension of caches in the legacy format
+    legacyFileExt = "pickleDB%s" % dotre.sub('_', legacyPersistVersionName)
+
+    # static variable: regexp for legacy cache file names
+    legacyFileRe = re.compile(r'^(\w\S*)\.%s$' % legacyFileExt)
+
+    # static variable: name of file extension to use to record the database
+    # generations a persisted cache reflects
+    generationFileExt = "generation"
+
+    # static variable: name of file extension to use for the changes made
+    # since a cache was written
+    deltaFileExt = "delta"
+
+    # static variable: the number of changes that may be appended to a cache's
+    # delta file before the cache is rewritten
+    maxDeltaRecords = 200
+
     # static variable: name of file extension to use to persist data
-    userTagFileExt = "pickleTag%s" % dotre.sub('_', persistVersionName)
+    userTagFileExt = "pickleTag%s" % dotre.sub('_', legacyPersistVersionName)
 
     def __init__(self, dbpath, persistDir=None, autosave=True):
         """
@@ -99,6 +142,17 @@ class ProductStack(object):
         # not save any new changes to it.
         self.modtimes = {}
 
+        # the size of the delta file for each cache file that was loaded (or
+        # written), and the number of changes it holds, as a lookup by cache
+        # file name.  None means the delta file can't be appended to, so the
+        # cache should be rewritten.
+        self.deltas = {}
+
+        # the names of the products that have changed in each updated
+        # flavor, as a lookup by flavor.  An updated flavor that's missing
+        # must be saved in full.
+        self.changed = {}
+
         # the directory to persist this data to when save is called.  If None,
         # a default path will be dbpath.
         self.persistDir = persistDir
@@ -119,6 +173,21 @@ class ProductStack(object):
         # True if python is new enough to pickle the cache data
         self.canCache = utils.canPickle()
 
+        # the generations of the database change journals (see
+        # Database.getGeneration()) that the loaded product data reflects,
+        # as a lookup by database directory.  None means no data has been
+        # loaded; a directory that is missing had no journal.
+        self.generations = None
+
+        # if true, this stack is a view of a cache that must not be saved
+        # (see fromCacheReadOnly())
+        self.readOnly = False
+
+        # the names of products that may have changed since the cache was
+        # written, and so should be looked up in the database (read-only
+        # stacks only)
+        self.stale = set()
+
 
     def getDbPath(self):
         """
@@ -169,6 +238,51 @@ class ProductStack(object):
         except KeyError:
           return []
 
+    def getSortedVersions(self, productName, flavor=None, version_cmp=None):
+        """
+        return the versions declared for a product, sorted into version order
+        (oldest first)
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search; if None, return for all
+                                flavors
+        @param version_cmp   the function to order the versions (e.g.
+                                hooks.version_cmp); see
+                                ProductFamily.getSortedVersions()
+        """
+        if flavor is None:
+            vers = self.getVersions(productName)
+            return sorted(vers, **sortArgs(version_cmp or hooks.version_cmp, vers))
+
+        try:
+            return self.lookup[flavor][productName].getSortedVersions(version_cmp)
+        except KeyError:
+            return []
+
+    def getLatestVersion(self, productName, flavor, version_cmp=None, match=None):
+        """
+        return the latest version of a product declared for a flavor, or None
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search; if None, search all flavors
+        @param version_cmp   the function to order the versions; see
+                                ProductFamily.getSortedVersions()
+        @param match         if not None, a function that returns True if a
+                                version is acceptable; see
+                                ProductFamily.getLatestVersion()
+        """
+        if flavor is None:
+            vers = self.getVersions(productName)
+            if match is not None:
+                vers = [v for v in vers if match(v)]
+            if not vers:
+                return None
+
+            return sorted(vers, **sortArgs(version_cmp or hooks.version_cmp, vers))[-1]
+
+        try:
+            return self.lookup[flavor][productName].getLatestVersion(version_cmp, match)
+        except KeyError:
+            return None
+
     def hasProduct(self, name, flavor=None, version=None):
         """
         return true if a desired product is registered.
@@ -228,6 +342,8 @@ class ProductStack(object):
                            None, save all flavors that appear to need updating
         @param file     the file to save it to.
         """
+        if self.readOnly:
+            return
         if flavors is None:
             if not self.updated: return
             return self.save(self.updated)
@@ -242,16 +358,28 @@ class ProductStack(object):
                 outofsync.append(file)
                 continue
 
-            self.persist(flavor, file)
+            changed = self.changed.get(flavor)
+            delta = self.deltas.get(file)
+            if changed is not None and delta is not None and flavor in self.updated and \
+                   delta[1] + len(changed) <= self.maxDeltaRecords:
+                self._appendDelta(flavor, file, changed)
+            else:
+                self.persist(flavor, file)
             if dir is None:
                 self.updated = [x for x in self.updated if x != flavor]
+                self.changed.pop(flavor, None)
 
         if len(outofsync) > 0:
             raise CacheOutOfSync(outofsync)
 
     def _cacheFileIsInSync(self, file):
-        return (file not in self.modtimes or
-                os.stat(file).st_mtime <= self.modtimes[file])
+        if file not in self.modtimes:
+            return True
+        if os.stat(file).st_mtime > self.modtimes[file]:
+            return False
+        # has anyone else appended to the cache's delta file?
+        delta = self.deltas.get(file)
+        return delta is None or self._deltaSize(file) == delta[0]
 
     def cacheIsInSync(self, flavors=None):
         """
@@ -298,11 +426,135 @@ class ProductStack(object):
             self.lookup[flavor] = {}
         flavorData = self.lookup[flavor]
 
-        fd = utils.AtomicFile(file, "wb")
-        pickle.dump(flavorData, fd, protocol=2)
-        fd.close()
+        ProductIndex.write(file, flavorData)
         self.modtimes[file] = os.stat(file).st_mtime
 
+        # the delta file no longer applies to the cache (and will be ignored
+        # if read before it's removed)
+        deltaFile = self._deltaPath(file)
+        if os.path.exists(deltaFile):
+            os.remove(deltaFile)
+        self.deltas[file] = (0, 0)
+
+        self._writeGenerations(file)
+
+    def _appendDelta(self, flavor, file, productNames):
+        """
+        append the current state of the given products of a flavor to the
+        delta file of a cache file that is known to be in sync
+        """
+        flavorData = self.lookup[flavor]
+        changes = [(name, flavorData.get(name)) for name in sorted(productNames)]
+        size = ProductIndex.appendDelta(self._deltaPath(file), file, changes)
+        self.deltas[file] = (size, self.deltas[file][1] + len(changes))
+
+        self._writeGenerations(file)
+
+    def _writeGenerations(self, file):
+        # written after the cache so that it never claims more than the cache holds
+        genfile = self._generationPath(file)
+        if self.generations:
+            fd = utils.AtomicFile(genfile, "w")
+            for dir, gen in self.generations.items():
+                print("%d\t%s" % (gen, dir), file=fd)
+            fd.close()
+        elif os.path.exists(genfile):
+            os.remove(genfile)
+
+    def _deltaPath(self, cacheFile):
+        return "%s.%s" % (os.path.splitext(cacheFile)[0], self.deltaFileExt)
+
+    def _deltaSize(self, cacheFile):
+        try:
+            return os.stat(self._deltaPath(cacheFile)).st_size
+        except OSError:
+            return 0
+
+    def _legacyPersistPath(self, flavor, dir=None):
+        return os.path.join(self._persistDir(dir),
+                            "%s.%s" % (flavor, ProductStack.legacyFileExt))
+
+    def _cacheFile(self, flavor, dir=None):
+        # return the cache file to load a flavor from, or None if there is none
+        for file in [self._persistPath(flavor, dir), self._legacyPersistPath(flavor, dir)]:
+            if os.path.exists(file):
+                return file
+        return None
+
+    def _generationPath(self, cacheFile):
+        return "%s.%s" % (os.path.splitext(cacheFile)[0], self.generationFileExt)
+
+    def _readGenerations(self, cacheFile):
+        # return the database generations recorded for a cache file
+        gens = {}
+        try:
+            fd = open(self._generationPath(cacheFile))
+        except IOError:
+            return gens
+        try:
+            for line in fd:
+                gen, dir = line.rstrip("\n").split("\t", 1)
+                gens[dir] = int(gen)
+        except ValueError:
+            gens = {}
+        fd.close()
+        return gens
+
+    def _journalGenerations(self, userTagDir=None):
+        # return the current generations of the database and user tag journals
+        gens = {}
+        gen = Database(self.dbpath).getGeneration()
+        if gen is not None:
+            gens[self.dbpath] = gen
+        if userTagDir and userTagDir != self.dbpath:
+            # no journal here just means no user tags were ever assigned
+            gens[userTagDir] = Database(userTagDir).getGeneration() or 0
+        return gens
+
+    def _staleProducts(self, flavor, cacheDir, generations=None):
+        """
+        use the database change journals to determine which products may have
+        changed since the cache for a given flavor was written.  An empty set
+        means the cache is up-to-date; None means the journals can't tell
+        (e.g. the database has no journal, or the cache predates it).
+        @param generations  if provided, a dictionary that is updated with
+                              the generation each journal was read up to
+                              (keeping the lowest if a directory is already
+                              present); these are the generations the
+                              returned products account for.
+        """
+        cache = self._persistPath(flavor, cacheDir)
+        if not os.path.exists(cache):
+            return None         # legacy caches don't record generations
+        recorded = self._readGenerations(cache)
+        current = self._journalGenerations(cacheDir)
+        if self.dbpath not in current or self.dbpath not in recorded:
+            return None
+
+        stale = set()
+        seen = {}
+        for dir in current.keys():
+            if dir not in recorded:
+                return None
+            seen[dir] = recorded[dir]
+            if recorded[dir] == current[dir]:
+                continue
+
+            changes = Database(dir).getJournal(recorded[dir])
+            if changes is None:
+                return None
+            stale.update(c[2] for c in changes)
+            if changes:
+                seen[dir] = changes[-1][0]
+
+        if generations is not None:
+            for dir, gen in seen.items():
+                if dir in generations:
+                    gen = min(gen, generations[dir])
+                generations[dir] = gen
+
+        return stale
+
     def export(self):
         """
         return a hierarchical dictionary of all the Products in the stack,
@@ -386,19 +638,32 @@ class ProductStack(object):
         for tag in prod.tags:
             self.lookup[flavor][prod.name].assignTag(tag, prod.version)
 
-        self._flavorsUpdated(flavor)
+        self._flavorsUpdated(flavor, [prod.name])
         if self.autosave: self.save(flavor)
 
-    def _flavorsUpdated(self, flavors=None):
+    def _flavorsUpdated(self, flavors=None, productNames=None):
         # this function is called whenever the stack is updated to add
         # the updated flavors to self.updated.  The value of self.updated,
         # therefore, indicates which flavors need to updated to disk.
+        # If productNames is given, only those products changed, which
+        # is recorded in self.changed so that save() can append them to
+        # the cache's delta file.
         if flavors is None:
-            self.updated = self.getFlavors()
-        elif isinstance(flavors, list):
-            self.updated.extend(x for x in flavors if x not in self.updated)
-        elif flavors not in self.updated:
-            self.updated.append(flavors)
+            flavors = self.getFlavors()
+            self.updated = []
+        elif not isinstance(flavors, list):
+            flavors = [flavors]
+
+        for flavor in flavors:
+            if productNames is None:
+                self.changed.pop(flavor, None)
+            elif flavor not in self.updated:
+                self.changed[flavor] = set(productNames)
+            elif flavor in self.changed:
+                self.changed[flavor].update(productNames)
+
+            if flavor not in self.updated:
+                self.updated.append(flavor)
 
     def saveNeeded(self, flavors=None):
         """
@@ -443,7 +708,7 @@ class ProductStack(object):
                     self.lookup[flavor][product] = ProductFamily(product)
                 self.lookup[flavor][product].import_(products[flavor][product])
                 updated = True
-                self._flavorsUpdated(flavor)
+                self._flavorsUpdated(flavor, [product])
 
         if self.autosave and updated: self.save()
 
@@ -461,7 +726,7 @@ class ProductStack(object):
             if updated:
                 if len(self.lookup[flavor][name].getVersions()) == 0:
                     del self.lookup[flavor][name]
-                self._flavorsUpdated(flavor)
+                self._flavorsUpdated(flavor, [name])
                 if self.autosave: self.save(flavor)
         except KeyError:
             return False
@@ -520,7 +785,7 @@ class ProductStack(object):
         if notfound:
             raise ProductNotFound(product, version, flavors, self.dbpath)
 
-        self._flavorsUpdated(flavors)
+        self._flavorsUpdated(flavors, [product])
         if self.autosave:
             self.save(flavors)
 
@@ -546,7 +811,7 @@ class ProductStack(object):
             try:
                 if (self.lookup[flavor][product].unassignTag(tag)):
                     updated = True
-                    self._flavorsUpdated(flavor)
+                    self._flavorsUpdated(flavor, [product])
             except KeyError:
                 pass
 
@@ -575,7 +840,7 @@ class ProductStack(object):
                 table = prod.getTable()
 
             self.lookup[flavor][productName].loadTableFor(version, table)
-            self._flavorsUpdated(flavor)
+            self._flavorsUpdated(flavor, [productName])
         except KeyError:
             raise ProductNotFound(productName, version, flavor)
 
@@ -616,16 +881,28 @@ class ProductStack(object):
         product database.  False is returned if the file does not exist
         or otherwise appears out-of-date.
 
+        If the database keeps a change journal, this only requires reading
+        the journals and the generations recorded with the cache; otherwise,
+        the modification time of every file in the database is checked.
+
         Note that this is different from cacheIsInSync()
         """
         if not cacheDir:
             cacheDir = self.dbpath
-        cache = self._persistPath(flavor, cacheDir)
-        if not os.path.exists(cache):
+        cache = self._cacheFile(flavor, cacheDir)
+        if not cache:
             return False
 
-        # get the modification time of the cache file
+        stale = self._staleProducts(flavor, cacheDir)
+        if stale is not None:
+            return not stale
+
+        # get the modification time of the cache file (or of its delta file,
+        # if it's been updated since it was written)
         cache_mtime = os.stat(cache).st_mtime
+        deltaFile = self._deltaPath(cache)
+        if os.path.exists(deltaFile):
+            cache_mtime = max(cache_mtime, os.stat(deltaFile).st_mtime)
 
         # check for user tag updates
         if cacheDir != self.dbpath and \
@@ -655,10 +932,14 @@ class ProductStack(object):
 
         for flavor in flavors:
             fileName = self._persistPath(flavor, cachedir)
-            if os.path.exists(fileName):
-                if verbose > 0:
-                    print("Deleting %s" % (fileName), file=sys.stderr)
-                os.remove(fileName)
+            for file in [fileName, self._legacyPersistPath(flavor, cachedir)]:
+                if os.path.exists(file):
+                    if verbose > 0:
+                        print("Deleting %s" % (file), file=sys.stderr)
+                    os.remove(file)
+            for file in [self._generationPath(fileName), self._deltaPath(fileName)]:
+                if os.path.exists(file):
+                    os.remove(file)
 
     def reload(self, flavors=None, persistDir=None, verbose=0):
         """
@@ -687,22 +968,47 @@ class ProductStack(object):
 
         for flavor in flavors:
             fileName = self._persistPath(flavor,persistDir)
+            legacy = not os.path.exists(fileName)
+            if legacy:
+                fileName = self._legacyPersistPath(flavor, persistDir)
+
+            # read before the cache, so a concurrent update can only make
+            # the data look older than it is
+            gens = {}
+            if not legacy:
+                gens = self._readGenerations(fileName)
+            if self.generations is None:
+                self.generations = gens
+            else:
+                self.generations = dict((d, min(g, gens[d]))
+                                        for d, g in self.generations.items() if d in gens)
+
             self.modtimes[fileName] = os.stat(fileName).st_mtime
-            fd = open(fileName, "rb")
-            lookup = pickle.load(fd)
-            fd.close()
+            if legacy:
+                fd = open(fileName, "rb")
+                lookup = pickle.load(fd)
+                fd.close()
+            else:
+                lookup = ProductIndex(fileName)
+                self.deltas[fileName] = lookup.replayDelta(self._deltaPath(fileName))
+                if verbose > 1 and self.deltas[fileName] is None:
+                    print("Ignoring unusable delta file for %s" % fileName, file=sys.stderr)
 
             self.lookup[flavor] = lookup
 
+            # any unsaved changes are lost
+            self.updated = [x for x in self.updated if x != flavor]
+            self.changed.pop(flavor, None)
+
     @staticmethod
     def findCachedFlavors(dir):
 
         flavors = []
         # list contents of directory
         for c in os.listdir(dir):
-            # match file against cache file pattern
-            b = ProductStack.persistFileRe.match(c)
-            if b:
+            # match file against cache file patterns
+            b = ProductStack.persistFileRe.match(c) or ProductStack.legacyFileRe.match(c)
+            if b and b.group(1) not in flavors:
                 # grab only cache files
                 flavors.append(b.group(1))
         return flavors
@@ -715,20 +1021,52 @@ class ProductStack(object):
         (otherwise, the stack may not have user tags in it).
         """
         db = Database(self.dbpath, userTagDir)
+        self.generations = self._journalGenerations(userTagDir)
 
-        # forget!
+        # forget!  (including the deltas, as the caches must now be rewritten)
         self.lookup = {}
+        self.deltas = {}
 
         for prodname in db.findProductNames():
             for product in db.findProducts(prodname):
                 self.addProduct(product)
 
+    def refreshProducts(self, productNames, flavors=None, userTagDir=None):
+        """
+        reload the information for the given products directly from the
+        database files on disk, leaving the other products as they are.
+        If userTagDir is provided, user tag assignments will be explicitly
+        loaded as well.
+        @param productNames   the names of the products to refresh
+        @param flavors        the flavors to refresh; if None, all flavors
+                                 currently loaded.
+        @param userTagDir     the directory where user tag data is persisted
+        """
+        if flavors is None:
+            flavors = self.getFlavors()
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        db = Database(self.dbpath, userTagDir)
+        for prodname in productNames:
+            for flavor in flavors:
+                if prodname in self.lookup.get(flavor, {}):
+                    del self.lookup[flavor][prodname]
+                    self._flavorsUpdated(flavor, [prodname])
+            if not os.path.isdir(os.path.join(self.dbpath, prodname)):
+                continue                # no longer declared
+            for product in db.findProducts(prodname, flavors=flavors):
+                self.addProduct(product)
+
     def _loadUserTags(self, userTagDir=None):
         if not userTagDir:
             userTagDir = self.persistDir
         if not userTagDir or not os.path.exists(userTagDir):
             return
 
+        if self.generations and userTagDir != self.dbpath:
+            self.generations[userTagDir] = Database(userTagDir).getGeneration() or 0
+
         db = Database(self.dbpath, userTagDir)
         prodnames = db.findProductNames()
         for pname in prodnames:
@@ -790,31 +1128,136 @@ class ProductStack(object):
         if not isinstance(flavors, list):
             flavors = [flavors]
 
+        warmKey = (dbpath, tuple(flavors), persistDir, userTagDir)
+        if _warmStacks is not None and warmKey in _warmStacks:
+            out, loaded = _warmStacks[warmKey]
+            if out._isCurrent(loaded, userTagDir):
+                out.autosave = autosave
+                return out
+        loaded = time.time()
+
         out = ProductStack(dbpath, persistDir, False)
 
         cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose)
+        patched = cacheOkay and out.saveNeeded()  # updated from the change journal?
         if not cacheOkay:
             cacheOkay = out._tryCache(dbpath, dbpath, flavors)
             if cacheOkay:
+                patched = out.saveNeeded()
                 out._loadUserTags(userTagDir)
 
         if not cacheOkay:
             out.refreshFromDatabase(userTagDir)
             out._flavorsUpdated(flavors)
             if updateCache:  out.save()
+        elif patched and updateCache:
+            out.save()
+
+        if _warmStacks is not None:
+            _warmStacks[warmKey] = (out, loaded)
 
         out.autosave = autosave
         return out
 
     fromCache = staticmethod(fromCache)    # works since python2.2
 
+    # @staticmethod   # requires python 2.4
+    def fromCacheReadOnly(dbpath, flavors, persistDir=None, userTagDir=None, verbose=0):
+        """
+        return a read-only ProductStack loaded from the caches for the given
+        flavors, or None if there are no caches that the database change
+        journals show to be current.  As with fromCache(), persistDir is
+        tried before dbpath.  Unlike fromCache(), the database itself is never
+        read and nothing is written: the names of products that have changed
+        since the caches were written are listed in the returned stack's
+        stale attribute, and should be looked up in the database instead.
+
+        @param dbpath       the full path to the database directory ("ups_db")
+        @param flavors      the desired flavors
+        @param persistDir   the directory to look for caches in before dbpath
+        @param userTagDir   the directory where user tag data is persisted
+        """
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        for cacheDir in [persistDir, dbpath]:
+            if not cacheDir or not os.path.isdir(cacheDir):
+                continue
+
+            out = ProductStack(dbpath, cacheDir, False)
+            stale = set()
+            for flavor in flavors:
+                changed = out._staleProducts(flavor, cacheDir)
+                if changed is None:
+                    break
+                stale.update(changed)
+            else:
+                out.reload(flavors, cacheDir, verbose=verbose)
+                if cacheDir == dbpath:
+                    out._loadUserTags(userTagDir)
+
+                if verbose > 1 and stale:
+                    print("%d product(s) have changed since the cache for %s in %s was written" %
+                          (len(stale), " ".join(flavors), dbpath), file=sys.stderr)
+
+                out.readOnly = True
+                out.stale = stale
+                return out
+
+        return None
+
+    fromCacheReadOnly = staticmethod(fromCacheReadOnly)
+
+    # @staticmethod   # requires python 2.4
+    def keepWarm(enable=True):
+        """
+        keep the ProductStacks returned by fromCache() in memory, and return
+        them again from later calls (with the same arguments) for as long as
+        they are up-to-date with their databases.  This is intended for
+        long-lived processes (see eups.daemon); note that the stacks are
+        shared by all callers.
+        @param enable   if False, stop keeping stacks and forget those kept
+        """
+        global _warmStacks
+        if not enable:
+            _warmStacks = None
+        elif _warmStacks is None:
+            _warmStacks = {}
+    keepWarm = staticmethod(keepWarm)
+
+    def _isCurrent(self, since, userTagDir=None):
+        """
+        return true if the database (and user tags) have not changed since
+        this stack was loaded at a given time.
+        """
+        current = self._journalGenerations(userTagDir)
+        if self.generations and self.generations.get(self.dbpath) is not None and \
+               self.dbpath in current:
+            for dir, gen in current.items():
+                if self.generations.get(dir) != gen:
+                    return False
+            return True
+
+        if userTagDir and userTagDir != self.dbpath and \
+           Database(userTagDir).isNewerThan(since):
+            return False
+        return not Database(self.dbpath).isNewerThan(since)
+
     def _tryCache(self, dbpath, cacheDir, flavors, verbose=0):
         if not cacheDir or not os.path.exists(cacheDir):
             return False
 
         cacheOkay = True
+        journaled = True                # validated by the change journals?
+        stale = set()                   # products changed since caching
+        gens = {}                       # the generations stale accounts for
         for flav in flavors:
-            if not self.cacheIsUpToDate(flav, cacheDir):
+            changed = self._staleProducts(flav, cacheDir, gens)
+            if changed is not None:
+                stale.update(changed)
+            elif self.cacheIsUpToDate(flav, cacheDir):
+                journaled = False
+            else:
                 cacheOkay = False
                 if verbose > 1:
                     print("Regenerating missing or out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
@@ -823,6 +1266,19 @@ class ProductStack(object):
         if cacheOkay:
             self.reload(flavors, cacheDir, verbose=verbose)
 
+            if journaled:
+                if stale:
+                    if verbose > 1:
+                        print("Updating %d product(s) in cache for %s in %s" %
+                              (len(stale), " ".join(flavors), dbpath), file=sys.stderr)
+                    self.refreshProducts(sorted(stale), flavors,
+                                         cacheDir if cacheDir != dbpath else None)
+                    self.generations = gens
+
+                # the journals account for every change, so there's no need
+                # to check the product list against the database
+                return cacheOkay
+
             # do a final consistency check; do we have the same products
             dbnames = Database(dbpath).findProductNames()
             dbnames.sort()
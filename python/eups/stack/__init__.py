@@ -8,6 +8,9 @@ The major classes are:
                        to speed up recreation of a stack instance later.
    ProductFamily   a collection of different versions of product (installed
                        for the same flavor).
+   ProductIndex    a lookup of ProductFamilys backed by a memory-mapped cache
+                       file that decodes products only as they are needed.
 """
 from .ProductFamily import ProductFamily
+from .ProductIndex import ProductIndex
 from .ProductStack import ProductStack, persistVersionName, CacheOutOfSync
@@ -7,6 +7,10 @@
 from __future__ import absolute_import, print_function
 import os
 import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import eups
 from .exceptions import BadTableContent, TableError, TableFileNotFound, ProductNotFound
@@ -15,9 +19,75 @@ from .VersionParser import VersionParser
 from . import utils
 from . import hooks
 
+# the version of the parsed-table cache's contents; change it whenever the
+# parsed form of a Table changes, so that old cache entries are ignored
+tableCacheVersion = 2
+
+# the maximum number of parsed tables to keep in the cache
+tableCacheMaxEntries = 2000
+
+# the number of tables found in (hits) or added to (misses) the cache by this process
+tableCacheStats = {"hits" : 0, "misses" : 0}
+
+_tableCachePruned = False               # has this process pruned the cache?
+
+def tableCacheFile(tableFile, userDataDir=None, productName=None):
+    """
+    return the file in the user's data directory used to cache the parsed
+    contents of a table file, or None if tables should not be cached (see
+    hooks.config.Eups.cacheTables)
+    @param tableFile     the table file in question
+    @param userDataDir   the user's data directory (default: utils.defaultUserDataDir())
+    @param productName   the name of the product that the table belongs to
+                           (the parsed table depends on it)
+    """
+    if not hooks.config.Eups.cacheTables:
+        return None
+    try:
+        if not userDataDir:
+            userDataDir = utils.defaultUserDataDir()
+    except RuntimeError:
+        return None
+    if not userDataDir:
+        return None
+
+    import hashlib                      # only needed here, so don't slow down "import eups"
+    name = "%s\0%s" % (os.path.abspath(tableFile), productName or "")
+    name = hashlib.sha1(name.encode("utf-8")).hexdigest()
+    return os.path.join(userDataDir, "_caches_", "_tables_", name[:2], name + ".pickleTable")
+
+def pruneTableCache(cacheDir, maxEntries=None):
+    """
+    remove the least recently used parsed tables if the cache holds more than
+    maxEntries of them
+    @param cacheDir     the cache's directory (the "_tables_" directory
+                          containing the files returned by tableCacheFile())
+    @param maxEntries   the number of tables to keep (default: tableCacheMaxEntries)
+    """
+    if maxEntries is None:
+        maxEntries = tableCacheMaxEntries
+
+    try:
+        files = []
+        for subdir in os.listdir(cacheDir):
+            subdir = os.path.join(cacheDir, subdir)
+            if os.path.isdir(subdir):
+                files += [os.path.join(subdir, f) for f in os.listdir(subdir)
+                          if f.endswith(".pickleTable")]
+        if len(files) <= maxEntries:
+            return
+
+        files = sorted([(os.stat(f).st_mtime, f) for f in files])
+        for mtime, f in files[:len(files) - maxEntries]:
+            os.unlink(f)
+    except OSError:
+        pass
+
 class Table(object):
     """A class that represents a eups table file"""
 
+    _actionsCache = None                # in case we were pickled before it was added
+
     def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0):
         """
         Parse a tablefile
@@ -36,10 +106,22 @@ class Table(object):
         self.topProduct = topProduct
         self.old = False
         self._actions = []
+        self._actionsCache = {}         # actions(), keyed by flavor and setup type
 
         if utils.isRealFilename(tableFile):
             self._read(tableFile, addDefaultProduct, verbose, topProduct)
 
+    def _message(self, stream, msg, verbose=0, level=0):
+        """Print a message about the table file, remembering it for the cache (see _read())
+
+        @param stream   the name of the stream in utils to print it to
+        @param level    the verbosity needed to print it
+        """
+        if verbose >= level:
+            print(msg, file=getattr(utils, stream))
+        if getattr(self, "_messages", None) is not None:
+            self._messages.append((stream, msg, level))
+
     def _rewrite(self, contents):
         """Rewrite the contents of a tablefile to the canonical form; each
 line is returned as a tuple (lineNo, line)
@@ -101,7 +183,8 @@ but no other interpretation is applied
                         msg = "Unsupported qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
                         raise BadTableContent(self.file, msg=msg)
                     else:
-                        print("Ignoring qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo), file=utils.stdwarn)
+                        self._message("stdwarn", "Ignoring qualifiers \"%s\" at %s:%d" %
+                                      (mat.group(1), self.file, lineNo))
                 continue
             #
             # Parse Group...Common...End, replacing by a proper If statement
@@ -252,11 +335,104 @@ but no other interpretation is applied
         return self
 
     def _read(self, tableFile, addDefaultProduct, verbose=0, topProduct=None):
-        """Read and parse a table file, setting _actions"""
+        """Read and parse a table file, setting _actions
+
+        The parsed actions (before the default product is added or any eups
+        variables are expanded) are cached in the user's data directory (see
+        tableCacheFile()), keyed by the table file's size and modification
+        time, so a table is only parsed again once it has changed.  The
+        messages printed while parsing it are cached too, and are printed
+        again whenever the cached table is used.
+        """
+        global _tableCachePruned
 
         if not tableFile:               # nothing to do
             return
 
+        try:
+            st = os.stat(tableFile)
+        except OSError as e:
+            raise TableError(tableFile, msg=str(e))
+        # unsetting PRODUCT_DIR depends on the product the table belongs to
+        key = (tableCacheVersion, os.path.abspath(tableFile), st.st_size, st.st_mtime,
+               topProduct and topProduct.name)
+
+        cacheFile = tableCacheFile(tableFile, productName=topProduct and topProduct.name)
+        cached = None
+        if cacheFile:
+            try:
+                fd = open(cacheFile, "rb")
+                try:
+                    cached = pickle.load(fd)
+                finally:
+                    fd.close()
+                if cached.get("key") != key:
+                    cached = None
+            except Exception:
+                cached = None
+
+        if cached:
+            tableCacheStats["hits"] += 1
+            self.old = cached["old"]
+            self._actions = cached["actions"]
+            for stream, msg, level in cached["messages"]:
+                if verbose >= level:
+                    print(msg, file=getattr(utils, stream))
+            try:
+                os.utime(cacheFile, None) # it's been used, so keep it (see pruneTableCache())
+            except OSError:
+                pass
+        else:
+            tableCacheStats["misses"] += 1
+            self._messages = []
+            try:
+                self._parse(tableFile, verbose)
+                messages = self._messages
+            finally:
+                del self._messages
+
+            if cacheFile:
+                try:
+                    if not os.path.isdir(os.path.dirname(cacheFile)):
+                        os.makedirs(os.path.dirname(cacheFile))
+                    fd = utils.AtomicFile(cacheFile, "wb")
+                    pickle.dump(dict(key=key, old=self.old, actions=self._actions, messages=messages),
+                                fd, protocol=2)
+                    fd.close()
+                except Exception as e:
+                    if verbose > 1:
+                        print("Unable to cache parsed table %s: %s" % (tableFile, e), file=utils.stdwarn)
+                else:
+                    if not _tableCachePruned:
+                        _tableCachePruned = True
+                        pruneTableCache(os.path.dirname(os.path.dirname(cacheFile)))
+        #
+        # The cached Actions don't know about the product that we're setting up
+        #
+        for actions in self._actions:
+            for logicalOrBlock in actions:
+                if isinstance(logicalOrBlock, list):
+                    for a in logicalOrBlock:
+                        a.topProduct = topProduct
+        #
+        # Setup the default product, usually "toolchain"
+        #
+        if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
+            args = [hooks.config.Eups.defaultProduct["name"]]
+            if hooks.config.Eups.defaultProduct["version"]:
+                args.append(hooks.config.Eups.defaultProduct["version"])
+            if hooks.config.Eups.defaultProduct["tag"]:
+                args.append("--tag")
+                args.append(hooks.config.Eups.defaultProduct["tag"])
+
+            self._actions += [('True',
+                               [Action("implicit", "setupRequired", args,
+                                       {"optional": True, "silent" : True})],
+                               [])]
+
+    def _parse(self, tableFile, verbose=0):
+        """Parse a table file, setting _actions"""
+
         try:
             fd = open(tableFile)
         except IOError as e:
@@ -373,7 +549,7 @@ but no other interpretation is applied
                         "unsetupoptional" : Action.unsetupOptional,
                         }[cmd]
                 except KeyError:
-                    print("Unexpected line in %s:%d: %s" % (tableFile, lineNo, line), file=utils.stderr)
+                    self._message("stderr", "Unexpected line in %s:%d: %s" % (tableFile, lineNo, line))
                     continue
             else:
                 cmd = line; args = []
@@ -432,19 +608,21 @@ but no other interpretation is applied
                     args[0] = pdirVar
 
                 if args[0] != pdirVar:  # only allow the unsetting of this one variable
-                    if pdirVar and verbose > 0:
-                        print("Attempt to unset $%s at %s:%d" % (args[0], self.file, lineNo), file=utils.stdwarn)
+                    if pdirVar:
+                        self._message("stdwarn", "Attempt to unset $%s at %s:%d" %
+                                      (args[0], self.file, lineNo), verbose, 1)
                     continue
             elif cmd == Action.sourceRequired:
-                print("Ignoring unsupported directive %s at %s:%d" % (line, self.file, lineNo), file=utils.stderr)
+                self._message("stderr", "Ignoring unsupported directive %s at %s:%d" %
+                              (line, self.file, lineNo))
                 continue
             elif cmd == Action.doPrint:
                 pass
             else:
-                print("Unrecognized line: %s at %s:%d" % (line, self.file, lineNo), file=utils.stderr)
+                self._message("stderr", "Unrecognized line: %s at %s:%d" % (line, self.file, lineNo))
                 continue
 
-            block += [Action(tableFile, cmd, args, extra, topProduct=topProduct)]
+            block += [Action(tableFile, cmd, args, extra)]
         #
         # Push any remaining actions onto current logical block
         #
@@ -452,38 +630,51 @@ but no other interpretation is applied
             self._actions.append(logicalBlocks)
         if block:
             self._actions += [(logical, block, [])]
-        #
-        # Setup the default product, usually "toolchain"
-        #
-        if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
-            args = [hooks.config.Eups.defaultProduct["name"]]
-            if hooks.config.Eups.defaultProduct["version"]:
-                args.append(hooks.config.Eups.defaultProduct["version"])
-            if hooks.config.Eups.defaultProduct["tag"]:
-                args.append("--tag")
-                args.append(hooks.config.Eups.defaultProduct["tag"])
-
-            self._actions += [('True',
-                               [Action("implicit", "setupRequired", args,
-                                       {"optional": True, "silent" : True})],
-                               [])]
 
     def actions(self, flavor, setupType=[], verbose=0):
         """Return a list of actions for the specified flavor"""
 
-        actions = []
         if not self._actions:
-            return actions
+            return []
+
+        if utils.is_string(setupType):
+            key = (flavor, setupType)
+        else:
+            key = (flavor, tuple(setupType))
+        if self._actionsCache is None:
+            self._actionsCache = {}
+
+        actions = self._actionsCache.get(key)
+        if actions is None:
+            actions, usesEnvironment = self._selectActions(flavor, setupType)
+            if not usesEnvironment:     # else the choice may be different next time
+                self._actionsCache[key] = actions
+
+        if len(actions) == 0 and verbose > 1:
+            msg = "Table %s has no entry for flavor %s" % (self.file, flavor)
+            if setupType:
+                msg += ", type " + ", ".join(setupType)
+            print(msg, file=utils.stdinfo)
+        return list(actions)
+
+    def _selectActions(self, flavor, setupType):
+        """Return the actions whose conditions are satisfied for a flavor and
+        setup type, and whether any of the conditions evaluated depended on
+        the environment"""
+
+        symbols = {"flavor" : flavor}
+        if setupType:
+            symbols["type"] = setupType
 
+        actions = []
+        usesEnvironment = False
         for LBB in self._actions:       # LBB: Logical Block Block[s]
             while LBB:
                 logical, ifBlock, elseBlock = LBB[0], LBB[1], LBB[2:]
-                parser = VersionParser(logical)
-                parser.define("flavor", flavor)
-                if setupType:
-                    parser.define("type", setupType)
+                condition = VersionParser.compile(logical)
+                usesEnvironment = usesEnvironment or condition.usesEnvironment
 
-                if parser.eval():
+                if condition(symbols):
                     actions += ifBlock
                     break
                 else:
@@ -493,12 +684,7 @@ but no other interpretation is applied
                     else:
                         LBB = elseBlock # another Logical Block Block[s]
 
-        if len(actions) == 0 and verbose > 1:
-            msg = "Table %s has no entry for flavor %s" % (self.file, flavor)
-            if setupType:
-                msg += ", type " + ", ".join(setupType)
-            print(msg, file=utils.stdinfo)
-        return actions
+        return actions, usesEnvironment
 
     def __str__(self):
         s = ""
@@ -520,7 +706,8 @@ but no other interpretation is applied
                      listExternalDependencies=False):
         """
         Return the product dependencies as specified in this table as a list
-        of (Product, optional?, recursionDepth) tuples
+        of (Product, optional?, recursionDepth) tuples.  The products are
+        resolved by the Eups instance's DependencyGraph, which remembers them.
 
         @param Eups            an Eups instance to use to locate packages
         @param eupsPathDirs    the product stacks to restrict searches to
@@ -539,11 +726,31 @@ but no other interpretation is applied
                                         but does not manage), rather than the ones it both tracks and
                                         manages via declare/setup
         """
-        from .Product import Product
-
         if Eups is None:
             Eups = eups.Eups()
 
+        return Eups.getDependencyGraph().dependencies(self, recursive, recursionDepth, followExact,
+                                                      productDictionary, addDefaultProduct,
+                                                      requiredVersions, listExternalDependencies)
+
+    def directDependencies(self, Eups, followExact=None, listExternalDependencies=False):
+        """
+        Return the products that this table sets up or unsets up, without
+        following their dependencies, as a list of tuples
+            (cmd, productName, product, optional?, requestedVRO, noRecursion, versionName)
+        where cmd is Action.setupRequired or Action.unsetupRequired.  For
+        setupRequired, product is the Product found (using the VRO requested
+        in the table, if any), or an undeclared Product if there is none; for
+        unsetupRequired it is None.  See also dependencies().
+
+        @param Eups            an Eups instance to use to locate packages
+        @param followExact     follow the exact, as-built versions in the
+                                  table file.  If None or not specified,
+                                  it defaults to Eups.exact_version.
+        @param listExternalDependencies Return the external dependencies
+        """
+        from .Product import Product
+
         if followExact is None:
             followExact = Eups.exact_version
 
@@ -551,63 +758,23 @@ but no other interpretation is applied
         if not followExact:
             setupType = [t for t in setupType if t != "exact"]
 
-        if recursive and not isinstance(recursive, bool):
-            recursiveDict = recursive
-        else:
-            recursiveDict = {}          # dictionary of products we've analysed
-        prodkey = lambda p: "%s-%s" % (p.name, p.version)
-
-        if productDictionary is None:
-            productDictionary = {}
-
         listExternalDependencies = not not listExternalDependencies # ensure it is boolean
 
-        if self.topProduct not in productDictionary:
-            productDictionary[self.topProduct] = []
-
-        if addDefaultProduct is None and \
-               self.topProduct and self.topProduct.name == hooks.config.Eups.defaultProduct["name"]:
-            addDefaultProduct = False
-
         deps = []
         for a in self.actions(Eups.flavor, setupType=setupType):
-            if a.cmd == Action.unsetupRequired:
-                if True:
-                    optional = a.extra["optional"]
-
-                    requestedVRO, productName, productDir, vers, versExpr, extraArgs = a.processArgs(Eups)
-                    if extraArgs["noAction"]:
-                        continue
-                    if extraArgs["isExternal"] != listExternalDependencies:
-                        continue
-                    #
-                    # Remove all mention of the unsetup product
-                    #
-                    try:
-                        thisProduct = [val for val in deps if val[0].name == productName][0][0]
-                    except IndexError:
-                        continue
-                    table = thisProduct.getTable()
-
-                    unsetupProducts = [thisProduct.name]
-                    if table and not extraArgs["noRecursion"]:
-                        subDeps = table.dependencies(Eups, eupsPathDirs=eupsPathDirs,
-                                                    recursive=True, followExact=followExact)
-                        unsetupProducts += [val[0].name for val in subDeps]
-
-                    for pn in unsetupProducts:
-                        for i in reversed(sorted([i for i, val in enumerate(deps) if val[0].name == pn])):
-                            del deps[i]
+            if a.cmd not in (Action.setupRequired, Action.unsetupRequired):
+                continue
 
-            elif a.cmd == Action.setupRequired:
-                optional = a.extra["optional"]
+            optional = a.extra["optional"]
 
-                requestedVRO, productName, productDir, vers, versExpr, extraArgs = a.processArgs(Eups)
-                if extraArgs["noAction"]:
-                    continue
-                if extraArgs["isExternal"] != listExternalDependencies:
-                    continue
+            requestedVRO, productName, productDir, vers, versExpr, extraArgs = a.processArgs(Eups)
+            if extraArgs["noAction"]:
+                continue
+            if extraArgs["isExternal"] != listExternalDependencies:
+                continue
 
+            product = None
+            if a.cmd == Action.setupRequired:
                 Eups.pushStack("vro", requestedVRO)
 
                 q = None
@@ -615,45 +782,18 @@ but no other interpretation is applied
                     q = utils.Quiet(Eups)
 
                 try:
-                    if requiredVersions and productName in requiredVersions:
-                        product = Eups.findProduct(productName, requiredVersions[productName])
-                    else:
-                        product, vroReason = Eups.findProductFromVRO(productName, vers, versExpr)
-                    if not product:
-                        raise ProductNotFound(productName)
-
-                    val = [product]
-                    val.append(a.extra["optional"])
-                    if recursive:
-                        val.append(recursionDepth)
-                    else:
-                        val.append(None)
-                    deps += [val]
-
-                    if recursive and not extraArgs["noRecursion"] and prodkey(product) not in recursiveDict:
-                        recursiveDict[prodkey(product)] = 1
-                        deptable = product.getTable(addDefaultProduct=addDefaultProduct)
-                        if deptable:
-                            deps += deptable.dependencies(Eups, eupsPathDirs, recursiveDict,
-                                                          recursionDepth + 1, followExact, productDictionary,
-                                                          addDefaultProduct, requiredVersions=requiredVersions)
-
+                    product, vroReason = Eups.findProductFromVRO(productName, vers, versExpr)
                 except (ProductNotFound, TableFileNotFound):
+                    product = None
+                if not product:
                     product = Product(productName, vers) # it doesn't exist, but it's still a dep.
 
-                    val = [product, a.extra["optional"]]
-                    if recursive:
-                        val.append(recursionDepth)
-                    else:
-                        val.append(None)
-                    deps += [val]
-
                 del q
 
-                productDictionary[self.topProduct].append(val)
-
                 Eups.popStack("vro")
 
+            deps.append((a.cmd, productName, product, optional, requestedVRO, extraArgs["noRecursion"], vers))
+
         return deps
 
     def getDeclareOptions(self, flavor, setupType):
@@ -671,12 +811,11 @@ but no other interpretation is applied
                     print("Oh dear. Please type w at the pdb prompt and notify rhl@astro.princeton.edu")
                     import pdb; pdb.set_trace()
 
-                parser = VersionParser(logical)
-                parser.define("flavor", flavor)
+                symbols = {"flavor" : flavor}
                 if setupType:
-                    parser.define("type", setupType)
+                    symbols["type"] = setupType
 
-                if parser.eval():
+                if VersionParser.compile(logical)(symbols):
                     block = ifBlock
                     LBB = None
                 else:
@@ -998,6 +1137,9 @@ class Action(object):
             if productDir is None:
                 return
 
+        if fwd:
+            Eups.recordUndo("setupRequired", productName, extraArgs["noRecursion"], bool(optional))
+
         Eups.pushStack("env")
         Eups.pushStack("vro", requestedVRO)
 
@@ -1102,8 +1244,6 @@ class Action(object):
         else:
             delim = ":"
 
-        opath = os.environ.get(envVar, "") # old value of envVar, generally a path of some sort hence the name
-
         # should we prepend an extra :?
         pat = "^" + delim
         prepend_delim = re.search(pat, value)
@@ -1113,8 +1253,6 @@ class Action(object):
         append_delim = re.search(pat, value)
         value = re.sub(pat, "", value)
 
-        opath = [el for el in opath.split(delim) if el] # strip extra : at start or end
-
         if fwd:
             value = self.expandEnvironmentalVariable(value, Eups.verbose)
             if value is None:
@@ -1124,29 +1262,24 @@ class Action(object):
             if Eups.verbose > 1:
                 print("In %s value \"%s\" contains a delimiter '%s'" % (self.tableFile, value, delim), file=utils.stdwarn)
 
-        npath = opath
-        for value in value.split(delim):
+        path = Eups.getEnvPath(envVar, delim) # old value of envVar, generally a path of some sort hence the name
+        values = value.split(delim)
+        for value in values:
             if fwd:
                 if append:
-                    npath = npath + [value]
+                    path.append(value)
                 else:
-                    npath = [value] + npath
+                    path.prepend(value)
             else:
-                npath = [d for d in npath if d != value]
+                path.remove(value)
 
-        npath = self.pathUnique(npath) # remove duplicates
-
-        npath = delim.join(npath)     # convert back to a string
-
-        if prepend_delim and not re.search(r"^%s" % delim, npath):
-            npath = delim + npath
-        if append_delim and not re.search(r"%s$" % delim, npath):
-            npath += delim
+        if fwd:
+            Eups.recordUndo("envPrepend", envVar, delim, values, bool(prepend_delim), bool(append_delim))
 
         if Eups.force and envVar in Eups.oldEnviron:
             del Eups.oldEnviron[envVar]
 
-        Eups.setEnv(envVar, npath, interpolateEnv=True)
+        Eups.setEnvPath(envVar, path, prependDelim=prepend_delim, appendDelim=append_delim)
 
     def execute_addAlias(self, Eups, fwd=True):
         """Execute addAlias"""
@@ -1161,6 +1294,7 @@ class Action(object):
 
         if fwd:
             Eups.setAlias(key, value)
+            Eups.recordUndo("addAlias", key)
         else:
             Eups.unsetAlias(key)
 
@@ -1182,6 +1316,7 @@ class Action(object):
                 return
 
             Eups.setEnv(key, value, interpolateEnv=True)
+            Eups.recordUndo("envSet", key)
         else:
             Eups.unsetEnv(key)
 
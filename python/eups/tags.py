@@ -614,19 +614,15 @@ def getUserDefinedTags(user):
 def cloneTag(eupsenv, newTag, oldTag, productList=[]):
     checkTagsList(eupsenv, [newTag, oldTag])
 
-    productsToTag = productList          # may be []
-    failedToTag = []                      # products we failed to tag
+    productsToTag = []
     for p in eupsenv.findProducts(tags=[oldTag]):
         if productList and p.name not in productList:
             continue
 
-        try:
-            eupsenv.declare(p.name, p.version, tag=newTag)
-        except EupsException as e:
-            print(e, file=utils.stderr)
-            failedToTag.append(p.name)
+        productsToTag.append((p.name, p.version, None, None, newTag))
 
-    return failedToTag
+    # products we failed to tag are reported and returned
+    return eupsenv.declareProducts(productsToTag, atomic=False)
 
 def deleteTag(eupsenv, tag):
     checkTagsList(eupsenv, [tag])
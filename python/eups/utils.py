@@ -72,6 +72,57 @@ else:
     def is_string(string):
         return isinstance(string, str)
 
+class _OrderedDict(dict):
+    """
+    The parts of collections.OrderedDict (new in python 2.7) that eups uses:
+    iteration in insertion order, and popitem() from either end
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self._order = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._order.append(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._order.remove(key)
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def keys(self):
+        return list(self._order)
+
+    def values(self):
+        return [self[k] for k in self._order]
+
+    def items(self):
+        return [(k, self[k]) for k in self._order]
+
+    def pop(self, key, *default):
+        if key in self:
+            self._order.remove(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self, last=True):
+        if not self._order:
+            raise KeyError("dictionary is empty")
+        key = self._order[-1 if last else 0]
+        return key, self.pop(key)
+
+    def clear(self):
+        dict.clear(self)
+        del self._order[:]
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    OrderedDict = _OrderedDict
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def getUserName(full=False):
@@ -252,6 +303,14 @@ def setupEnvNameFor(productName):
     else:
         return name.upper()
 
+def undoEnvNameFor(productName):
+    """
+    return the name of the environment variable that records how to undo
+    the setup of a product (see Eups.setup()).  This is of the form
+    "EUPS_SETUP_UNDO_PROD"
+    """
+    return "EUPS_" + setupEnvPrefix() + "UNDO_" + productName.upper()
+
 def userStackCacheFor(eupsPathDir, userDataDir=None):
     """
     return cache directory for a given EUPS product stack in the user's
@@ -728,159 +787,33 @@ stdwarn = coloredFile(sys.stderr, "WARN")
 stdok =   coloredFile(sys.stderr, "OK")
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
-"""
-   Tarjan's algorithm and topological sorting implementation in Python
-
-   by Paul Harrison
-
-   Public domain, do with it as you will
-
-"""
-
 def stronglyConnectedComponents(graph):
     """ Find the strongly connected components in a graph using
-        Tarjan's algorithm.
+        (an iterative version of) Tarjan's algorithm.
 
         graph should be a dictionary mapping node names to
         lists of successor nodes.
-        """
-
-    result = []
-    stack = []
-    low = {}
-
-    def visit(node):
-        if node in low: return
-
-        num = len(low)
-        low[node] = num
-        stack_pos = len(stack)
-        stack.append(node)
-
-        for successor in graph[node]:
-            visit(successor)
-            low[node] = min(low[node], low[successor])
-
-        if num == low[node]:
-            component = tuple(stack[stack_pos:])
-            del stack[stack_pos:]
-            result.append(component)
-            for item in component:
-                low[item] = len(graph)
-
-    for node in graph:
-        visit(node)
 
-    return result
-
-
-def _topological_sort(graph):
-    count = { }
-    for node in graph:
-        count[node] = 0
-    for node in graph:
-        for successor in graph[node]:
-            count[successor] += 1
-
-    ready = [ node for node in graph if count[node] == 0 ]
-
-    result = [ ]
-    while ready:
-        node = ready.pop(-1)
-        result.append(node)
-
-        for successor in graph[node]:
-            count[successor] -= 1
-            if count[successor] == 0:
-                ready.append(successor)
+        Returns a list of tuples of nodes, each component being listed
+        after the components that it can reach.
+        """
+    from eups.graph import Graph
 
-    return result
+    g = Graph(graph)
+    return [tuple([g.nodes[i] for i in c]) for c in g.stronglyConnectedComponents()]
 
 
 def topologicalSort(graph, verbose=False, checkCycles=False):
     """
     If checkCycles is True, throw RuntimeError if any cycles are detected
 
-    From http://code.activestate.com/recipes/577413-topological-sort (but converted back to python 2.4)
-
-    Author Paddy McCarthy, under the MIT license
-
     Returns a generator;
            print [str(t) for t in utils.topologicalSort(graph)]
     returns a list of keys, where the earlier elements sort _after_ the later ones.
-    """
-
-    for k, v in graph.items():
-        graph[k] = set(v)
 
-    for k, v in graph.items():
-        v.discard(k) # Ignore self dependencies
-
-    extra_items_in_deps = reduce(set.union, graph.values()) - set(graph.keys())
-    for item in extra_items_in_deps:
-        graph[item] = set()
-
-    #
-    # If there are strongly-connected components, make these components the keys
-    # in the graph, not single elements
-    #
-    def name(p):
-        """Return a p's name (if a Product), otherwise str(p)"""
-        try:
-            return p.name
-        except AttributeError:
-            return str(p)
-
-    def nameVersion(p):
-        try:
-            return "[%s %s]" % (p.name, p.version)
-        except AttributeError:
-            return str(p)
-
-
-    components = stronglyConnectedComponents(graph)
-
-    cycles = []
-    for ccomp in components:
-        if len(ccomp) > 1:
-            cycles.append(ccomp)
-
-    msg = []
-    for ccomp in cycles:
-        msg.append(", ".join([nameVersion(c) for c in ccomp]))
-
-    if msg:
-        msg = "(%s)" % ("), (".join(msg))
-
-        if verbose:
-            if len(msg) == 0:
-                s = ""
-            else:
-                s = "s"
-            print("Detected cycle%s: %s" % (s, msg), file=stdwarn)
-
-        if checkCycles:
-            raise RuntimeError("".join(msg))
-    #
-    # Rebuild the graph using tuples, so as to handle connected components
-    #
-    node_component = {}         # index for which component each node belongs in
-    for component in components:
-        for node in component:
-            node_component[node] = component
-
-    component_graph = {}        # our new graph, indexed by component
-    for component in components:
-        component_graph[component] = set()
-
-    for node in graph:
-        node_c = node_component[node]
-        for successor in graph[node]:
-            successor_c = node_component[successor]
-            if node_c != successor_c: # here's where we break the cycle
-                component_graph[node_c].add(successor_c)
-
-    graph = component_graph
+    The members of a cycle are returned together.  See eups.graph.Graph
+    """
+    from eups.graph import Graph
 
     def cmp_prods_and_none(a, b):
         """ Compare a and b, allowing either to be None. None
@@ -896,23 +829,8 @@ def topologicalSort(graph, verbose=False, checkCycles=False):
             return 1
         return cmp(a, b)
 
-    while True:
-        ordered = set(item for item, dep in graph.items() if not dep)
-        if not ordered:
-            break
-        flattened_ordered = [p for comp in list(ordered)
-                               for p    in comp]
-        yield sorted(flattened_ordered, **cmp_or_key(cmp_prods_and_none))
-        ngraph = {}
-        for item, dep in graph.items():
-            if item not in ordered:
-                ngraph[item] = (dep - ordered)
-
-        graph = ngraph; del ngraph
-
-    if graph:
-        raise RuntimeError("A cyclic dependency exists amongst %s" %
-                           " ".join(sorted([name([x for x in p]) for p in graph.keys()])))
+    for layer in Graph(graph).topologicalLayers(verbose=verbose, checkCycles=checkCycles):
+        yield sorted(layer, **cmp_or_key(cmp_prods_and_none))
 
 class AtomicFile(object):
     """
@@ -1002,6 +920,61 @@ def uniq(seq):
 
     return list(_aux(seq))
 
+class EnvPath(object):
+    """
+    the elements of a path-like environment variable such as $PATH, held as
+    an ordered list without duplicates or empty elements together with a set
+    of its elements, so that an element can be added or removed without
+    re-splitting and re-scanning the whole path.
+    """
+
+    def __init__(self, value="", delim=":"):
+        """
+        @param value   the value of the variable
+        @param delim   the delimiter between elements of the path
+        """
+        self.delim = delim
+        self.value = value              # the value this path was last read from or written to
+        self._elements = []
+        self._members = set()
+
+        for el in value.split(delim):
+            if el and el not in self._members:
+                self._elements.append(el)
+                self._members.add(el)
+
+    def prepend(self, el):
+        """Put an element at the front of the path, moving it there if it's already present"""
+        if el in self._members:
+            self._elements.remove(el)
+        else:
+            self._members.add(el)
+        self._elements.insert(0, el)
+
+    def append(self, el):
+        """Put an element at the end of the path, unless it's already present"""
+        if el not in self._members:
+            self._elements.append(el)
+            self._members.add(el)
+
+    def remove(self, el):
+        """Remove an element from the path, if present"""
+        if el in self._members:
+            self._elements.remove(el)
+            self._members.discard(el)
+
+    def __contains__(self, el):
+        return el in self._members
+
+    def __iter__(self):
+        return iter(self._elements)
+
+    def __len__(self):
+        return len(self._elements)
+
+    def __str__(self):
+        return self.delim.join(self._elements)
+
 if __name__ == "__main__":
     data = {
         'des_system_lib':   set('std synopsys std_cell_lib des_system_lib dw02 dw01 ramlib ieee'.split()),
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Measure the time and memory that "eups list" needs with a large cached
+stack (by default 500 products with 10 versions each), and how much of that
+is the cost of loading the cached product records:
+
+    python benchListMemory.py [nproduct [nversion]]
+
+The peak RSS of "eups list" is compared with that of "import eups.cmd"
+alone; the difference is the memory needed for the stack.
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import testCommon
+
+from eups.stack import ProductStack
+
+flavor = "Linux"
+
+def makeStack(root, nproduct, nversion):
+    """Write a stack of nproduct products, each with nversion versions, in root"""
+    for i in range(nproduct):
+        name = "prod%03d" % i
+        dbdir = os.path.join(root, "ups_db", name)
+        os.makedirs(dbdir)
+        for j in range(nversion):
+            version = "%d.%d" % (j//5 + 1, j % 5)
+            upsdir = os.path.join(root, flavor, name, version, "ups")
+            os.makedirs(upsdir)
+            fd = open(os.path.join(upsdir, "%s.table" % name), "w")
+            fd.write("envPrepend(PATH, ${PRODUCT_DIR}/bin)\n")
+            if i > 0:
+                fd.write("setupRequired(prod%03d)\n" % (i - 1))
+            fd.close()
+
+            fd = open(os.path.join(dbdir, "%s.version" % version), "w")
+            fd.write("""FILE = version
+PRODUCT = %s
+VERSION = %s
+#***************************************
+
+Group:
+   FLAVOR = %s
+   QUALIFIERS = ""
+   PROD_DIR = %s/%s/%s
+   UPS_DIR = ups
+   TABLE_FILE = %s.table
+End:
+""" % (name, version, flavor, flavor, name, version, name))
+            fd.close()
+
+def measure(cmd, env, ntry=3):
+    """
+    Run cmd ntry times, returning the shortest wall-clock time it took and
+    its peak RSS in MB
+    """
+    # RUSAGE_CHILDREN is the maximum over all of a process's children, so
+    # run each command from a process of its own
+    code = """
+import os, resource, subprocess, sys, time
+t0 = time.time()
+subprocess.call(sys.argv[1:], stdout=open(os.devnull, "w"))
+print("%f %d" % (time.time() - t0, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+"""
+    times, rss = [], []
+    for i in range(ntry):
+        out = subprocess.Popen([sys.executable, "-c", code] + cmd, env=env,
+                               stdout=subprocess.PIPE).communicate()[0]
+        t, maxrss = out.decode().split()
+        times.append(float(t))
+        rss.append(int(maxrss))
+
+    scale = 1024.0*1024 if sys.platform == "darwin" else 1024.0 # ru_maxrss is in bytes on OS X
+    return min(times), max(rss)/scale
+
+def timeit(what, func, *args):
+    """Call func(*args), reporting the time (and memory, if we can) it takes"""
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    if tracemalloc:
+        tracemalloc.start()
+    t0 = time.time()
+    result = func(*args)
+    msg = "%-40s %8.3fs" % (what, time.time() - t0)
+    if tracemalloc:
+        msg += " %8.1f MB" % (tracemalloc.get_traced_memory()[1]/(1024.0*1024))
+        tracemalloc.stop()
+    print(msg)
+
+    return result
+
+def main(nproduct=500, nversion=10):
+    root = tempfile.mkdtemp(prefix="eupsbench")
+    try:
+        makeStack(root, nproduct, nversion)
+
+        env = os.environ.copy()
+        env.update(EUPS_DIR=testCommon.EUPS_DIR, EUPS_PATH=root, EUPS_FLAVOR=flavor,
+                   EUPS_USERDATA=os.path.join(root, "_userdata_"), EUPS_NO_DAEMON="1",
+                   PYTHONPATH=os.path.join(testCommon.EUPS_DIR, "python"))
+        eupsCmd = [sys.executable, os.path.join(testCommon.EUPS_DIR, "bin", "eups.in")]
+        devnull = open(os.devnull, "w")
+        subprocess.check_call(eupsCmd + ["admin", "buildCache"], env=env, stdout=devnull, stderr=devnull)
+        devnull.close()
+
+        # as we're not an admin, the cache is in the user data directory
+        dbpath = os.path.join(root, "ups_db")
+        cacheFile = ProductStack.persistFilename(flavor)
+        cacheDir = [d for d, dirs, files in os.walk(env["EUPS_USERDATA"]) if cacheFile in files][0]
+        print("%d products x %d versions; the %s cache is %d kB" %
+              (nproduct, nversion, flavor, os.stat(os.path.join(cacheDir, cacheFile)).st_size//1024))
+        #
+        # The cost of the cached product records
+        #
+        stack = timeit("load the cache", ProductStack.fromCache, dbpath, flavor,
+                       cacheDir, cacheDir, False, False)
+        names = stack.getProductNames(flavor)
+        timeit("decode every product's versions",
+               lambda: [stack.getVersions(n, flavor) for n in names])
+        timeit("make a Product for every version",
+               lambda: [stack.getProduct(n, v, flavor) for n in names for v in stack.getVersions(n, flavor)])
+        #
+        # ... and of "eups list", compared with just importing eups
+        #
+        for what, cmd in [("import eups.cmd", [sys.executable, "-c", "import eups.cmd"]),
+                          ("eups list", eupsCmd + ["list"])]:
+            t, rss = measure(cmd, env)
+            print("%-40s %8.3fs %8.1f MB peak RSS" % (what, t, rss))
+    finally:
+        shutil.rmtree(root, True)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
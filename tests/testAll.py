@@ -10,7 +10,9 @@ tests = []
 for t in [
     "testApp",
     "testCmd",
+    "testDaemon",
     "testDeprecated",
+    "testDistrib",
     "testDb",
     "testEups",
     "testMisc",
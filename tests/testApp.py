@@ -7,6 +7,8 @@ functions are tested via testCmd.py
 
 import os
 import shutil
+import subprocess
+import tempfile
 import unittest
 import testCommon
 from testCommon import testEupsStack
@@ -52,6 +54,70 @@ class AppTestCase(unittest.TestCase):
         version = eups.getSetupVersion("python")
         self.assertEqual(version, "2.5.2")
 
+    def testFreeze(self):
+        pdir = os.path.join(testEupsStack, os.environ["EUPS_FLAVOR"], "python", "2.5.2")
+        os.environ["PATH"] = "/usr/bin:/bin"
+        environ = os.environ.copy()
+
+        lines = eups.freeze("python", "2.5.2", shell="sh")
+        self.assertEqual(os.environ, environ) # the environment isn't changed
+        self.assertIn("export PYTHON_DIR=%s" % pdir, lines)
+        bin = ":".join([os.path.join(pdir, "bin"), os.path.join(testEupsStack, "Linux", "tcltk", "8.5a4", "bin")])
+        self.assertIn("export PATH=\"%s:${PATH}\"" % bin, lines)
+        self.assertEqual(sorted([l.split("=")[0] for l in lines if l.startswith("export")]),
+                         sorted([c.split("=")[0] for c in eups.setup("python", "2.5.2")]))
+        os.environ = environ.copy()
+
+        lines = eups.freeze("python", "2.5.2", shell="csh")
+        self.assertIn("setenv PYTHON_DIR %s" % pdir, lines)
+        self.assertIn("SETUP_TCLTK", [l.split()[1] for l in lines if l.startswith("setenv")])
+        #
+        # Check that sourcing the script sets things up
+        #
+        os.environ = environ
+        tmpdir = tempfile.mkdtemp()
+        try:
+            script = os.path.join(tmpdir, "python.sh")
+            fd = open(script, "w")
+            fd.write("\n".join(eups.freeze("python", "2.5.2", shell="sh")) + "\n")
+            fd.close()
+
+            out = subprocess.Popen(["sh", "-c", ". %s; echo $PYTHON_DIR; echo $PATH" % script],
+                                   stdout=subprocess.PIPE, env=environ).communicate()[0]
+            self.assertEqual(out.decode().split(), [pdir, "%s:/usr/bin:/bin" % bin])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testFreezeAlreadySetup(self):
+        # the script doesn't depend on the product being setup when it was written
+        pdir = os.path.join(testEupsStack, os.environ["EUPS_FLAVOR"], "python", "2.5.2")
+        os.environ["PATH"] = "/usr/bin:/bin"
+        clean = os.environ.copy()
+        fresh = eups.freeze("python", "2.5.2", shell="sh")
+
+        eups.setup("python", "2.5.2")
+        environ = os.environ.copy()
+        lines = eups.freeze("python", "2.5.2", shell="sh")
+        self.assertEqual(os.environ, environ)
+        self.assertEqual(sorted(lines), sorted(fresh))
+        self.assertIn("export PYTHON_DIR=%s" % pdir, lines)
+        self.assertIn("SETUP_TCLTK", [l.split("=")[0].split()[1] for l in lines if l.startswith("export")])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            script = os.path.join(tmpdir, "python.sh")
+            fd = open(script, "w")
+            fd.write("\n".join(lines) + "\n")
+            fd.close()
+
+            out = subprocess.Popen(["sh", "-c", ". %s; echo $PYTHON_DIR; echo $PATH" % script],
+                                   stdout=subprocess.PIPE, env=clean).communicate()[0]
+            bin = ":".join([os.path.join(pdir, "bin"),
+                            os.path.join(testEupsStack, "Linux", "tcltk", "8.5a4", "bin")])
+            self.assertEqual(out.decode().split(), [pdir, "%s:/usr/bin:/bin" % bin])
+        finally:
+            shutil.rmtree(tmpdir)
+
 class TagSetupTestCase(unittest.TestCase):
     """
     Tests use cases for selecting tagged versions via app.setup()
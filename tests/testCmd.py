@@ -10,6 +10,8 @@ import os
 import sys
 import unittest
 import re, shutil
+import tempfile
+import subprocess
 from eups.utils import StringIO, encodePath
 from testCommon import testEupsStack
 
@@ -317,6 +319,58 @@ tcltk                 8.5a4      \tcurrent
         prod = myeups.findProduct("newprod", Tag("current"))
         self.assertIsNone(prod, msg="Failed to undeclare product")
 
+    def testDeclareFromFile(self):
+        pdir = os.path.join(testEupsStack, "Linux", "newprod")
+        pdir10 = os.path.join(pdir, "1.0")
+        pdir11 = os.path.join(pdir, "1.1")
+        table = os.path.join(pdir10, "ups", "newprod.table")
+
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".txt") as fd:
+            fd.write("# product version dir table tags\n")
+            fd.write("newprod 1.0 %s %s current\n" % (pdir10, table))
+            fd.write("newprod 1.1 %s %s\n" % (pdir11, table))
+            fd.write("newprod 1.2 %s - beta   # no such dir\n" % os.path.join(pdir, "1.2"))
+            fd.flush()
+
+            # the bad entry means that nothing is declared
+            cmd = eups.cmd.EupsCmd(args=["declare", "--from-file", fd.name], toolname=prog)
+            try:
+                cmd.run()
+                self.fail("Declared a product with a non-existent directory")
+            except eups.EupsException as e:
+                self.assertEqual(e.status, 2)
+            self.assertIsNone(eups.Eups().findProduct("newprod"))
+
+            fd.seek(0)
+            fd.truncate()
+            fd.write("newprod 1.0 %s %s current\n" % (pdir10, table))
+            fd.write("newprod 1.1 %s %s\n" % (pdir11, table))
+            fd.flush()
+
+            self._resetOut()
+            cmd = eups.cmd.EupsCmd(args=["declare", "--from-file", fd.name, "-t", "beta"], toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assertEqual(self.err.getvalue(), "")
+            self.assertEqual(self.out.getvalue(), "")
+
+        myeups = eups.Eups()
+        self.assertEqual(myeups.findProduct("newprod", "1.0").tags, ["current"])
+        self.assertEqual(myeups.findProduct("newprod", "1.1").dir, pdir11)
+        self.assertEqual(myeups.findProduct("newprod", Tag("beta")).version, "1.1")
+
+    def testFreeze(self):
+        cmd = eups.cmd.EupsCmd(args="freeze -s tcsh python 2.5.2".split(), toolname=prog)
+        self.assertEqual(cmd.run(), 0)
+        self.assertEqual(self.err.getvalue(), "")
+        lines = self.out.getvalue().split("\n")
+        self.assertIn("setenv SETUP_PYTHON 'python 2.5.2 -f Linux -Z %s'" % testEupsStack, lines)
+        self.assertIn("setenv TCLTK_DIR %s" % os.path.join(testEupsStack, "Linux", "tcltk", "8.5a4"), lines)
+
+        self._resetOut()
+        cmd = eups.cmd.EupsCmd(args="freeze -s fish python".split(), toolname=prog)
+        self.assertNotEqual(cmd.run(), 0)
+        self.assertIn("Unknown shell type fish", self.err.getvalue())
+
     def testRemove(self):
         pdir = os.path.join(testEupsStack, "Linux", "newprod")
         pdir10 = os.path.join(pdir, "1.0")
@@ -359,6 +413,53 @@ tcltk                 8.5a4      \tcurrent
         self.assertNotEqual(cmd.run(), 0)
         self.assertNotEquals(self.err.getvalue(), "")
 
+class ImportTestCase(unittest.TestCase):
+    """Check that the commands only import the machinery that they need"""
+
+    def importedModules(self, cmdargs):
+        """
+        Run an eups command in a fresh python, returning the modules it imported
+        and the time taken to import eups.cmd (in microseconds; None if python
+        doesn't support -X importtime)
+        """
+        script = "import sys, eups.cmd\n" + \
+            "eups.cmd.EupsCmd(args=%r, toolname='eups').run()\n" % cmdargs + \
+            "print(' '.join(sys.modules.keys()))\n"
+
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.join(testCommon.EUPS_DIR, "python")
+        env["EUPS_PATH"] = testEupsStack
+        env["EUPS_FLAVOR"] = "Linux"
+
+        importtime = sys.version_info >= (3, 7)
+        python = [sys.executable] + (["-X", "importtime"] if importtime else [])
+        proc = subprocess.Popen(python + ["-c", script], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+
+        usec = None
+        for line in err.decode().splitlines():
+            mat = re.search(r"^import time:\s*\d+\s*\|\s*(\d+)\s*\|\s*eups\.cmd$", line)
+            if mat:
+                usec = int(mat.group(1))
+
+        return out.decode().splitlines()[-1].split(), usec
+
+    def testLazyImports(self):
+        for cmdargs in (["flavor"], ["list"]):
+            modules, usec = self.importedModules(cmdargs)
+            self.assertIn("eups.cmd", modules)
+            if usec is not None:
+                self.assertTrue(usec > 0)
+
+            for mod in ("eups.distrib", "eups.distrib.server", "urllib.request", "http.client"):
+                self.assertFalse(mod in modules, "eups %s imported %s (import eups.cmd: %s usec)" %
+                                 (" ".join(cmdargs), mod, usec))
+
+        modules = self.importedModules(["distrib", "path"])[0]
+        self.assertNotIn("eups.distrib.Repositories", modules)
+
 import eups.setupcmd
 
 class SetupCmdTestCase(unittest.TestCase):
@@ -424,6 +525,7 @@ def suite(makeSuite=True):
     """Return a test suite"""
 
     return testCommon.makeSuite([CmdTestCase,
+                                 ImportTestCase,
                                  SetupCmdTestCase
                                  ], makeSuite)
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Tests for eups.daemon
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+import testCommon
+from testCommon import testEupsStack
+
+from eups import daemon
+
+class DaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ.pop("EUPS_NO_DAEMON", None)
+
+        # keep the socket's path short enough for a Unix-domain socket
+        self.tmpdir = tempfile.mkdtemp(prefix="eupsd")
+        self.sock = os.path.join(self.tmpdir, "eupsd.sock")
+        os.environ["EUPS_DAEMON_SOCKET"] = self.sock
+
+        self.script = os.path.join(testCommon.EUPS_DIR, "bin", "eups.in")
+        self.out = os.path.join(self.tmpdir, "out")
+
+    def tearDown(self):
+        daemon.EupsDaemon(self.sock).stop()
+        os.environ.clear()
+        os.environ.update(self.environ0)
+        shutil.rmtree(self.tmpdir, True)
+
+    def forward(self, args):
+        fd = os.open(self.out, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o644)
+        try:
+            status = daemon.forward("eups", self.script, args, fds=(0, fd, fd))
+        finally:
+            os.close(fd)
+        fd = open(self.out)
+        output = fd.read()
+        fd.close()
+
+        return status, output
+
+    def testNoDaemon(self):
+        self.assert_(not daemon.EupsDaemon(self.sock).isRunning())
+        self.assert_(not daemon.EupsDaemon(self.sock).stop())
+        self.assert_(daemon.forward("eups", self.script, ["flavor"]) is None)
+
+    def testForward(self):
+        if not hasattr(socket.socket, "sendmsg"):
+            return                      # the daemon is never used
+
+        pid = daemon.startDaemon(self.sock, idleTimeout=60)
+        self.assert_(pid > 0)
+        self.assert_(daemon.EupsDaemon(self.sock).isRunning())
+        self.assertRaises(RuntimeError, daemon.startDaemon, self.sock)
+
+        status, output = self.forward(["flavor"])
+        self.assertEqual(status, 0)
+        self.assertEqual(output.strip(), "Linux")
+
+        status, output = self.forward(["list", "python"])
+        self.assertEqual(status, 0)
+        self.assertEqual(len(output.strip().split("\n")), 2)
+
+        status, output = self.forward(["list", "goober"])
+        self.assertNotEqual(status, 0)
+
+        # the client forwards the command without importing eups
+        code = "\n".join(["import runpy, sys",
+                          "sys.argv = [%r, 'flavor']" % self.script,
+                          "try:",
+                          "    runpy.run_path(sys.argv[0], run_name='__main__')",
+                          "except SystemExit as e:",
+                          "    print('status=%s eups=%s' % (e.code, 'eups' in sys.modules))"])
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.path.join(testCommon.EUPS_DIR, "python")
+        out = subprocess.Popen([sys.executable, "-c", code], env=env,
+                               stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(out.decode().split(), ["Linux", "status=0", "eups=False"])
+
+        # commands selecting a different configuration are run in-process
+        self.assert_(self.forward(["list", "-Z", testEupsStack, "python"])[0] is None)
+        os.environ["EUPS_PATH"] = self.tmpdir
+        self.assert_(self.forward(["flavor"])[0] is None)
+
+        self.assert_(daemon.EupsDaemon(self.sock).stop())
+        self.assert_(not daemon.EupsDaemon(self.sock).isRunning())
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        DaemonTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
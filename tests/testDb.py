@@ -5,7 +5,12 @@ Tests for eups.db
 
 import os
 import shutil
+import tempfile
 import unittest
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import testCommon
 from testCommon import testEupsStack
 
@@ -469,6 +474,7 @@ class ChainFileTestCase(unittest.TestCase):
 
 
 from eups.db import Database
+from eups.db.Database import _ParsedFiles
 
 class DatabaseTestCase(unittest.TestCase):
 
@@ -716,6 +722,145 @@ class DatabaseTestCase(unittest.TestCase):
 
         os.rename(self.pycur+".bak", self.pycur)
 
+    def testJournal(self):
+        jfile = os.path.join(self.dbpath, "_journal_")
+        if os.path.exists(jfile):
+            os.remove(jfile)
+        self.assert_(self.db.getGeneration() is None)
+        self.assert_(self.db.getJournal() is None)
+
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"))
+        try:
+            self.db.declare(base)
+            gen = self.db.getGeneration()
+            self.assert_(gen > 0)
+            self.assertEqual(self.db.getJournal(),
+                             [(gen, "declare", "base", "1.0", "Linux", None)])
+
+            self.db.assignTag("beta", "base", "1.0")
+            self.db.assignTag("user:my", "base", "1.0")
+            self.assertEqual(self.db.getGeneration(), gen + 1)
+            self.assertEqual(self.db.getJournal(gen),
+                             [(gen+1, "assignTag", "base", "1.0", "Linux", "beta")])
+            self.assertEqual(Database(self.userdb).getJournal()[0][1:],
+                             ("assignTag", "base", "1.0", "Linux", "user:my"))
+
+            self.db.unassignTag("beta", "base")
+            self.db.undeclare(base)
+            changes = self.db.getJournal(gen + 1)
+            self.assertEqual([c[0] for c in changes], [gen + 2, gen + 3])
+            self.assertEqual(changes[0][1:],
+                             ("unassignTag", "base", None, None, "beta"))
+            self.assertEqual(changes[1][1:],
+                             ("undeclare", "base", "1.0", "Linux", None))
+
+            self.assertEqual(self.db.getJournal(gen + 3), [])
+            self.assert_(self.db.getJournal(gen + 4) is None)
+        finally:
+            if os.path.exists(jfile):
+                os.remove(jfile)
+
+    def testIndex(self):
+        jfile = os.path.join(self.dbpath, "_journal_")
+        ifile = os.path.join(self.dbpath, "_index_")
+        for f in (jfile, ifile):
+            if os.path.exists(f):
+                os.remove(f)
+
+        names = sorted(self.db.findProductNames())
+        self.assert_(not os.path.exists(ifile)) # no journal, so no index
+
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"))
+        pyfile = os.path.join(self.dbpath, "python", "9.9.version")
+        try:
+            self.db.declare(base)
+            self.assertEqual(sorted(self.db.findProductNames()), sorted(names + ["base"]))
+            self.assert_(os.path.exists(ifile))
+            self.assertEqual(sorted(self.db.findVersions("python")), ["2.5.2", "2.6"])
+            self.assertEqual(self.db.findTags("python", "2.5.2", "Linux"), ["current"])
+
+            # a version declared behind the journal's back isn't seen...
+            shutil.copyfile(os.path.join(self.dbpath, "python", "2.6.version"), pyfile)
+            self.assert_(not self.db.isDeclared("python", "9.9"))
+
+            # ...until the index is rebuilt
+            self.db.buildIndex()
+            self.assert_(self.db.isDeclared("python", "9.9", "Linux"))
+
+            # without an index, the product directories are read, and no index is written
+            self.db.clearIndex()
+            os.remove(pyfile)
+            self.assert_(not self.db.isDeclared("python", "9.9"))
+            self.assertEqual(sorted(self.db.findVersions("python")), ["2.5.2", "2.6"])
+            self.assert_(not os.path.exists(ifile))
+
+            # changes that are journaled keep the index up to date
+            self.db.assignTag("beta", "base", "1.0")
+            self.assertEqual(self.db.getTagAssignments("base"), [("beta", "1.0", "Linux")])
+            self.assertEqual(self.db.findFlavors("base"), ["Linux"])
+            self.db.undeclare(base)
+            self.assert_("base" not in self.db.findProductNames())
+            self.assert_(not self.db.isDeclared("base"))
+
+            index = pickle.load(open(ifile, "rb"))
+            self.assertEqual(index["generation"], self.db.getGeneration())
+            self.assertEqual(sorted(index["products"]), names)
+
+            # an index that's out of date isn't used
+            index["products"]["python"]["versions"]["9.9"] = ["Linux"]
+            index["generation"] -= 1
+            pickle.dump(index, open(ifile, "wb"))
+            self.assert_(not self.db.isDeclared("python", "9.9"))
+        finally:
+            for f in (jfile, ifile, pyfile):
+                if os.path.exists(f):
+                    os.remove(f)
+            self.db.clearIndex()
+
+    def testParsedFiles(self):
+        vfile = os.path.join(self.dbpath, "python", "2.6.version")
+        cache = _ParsedFiles(2)
+        vf = cache.get(VersionFile, vfile, "python", "2.6")
+        self.assert_(cache.get(VersionFile, vfile, "python", "2.6") is vf)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # the least recently used file is forgotten
+        cache.get(ChainFile, self.pycur)
+        cache.get(VersionFile, os.path.join(self.dbpath, "python", "2.5.2.version"))
+        self.assert_(cache.get(VersionFile, vfile, "python", "2.6") is not vf)
+
+        # files are reread if they change
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(tmpdir, "current.chain")
+            shutil.copyfile(self.pycur, tfile)
+            self.assertEqual(cache.get(ChainFile, tfile).getVersion("Linux"), "2.5.2")
+            contents = open(tfile).read().replace("2.5.2", "2.6")
+            fd = open(tfile, "w"); fd.write(contents); fd.close()
+            self.assertEqual(cache.get(ChainFile, tfile).getVersion("Linux"), "2.6")
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # and as soon as they're written by a Database
+        jfile = os.path.join(self.dbpath, "_journal_")
+        try:
+            self.db.assignTag("beta", "python", "2.6")
+            self.assertEqual(self.db.getTaggedVersion("beta", "python", "Linux"), ("python", "2.6"))
+            self.db.assignTag("beta", "python", "2.5.2")
+            self.assertEqual(self.db.getTaggedVersion("beta", "python", "Linux"), ("python", "2.5.2"))
+            self.db.unassignTag("beta", "python")
+            self.assertEqual(self.db.getTaggedVersion("beta", "python", "Linux"), ("python", None))
+        finally:
+            tfile = os.path.join(self.dbpath, "python", "beta.chain")
+            for f in (jfile, tfile):
+                if os.path.exists(f):
+                    os.remove(f)
+            self.db.clearIndex()
+
     def testDeclare(self):
         pdir = self.db._productDir("base")
         if os.path.isdir(pdir):
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+Tests for eups.distrib.Repositories' parallel installs and for retrieving
+files from web servers
+"""
+
+import os
+import re
+import shutil
+import select
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import testCommon
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from eups.distrib.Repositories import _InstallJobs
+from eups.distrib import server
+
+class InstallJobsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = open(os.devnull, "w")
+        self.finished = []
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.tmpdir, True)
+
+    def build(self, product, sleep=0.0, fail=False):
+        # run in the forked process
+        time.sleep(sleep)
+        if fail:
+            raise RuntimeError("%s didn't build" % product)
+        open(os.path.join(self.tmpdir, product), "w").close()
+
+    def finish(self, product):
+        # run in this process
+        self.assert_(os.path.exists(os.path.join(self.tmpdir, product)))
+        self.finished.append(product)
+
+    def add(self, jobs, product, deps=[], sleep=0.0, fail=False):
+        jobs.add(product, "1.0", [(d, "1.0") for d in deps],
+                 self.build, (product, sleep, fail), self.finish, (product,))
+
+    def testParallel(self):
+        jobs = _InstallJobs(3, self.log)
+        t0 = time.time()
+        for p in ["a", "b", "c"]:
+            self.add(jobs, p, sleep=0.5)
+        self.assert_(jobs.isPending("a", "1.0"))
+        jobs.wait()
+        self.assert_(time.time() - t0 < 1.4)
+        self.assertEqual(sorted(self.finished), ["a", "b", "c"])
+        self.assert_(not jobs.isPending("a", "1.0"))
+
+    def testDependencies(self):
+        jobs = _InstallJobs(4, self.log)
+        self.add(jobs, "a", sleep=0.3)
+        self.add(jobs, "b")
+        self.add(jobs, "c", ["a", "b"])
+        self.add(jobs, "d", ["c"])
+
+        tagged = []
+        jobs.whenInstalled([("c", "1.0")], tagged.append, "c")
+        jobs.whenInstalled([("x", "1.0")], tagged.append, "x")
+        self.assertEqual(tagged, ["x"])
+
+        jobs.wait()
+        self.assertEqual(self.finished[2:], ["c", "d"])
+        self.assertEqual(tagged, ["x", "c"])
+
+    def testFailure(self):
+        jobs = _InstallJobs(2, self.log)
+        self.add(jobs, "a", fail=True)
+        self.add(jobs, "b", ["a"])
+        self.assertRaises(RuntimeError, jobs.wait)
+        self.assertEqual(self.finished, [])
+        self.assert_(not os.path.exists(os.path.join(self.tmpdir, "b")))
+
+    def testOtherChildren(self):
+        # builds don't reap this process's other children
+        pid = os.fork()
+        if pid == 0:
+            os._exit(3)
+        try:
+            jobs = _InstallJobs(2, self.log)
+            self.add(jobs, "a", sleep=0.3)
+            jobs.wait()
+            self.assertEqual(self.finished, ["a"])
+        finally:
+            self.assertEqual(os.waitpid(pid, 0), (pid, 3 << 8))
+
+    def spawn(self, product, wfd):
+        # run in the forked process: start a command that outlives the build,
+        # and holds the write end of a pipe open for as long as it runs
+        subprocess.Popen(["sleep", "30"], stdout=wfd)
+        open(os.path.join(self.tmpdir, product), "w").close()
+        time.sleep(30)
+
+    def testAbort(self):
+        rfd, wfd = os.pipe()
+        # as installed by eups.lock.takeLocks()
+        handler = signal.signal(signal.SIGTERM, lambda *args: None)
+        try:
+            jobs = _InstallJobs(2, self.log)
+            jobs.add("a", "1.0", [], self.spawn, ("a", wfd), self.finish, ("a",))
+            os.close(wfd)
+            wfd = None
+            for i in range(50):
+                if os.path.exists(os.path.join(self.tmpdir, "a")):
+                    break
+                time.sleep(0.1)
+
+            jobs.abort()
+            # the command the build started is killed too, closing the pipe
+            self.assertEqual(select.select([rfd], [], [], 5)[0], [rfd])
+            self.assertEqual(os.read(rfd, 1), b"")
+            self.assertEqual(self.finished, [])
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+            os.close(rfd)
+            if wfd is not None:
+                os.close(wfd)
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve the server's files (a dict), supporting keep-alive and Range requests"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        srv.requests.append((self.path, self.headers.get("Range"), self.client_address))
+
+        data = srv.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = '"%d"' % len(data)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start = 0
+        mat = re.search(r"^bytes=(\d+)-$", self.headers.get("Range") or "")
+        if mat and self.headers.get("If-Range") == etag:
+            start = int(mat.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        if self.path in srv.truncate:   # send half the file, then hang up
+            srv.truncate.remove(self.path)
+            self.wfile.write(data[start:(start + len(data))//2])
+            self.close_connection = True
+        else:
+            self.wfile.write(data[start:])
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FileServerTestCase(unittest.TestCase):
+    """Run a FileServer for the tests to retrieve files from"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = open(os.devnull, "w")
+
+        self.server = FileServer(("127.0.0.1", 0), FileHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.truncate = []
+        for i in range(4):
+            self.server.files["/f%d" % i] = os.urandom(300000 + i)
+        self.base = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.log.close()
+        shutil.rmtree(self.tmpdir, True)
+
+    def fetch(self, path):
+        filename = os.path.join(self.tmpdir, os.path.basename(path))
+        server.WebTransporter(self.base + path, log=self.log).cacheToFile(filename)
+
+        fd = open(filename, "rb")
+        data = fd.read()
+        fd.close()
+        self.assertEqual(data, self.server.files[path])
+        self.assert_(not os.path.exists(filename + ".part"))
+
+class WebTransporterTestCase(FileServerTestCase):
+
+    def testKeepAlive(self):
+        self.fetch("/f0")
+        self.fetch("/f1")
+        self.assertEqual(len(set([r[2] for r in self.server.requests])), 1)
+
+        self.assertRaises(server.RemoteFileNotFound, self.fetch, "/missing")
+        self.fetch("/f2")
+
+    def testResume(self):
+        self.server.truncate.append("/f0")
+        self.fetch("/f0")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1][1], "bytes=150000-")
+
+    def testPartialFile(self):
+        # a partial file left behind by an earlier attempt, unchanged on the server
+        data = self.server.files["/f0"]
+        partial = os.path.join(self.tmpdir, "f0.part")
+        fd = open(partial, "wb"); fd.write(data[:1000]); fd.close()
+        fd = open(partial + ".validator", "w"); fd.write('"%d"' % len(data)); fd.close()
+
+        self.fetch("/f0")
+        self.assertEqual(self.server.requests[-1][1], "bytes=1000-")
+        self.assert_(not os.path.exists(partial + ".validator"))
+
+        # ...and one that's out of date
+        fd = open(partial, "wb"); fd.write(b"x"*1000); fd.close()
+        fd = open(partial + ".validator", "w"); fd.write('"1"'); fd.close()
+        self.fetch("/f0")
+
+    def testPrefetch(self):
+        paths = sorted(self.server.files.keys()) + ["/missing"]
+        fetched = []
+        def fetch(path):
+            self.fetch(path)
+            fetched.append(path)
+
+        server.prefetch([(fetch, (p,)) for p in paths], 3, log=self.log)
+        self.assertEqual(sorted(fetched), paths[:-1])
+
+    def testConditional(self):
+        filename = os.path.join(self.tmpdir, "f0")
+        trx = server.WebTransporter(self.base + "/f0", log=self.log)
+        self.assertEqual(trx.cacheToFileIfChanged(filename, '"1"'), (True, '"300000"'))
+        self.assertEqual(trx.cacheToFileIfChanged(filename + "2", '"300000"'), (False, '"300000"'))
+        self.assert_(not os.path.exists(filename + "2"))
+
+class DownloadCacheTestCase(FileServerTestCase):
+
+    def setUp(self):
+        FileServerTestCase.setUp(self)
+
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_USERDATA"] = os.path.join(self.tmpdir, "userdata")
+        self.fileCache0 = server.DistribServer._fileCache.copy()
+
+    def tearDown(self):
+        server.DistribServer._fileCache.clear()
+        server.DistribServer._fileCache.update(self.fileCache0)
+        os.environ.clear()
+        os.environ.update(self.environ0)
+
+        FileServerTestCase.tearDown(self)
+
+    def read(self, filename):
+        fd = open(filename, "rb")
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def testCacheFile(self):
+        distServer = server.DistribServer(self.base, log=self.log)
+
+        a = os.path.join(self.tmpdir, "a")
+        distServer.cacheFile(a, self.base + "/f0")
+        self.assertEqual(self.read(a), self.server.files["/f0"])
+
+        # as if in a new process
+        server.DistribServer._fileCache.clear()
+        b = os.path.join(self.tmpdir, "b", "f0")
+        distServer.cacheFile(b, self.base + "/f0")
+        self.assertEqual(self.read(b), self.server.files["/f0"])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(os.stat(b).st_nlink, 3) # a, b, and the cached copy
+
+        # the file's changed on the server
+        server.DistribServer._fileCache.clear()
+        self.server.files["/f0"] += b"x"
+        distServer.cacheFile(b, self.base + "/f0")
+        self.assertEqual(self.read(b), self.server.files["/f0"])
+        self.assertEqual(os.stat(a).st_size, 300000)
+
+    def testPrune(self):
+        cache = server.DownloadCache(os.path.join(self.tmpdir, "cache"), 650000)
+        for i in range(3):
+            filename = os.path.join(self.tmpdir, "f%d" % i)
+            self.fetch("/f%d" % i)
+            cache.add(self.base + "/f%d" % i, filename, "v%d" % i)
+            cache.lookup(self.base + "/f0") # f0 is used most recently
+            time.sleep(0.01)
+
+        self.assertEqual(cache.lookup(self.base + "/f0")[0], "v0")
+        self.assertEqual(cache.lookup(self.base + "/f1"), None)
+        self.assertEqual(cache.lookup(self.base + "/f2")[0], "v2")
+
+        # modifying a cached file invalidates it
+        fd = open(os.path.join(self.tmpdir, "f2"), "ab"); fd.write(b"x"); fd.close()
+        self.assertEqual(cache.lookup(self.base + "/f2"), None)
+
+        cache.clear()
+        self.assertEqual(cache.lookup(self.base + "/f0"), None)
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        InstallJobsTestCase,
+        WebTransporterTestCase,
+        DownloadCacheTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
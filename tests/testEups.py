@@ -14,6 +14,10 @@ import shutil
 import unittest
 import tempfile
 import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from eups.utils import StringIO
 from testCommon import testEupsStack
 
@@ -21,6 +25,7 @@ from eups import TagNotRecognized, ProductNotFound, EupsException
 from eups.Eups import Eups
 from eups.stack import ProductStack
 from eups.utils import Quiet
+import eups.utils as utils
 import eups.hooks
 
 class EupsTestCase(unittest.TestCase):
@@ -402,6 +407,60 @@ class EupsTestCase(unittest.TestCase):
         self.assertEqual(prod.tablefile,
                           os.path.join(self.dbpath, "Linux","newprod","1.1", "ups", "newprod.table"))
 
+    def testDeclareProducts(self):
+        pdir = os.path.join(testEupsStack, "Linux", "newprod")
+        pdir10 = os.path.join(pdir, "1.0")
+        pdir11 = os.path.join(pdir, "1.1")
+        table = os.path.join(pdir10, "ups", "newprod.table")
+
+        stack = self.eups.versions[testEupsStack]
+        saves = []
+        def save(*args, **kwargs):
+            saves.append(args)
+            return ProductStack.save(stack, *args, **kwargs)
+        stack.save = save
+
+        # a batch only saves the cache once
+        failed = self.eups.declareProducts([("newprod", "1.0", pdir10, table, "beta"),
+                                            ("newprod", "1.1", pdir11, table),
+                                            ("python", "2.5.2", None, None, ["beta"])])
+        self.assertEqual(failed, [])
+        self.assertEqual(len(saves), 1)
+        for noCache in (False, True):
+            self.assertEqual(self.eups.findProduct("newprod", "1.0", noCache=noCache).tags, ["beta"])
+            self.assertEqual(self.eups.findProduct("newprod", "1.1", noCache=noCache).dir, pdir11)
+            self.assertIn("beta", self.eups.findProduct("python", "2.5.2", noCache=noCache).tags)
+        self.assert_(os.path.exists(self.betachain))
+
+        # a failure undoes the whole batch
+        chainfile = os.path.join(self.dbpath, "newprod", "beta.chain")
+        with open(chainfile) as fd:
+            chain = fd.read()
+        self.assertRaises(EupsException, self.eups.declareProducts,
+                          [("newprod", "1.2", pdir11, table, "beta"),
+                           ("gurn", "1.0", os.path.join(pdir, "nosuchdir"), table)])
+        self.assert_(not os.path.exists(os.path.join(self.dbpath, "newprod", "1.2.version")))
+        self.assert_(not os.path.exists(os.path.join(self.dbpath, "gurn")))
+        with open(chainfile) as fd:
+            self.assertEqual(fd.read(), chain)
+        for noCache in (False, True):
+            self.assert_(self.eups.findProduct("newprod", "1.2", noCache=noCache) is None)
+            self.assertEqual(self.eups.findProduct("newprod", self.eups.tags.getTag("beta"),
+                                                   noCache=noCache).version, "1.0")
+        self.assertEqual(Eups().findProduct("newprod", self.eups.tags.getTag("beta")).version, "1.0")
+
+        # ...unless it isn't atomic
+        err = utils.stderr
+        utils.stderr = StringIO.StringIO()
+        try:
+            failed = self.eups.declareProducts([("newprod", "1.2", pdir11, table, "beta"),
+                                                ("gurn", "1.0", os.path.join(pdir, "nosuchdir"), table)],
+                                               atomic=False)
+        finally:
+            utils.stderr = err
+        self.assertEqual(failed, ["gurn"])
+        self.assertEqual(self.eups.findProduct("newprod", self.eups.tags.getTag("beta")).version, "1.2")
+
     def testUserTags(self):
         self.assert_(self.eups.tags.isRecognized("mine"),
                      "user:mine not recognized")
@@ -498,6 +557,49 @@ class EupsTestCase(unittest.TestCase):
         self.assertNotIn("TCLTK_DIR", os.environ)
         self.assertNotIn("SETUP_TCLTK", os.environ)
 
+    def testUnsetupFromUndoRecord(self):
+        self.environ0 = os.environ.copy()
+        path0 = os.environ["PATH"]
+
+        self.eups.setup("python")
+        self.assertIn(utils.undoEnvNameFor("python"), os.environ)
+        self.assertIn(utils.undoEnvNameFor("tcltk"), os.environ)
+        self.assertNotEqual(os.environ["PATH"], path0)
+        environ = os.environ.copy()
+
+        tablefiles = [os.path.join(testEupsStack, "Linux", p, v, "ups", "%s.table" % p)
+                      for p, v in [("python", "2.5.2"), ("tcltk", "8.5a4")]]
+        for f in tablefiles:
+            os.rename(f, f + ".hidden")
+        try:
+            # unsetup doesn't need the table files...
+            self.eups.unsetup("python")
+            self.assertEqual(os.environ["PATH"], path0)
+            for var in ["PYTHON_DIR", "SETUP_PYTHON", "TCLTK_DIR", "SETUP_TCLTK",
+                        utils.undoEnvNameFor("python"), utils.undoEnvNameFor("tcltk")]:
+                self.assertNotIn(var, os.environ)
+
+            # ...unless there's no undo record that matches the setup
+            for var, val in [(utils.undoEnvNameFor("python"), None),
+                             (utils.setupEnvNameFor("python"), environ["SETUP_PYTHON"] + " ")]:
+                os.environ = environ.copy()
+                if val is None:
+                    del os.environ[var]
+                else:
+                    os.environ[var] = val
+                q = Quiet(self.eups)
+                self.assertRaises(Exception, self.eups.unsetup, "python")
+                del q
+        finally:
+            for f in tablefiles:
+                os.rename(f + ".hidden", f)
+
+        os.environ = environ.copy()
+        del os.environ[utils.undoEnvNameFor("python")]
+        self.eups.unsetup("python")
+        self.assertEqual(os.environ["PATH"], path0)
+        self.assertNotIn("SETUP_TCLTK", os.environ)
+
     def testRemove(self):
         os.environ = self.environ0
 
@@ -518,6 +620,166 @@ class EupsTestCase(unittest.TestCase):
 
         # need to test for recursion
 
+    def testDependencyGraph(self):
+        prod = self.eups.findProduct("python", "2.5.2")
+        graph = self.eups.getDependencyGraph()
+
+        deps = [(p[0].name, p[1], p[2]) for p in self.eups.getDependentProducts(prod, topological=True)]
+        self.assertEqual(deps, [("tcltk", False, 2), ("implicitProducts", True, 3)])
+
+        # the table files are only analysed once
+        nexpansions = len(graph._expansions)
+        self.assert_(nexpansions > 0)
+        self.assertEqual([(p[0].name, p[1], p[2]) for p in
+                          self.eups.getDependentProducts(prod, topological=True)], deps)
+        self.assertEqual(len(graph._expansions), nexpansions)
+
+        productDictionary = {}
+        graph.dependencies(prod.getTable(), recursive=True, productDictionary=productDictionary)
+        depths = graph.topologicalDepths(productDictionary, prod)
+        self.assertEqual(depths, {"python" : 1, "tcltk" : 2, "implicitProducts" : 3})
+        self.assertEqual(graph.findCycles(productDictionary), [])
+
+        tcltk = self.eups.findProduct("tcltk", "8.5a4")
+        self.assertEqual(graph.dependents(productDictionary)[tcltk], [(prod, False)])
+
+        # changing the declared products forgets what's known
+        self.eups.assignTag("beta", "python", "2.5.2")
+        try:
+            self.assertEqual(graph._expansions, {})
+        finally:
+            self.eups.unassignTag("beta", "python")
+
+    def testUsesIndex(self):
+        pdir = tempfile.mkdtemp()
+        fd = open(os.path.join(pdir, "newprod.table"), "w")
+        fd.write("setupRequired(tcltk)\n")
+        fd.close()
+
+        analysed = []
+        def getDependentProducts(eupsenv):
+            def wrapper(product, *args, **kwargs):
+                analysed.append(product.name)
+                return Eups.getDependentProducts(eupsenv, product, *args, **kwargs)
+            eupsenv.getDependentProducts = wrapper
+            return eupsenv
+
+        jfile = os.path.join(self.dbpath, "_journal_")
+        try:
+            self.eups.declare("newprod", "1.0", pdir, tablefile=os.path.join(pdir, "newprod.table"))
+            users = [u[0] for u in getDependentProducts(Eups()).uses("tcltk")]
+            self.assertEqual(sorted(users), ["newprod", "python"])
+            self.assertIn("python", analysed)
+
+            # the saved index means that nothing needs to be analysed...
+            del analysed[:]
+            self.assertEqual(sorted([u[0] for u in getDependentProducts(Eups()).uses("tcltk")]), sorted(users))
+            self.assertEqual(analysed, [])
+
+            # ...except the products that have changed
+            self.eups.declare("newprod", "2.0", pdir, tablefile=os.path.join(pdir, "newprod.table"))
+            users = [u[:2] for u in getDependentProducts(Eups()).uses("tcltk")]
+            self.assertIn(("newprod", "2.0"), users)
+            self.assertEqual(set(analysed), set(["newprod"]))
+        finally:
+            shutil.rmtree(pdir)
+            for f in [jfile, os.path.join(self.dbpath, "_index_")]:
+                if os.path.exists(f):
+                    os.remove(f)
+
+    def testSetupCache(self):
+        pdir = tempfile.mkdtemp()
+        tablefile = os.path.join(pdir, "newprod.table")
+        fd = open(tablefile, "w")
+        fd.write("setupRequired(tcltk)\nenvSet(NEWPROD_HOME, ${HOME})\n")
+        fd.close()
+
+        resolved = []
+        def setup(environ):
+            os.environ = environ.copy()
+            eupsenv = Eups()
+            def wrapper(productName, *args, **kwargs):
+                if productName != eups.hooks.config.Eups.defaultProduct["name"]:
+                    resolved.append(productName)
+                return Eups.setup(eupsenv, productName, *args, **kwargs)
+            eupsenv.setup = wrapper
+            # the order of the commands that set independent variables isn't defined
+            cmds = sorted(eups.setup("newprod", eupsenv=eupsenv))
+            return cmds, os.environ.copy()
+
+        jfile = os.path.join(self.dbpath, "_journal_")
+        environ = os.environ.copy()
+        try:
+            eups.hooks.config.Eups.cacheSetups = True
+            self.eups.declare("newprod", "1.0", pdir, tablefile=tablefile)
+
+            cmds, env = setup(environ)
+            self.assertEqual(env["SETUP_NEWPROD"].split()[:2], ["newprod", "1.0"])
+            self.assertIn("SETUP_TCLTK", env)
+            self.assertEqual(sorted(resolved), ["newprod", "tcltk"])
+
+            # the saved outcome is replayed...
+            del resolved[:]
+            self.assertEqual(setup(environ), (cmds, env))
+            self.assertEqual(resolved, [])
+
+            # ...when the variables that the setup doesn't use change
+            environ["NEWPROD_UNUSED"] = "1"
+            self.assertEqual(setup(environ)[1]["SETUP_NEWPROD"], env["SETUP_NEWPROD"])
+            self.assertEqual(resolved, [])
+
+            # ...but not when those that it uses do
+            environ["HOME"] = os.path.join(environ.get("HOME", ""), "other")
+            self.assertEqual(setup(environ)[1]["NEWPROD_HOME"], environ["HOME"])
+            self.assertEqual(sorted(resolved), ["newprod", "tcltk"])
+
+            # ...or a table file changes
+            del resolved[:]
+            fd = open(tablefile, "a")
+            fd.write("envSet(NEWPROD_EDITED, 1)\n")
+            fd.close()
+            self.assertEqual(setup(environ)[1].get("NEWPROD_EDITED"), "1")
+            self.assertEqual(sorted(resolved), ["newprod", "tcltk"])
+
+            # ...or a product's declared
+            del resolved[:]
+            self.eups.declare("newprod", "2.0", pdir, tablefile=tablefile, tag="current")
+            self.assertEqual(setup(environ)[1]["SETUP_NEWPROD"].split()[:2], ["newprod", "2.0"])
+            self.assertEqual(sorted(resolved), ["newprod", "tcltk"])
+            #
+            # In "verify" mode, the setup's carried out anyway and differences are reported
+            #
+            eups.hooks.config.Eups.cacheSetups = "verify"
+            cmds, env = setup(environ)
+
+            del resolved[:]
+            err = utils.stdwarn
+            utils.stdwarn = StringIO.StringIO()
+            try:
+                self.assertEqual(setup(environ), (cmds, env))
+                self.assertEqual(utils.stdwarn.getvalue(), "")
+
+                cacheDir = os.path.join(os.environ["EUPS_USERDATA"], "_caches_", "_setups_")
+                for f in os.listdir(cacheDir):
+                    f = os.path.join(cacheDir, f)
+                    with open(f, "rb") as fd:
+                        saved = pickle.load(fd)
+                    saved["env"] = [(k, "1.0" if k == "NEWPROD_EDITED" else v) for k, v in saved["env"]]
+                    with open(f, "wb") as fd:
+                        pickle.dump(saved, fd)
+
+                self.assertEqual(setup(environ), (cmds, env))
+                self.assertIn("NEWPROD_EDITED: saved 1.0, found 1", utils.stdwarn.getvalue())
+            finally:
+                utils.stdwarn = err
+            self.assertEqual(sorted(resolved), ["newprod", "newprod", "tcltk", "tcltk"])
+        finally:
+            eups.hooks.config.Eups.cacheSetups = False
+            shutil.rmtree(pdir)
+            for f in [jfile, os.path.join(self.dbpath, "_index_")]:
+                if os.path.exists(f):
+                    os.remove(f)
+
 class EupsCacheTestCase(unittest.TestCase):
     def setUp(self):
         self.environ0 = os.environ.copy()
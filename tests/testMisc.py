@@ -13,6 +13,12 @@ import testCommon
 from testCommon import testEupsStack
 
 import eups
+from eups.VersionParser import VersionParser
+from eups.VersionCompare import VersionCompare, sortArgs, keysAgree
+from eups.VersionConstraint import VersionConstraint
+from eups.utils import cmp, cmp_or_key, _OrderedDict
+from eups import utils
+from eups.graph import Graph
 
 class MiscTestCase(unittest.TestCase):
 
@@ -25,6 +31,223 @@ class MiscTestCase(unittest.TestCase):
     def testNothing(self):
         pass
 
+    def testOrderedDict(self):
+        # the substitute for collections.OrderedDict used with python 2.6
+        d = _OrderedDict()
+        for k in "cab":
+            d[k] = k.upper()
+        d["c"] = "C2"
+        self.assertEqual(list(d), ["c", "a", "b"])
+        self.assertEqual(d.pop("c"), "C2")
+        d["c"] = "C3"                   # now the last
+        self.assertEqual(d.items(), [("a", "A"), ("b", "B"), ("c", "C3")])
+        self.assertEqual(d.pop("x", None), None)
+        self.assertRaises(KeyError, d.pop, "x")
+        self.assertEqual(d.popitem(last=False), ("a", "A"))
+        self.assertEqual(d.popitem(), ("c", "C3"))
+        del d["b"]
+        self.assertEqual((len(d), d.keys()), (0, []))
+        self.assertRaises(KeyError, d.popitem)
+
+    def testEnvPath(self):
+        path = utils.EnvPath("/a:/b::/a:/c")
+        self.assertEqual(list(path), ["/a", "/b", "/c"])
+        self.assertIn("/b", path)
+
+        path.prepend("/c")
+        path.prepend("/d")
+        path.append("/a")
+        path.append("/e")
+        self.assertEqual(str(path), "/d:/c:/a:/b:/e")
+
+        path.remove("/a")
+        path.remove("/goober")
+        self.assertNotIn("/a", path)
+        self.assertEqual(str(path), "/d:/c:/b:/e")
+        self.assertEqual(len(path), 4)
+
+        self.assertEqual(str(utils.EnvPath("x  y x", " ")), "x y")
+
+class GraphTestCase(unittest.TestCase):
+    """Test eups.graph, and the utils functions built on it"""
+
+    def testTopologicalSort(self):
+        graph = {"a" : ["b", "c"], "b" : ["d"], "c" : ["d", "e"], "e" : ["c"], "f" : []}
+        self.assertEqual(list(utils.topologicalSort(graph)), [["d", "f"], ["b", "c", "e"], ["a"]])
+
+        self.assertRaises(RuntimeError, lambda: list(utils.topologicalSort(graph, checkCycles=True)))
+        self.assertEqual(sorted([sorted(c) for c in utils.stronglyConnectedComponents(graph)]),
+                         [["a"], ["b"], ["c", "e"], ["d"], ["f"]])
+
+    def testGraph(self):
+        # a chain far longer than the recursion limit
+        n = 10*sys.getrecursionlimit()
+        g = Graph(dict((i, [i + 1]) for i in range(n)))
+        self.assertEqual(len(g), n + 1)
+        self.assertEqual(len(g.stronglyConnectedComponents()), n + 1)
+        self.assertEqual(g.cycles(), [])
+
+        g.addEdge(n, 0)
+        self.assertEqual(len(g.stronglyConnectedComponents()), 1)
+        self.assertEqual(len(g.cycles()[0]), n + 1)
+
+        g = Graph()
+        g.addEdges("app", ["img", "util"])
+        g.addEdges("img", ["util", "base"])
+        g.addEdges("util", ["base"])
+        g.addEdge("doc", "base")
+        self.assertEqual([sorted([g.nodes[i] for i in l]) for l in g.layers()],
+                         [["base"], ["doc", "util"], ["img"], ["app"]])
+
+class VersionParserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+
+    def tearDown(self):
+        os.environ = self.environ0
+
+    def eval(self, expr, **symbols):
+        parser = VersionParser(expr)
+        for k, v in symbols.items():
+            parser.define(k, v)
+        return parser.eval()
+
+    def testEval(self):
+        self.assert_(self.eval("FLAVOR == Linux", flavor="Linux"))
+        self.assert_(not self.eval("flavor == Darwin", flavor="Linux"))
+        self.assert_(self.eval("type == exact", type=["build", "exact"]))
+        self.assert_(self.eval("type != exact", type=["build"]))
+        self.assert_(self.eval("(flavor == Linux) && (type == build)", flavor="Linux", type="build"))
+        self.assert_(self.eval("flavor == Darwin or flavor =~ ^Lin", flavor="Linux"))
+        self.assert_(self.eval("!(flavor == Darwin)", flavor="Linux"))
+        self.assert_(self.eval("depth < 3", depth=2))
+        self.assert_(not self.eval(""))
+        self.assertRaises(RuntimeError, self.eval, "(flavor == Linux", flavor="Linux")
+
+    def testEnvironment(self):
+        os.environ["EUPS_TEST_VAR"] = "3"
+        self.assert_(self.eval("${EUPS_TEST_VAR} == 3"))
+        self.assert_(self.eval("${EUPS_TEST_UNDEFINED:-7} > 3"))
+        self.assertRaises(RuntimeError, self.eval, "${EUPS_TEST_UNDEFINED} == 3")
+
+        self.assert_(VersionParser.compile("${EUPS_TEST_VAR} == 3").usesEnvironment)
+        self.assert_(not VersionParser.compile("flavor == Linux").usesEnvironment)
+
+    def testCompile(self):
+        cond = VersionParser.compile("flavor == Linux || type == build")
+        self.assert_(VersionParser.compile("flavor == Linux || type == build") is cond)
+        self.assert_(cond(dict(flavor="Linux")))
+        self.assert_(cond(dict(flavor="Darwin", type=["build"])))
+        self.assert_(not cond(dict(flavor="Darwin", type=["exact"])))
+        self.assert_(not cond(dict(FLAVOR="Linux"), caseSensitive=True))
+
+class VersionCompareTestCase(unittest.TestCase):
+
+    # versions of the sort found in real stacks
+    corpus = """
+        0 1 2 10 20 0.9 0.10 0.11 1.0 1.0.0 1.0.1 1.0.2 1.1 1.2 1.10 1.2.3 1.2.3a 1.2.3b 2.0 2.0.0 2.0.1b3
+        2.5.2 2.6 2.7.3 3.0 3.5.1 3006.2 1.5.7.1 8.5 8.5a4 8.5.1 8.6 1.0.5p4 1.0.5p10 1.0.5m1
+        2.2.1 2.2.1p1 2.2.1p2 1.2.3-1 1.2.3-2 1.2.3+1 1.2.3+2 1.2.3-1+1 1.2.3-1+2 1.2.3-2+1
+        1.2-rc1 1.2-rc2 1.2-rc4 1.2+h1 1.2-rc1+h1 1.2.3+svn100 1.2.3+svn666 1.2.3+svn1000 1.2.3-svn666
+        1.2.3+rvn1000 1.2.3+tvn666 10.1 10.1+1 10.1+2 10.1-1 11.0 11.0+3 11.0-1-g1234 12.0.rc1 12.0.rc1+1
+        v9 v9_1 v10 v10_1 v10_2 v11 w.2016.9 w.2016.20 w.2016.21 w.2017.1 master master-g1234abc
+        master-gabcdef0 tickets-DM-1234 rel-0-8-2 rel-0-8-3 rel-0-9-0 1.0a1 1.0b1 1.0rc1 1.0rc2
+        2.0.alpha 2.0.beta 2.0.0-rc1 2.0.0-rc2 4.8.1.lsst1 4.8.1.lsst2 4.8.1.lsst10 2.4.0.lsst
+        1.8.5 1.8.10 2.1.0 2.1.0.1 5.0.0+2 5.0.0-2 5.0.0-2+3 0.4.9 0.4.10 1.46.0 1.46.0+2
+        3.2.3 3.2.3+3 4.1.3 4.1.3.lsst1 2.0.0-1-gabc123+4 1.3.0.rc2 1.3.0
+        """.split()
+
+    def setUp(self):
+        self.vc = VersionCompare()
+
+    def testKeyAgreesWithCompare(self):
+        corpus = list(self.corpus)
+        for root, dirs, files in os.walk(os.path.join(testEupsStack, "ups_db")):
+            corpus += [re.sub(r"\.version$", "", f) for f in files if f.endswith(".version")]
+
+        bad = []
+        for v1 in corpus:
+            for v2 in corpus:
+                if cmp(self.vc.key(v1), self.vc.key(v2)) != self.vc.compare(v1, v2):
+                    bad.append((v1, v2))
+        self.assertEqual(bad, [])
+
+        shuffled = corpus[::-1]
+        self.assertEqual(sorted(shuffled, **sortArgs(self.vc, shuffled)),
+                         sorted(shuffled, **cmp_or_key(self.vc)))
+
+        pairs = [(str(i), v) for i, v in enumerate(shuffled)]
+        self.assertEqual([p[1] for p in sorted(pairs, **sortArgs(self.vc, pairs, lambda p: p[1]))],
+                         sorted(shuffled, **cmp_or_key(self.vc)))
+
+    def testKnownDifferences(self):
+        # compare() compares 5a4 and 10 as strings, so isn't self-consistent
+        self.assertEqual(self.vc.compare("8.5a4", "8.10"), 1)
+        self.assertEqual(self.vc.compare("8.10", "8.6"), 1)
+        self.assertEqual(self.vc.compare("8.6", "8.5a4"), 1)
+        self.assertEqual(self.vc.compare("1.2.3rc1", "1.2.10"), 1)
+        # ... so sortArgs() falls back to compare() when versions have such components
+        for vers in (["8.10", "8.6", "8.5a4"], ["1.2.10", "1.2.3rc1", "1.2.4"], ["1.01-2", "1.1-1"],
+                     ["1_1-2", "1.1-1"]):
+            self.assert_(not keysAgree(self.vc, vers))
+            self.assertEqual(sorted(vers, **sortArgs(self.vc, vers)), sorted(vers, **cmp_or_key(self.vc)))
+        self.assertEqual(sorted(["1.2.10", "1.2.3rc1"], **sortArgs(self.vc, ["1.2.10", "1.2.3rc1"])),
+                         ["1.2.10", "1.2.3rc1"])
+        self.assert_(keysAgree(self.vc, ["8.10", "8.6", "8.5-a+4", "1.2.3"]))
+
+    def testKeyCache(self):
+        vc = VersionCompare()
+        vc.maxKeys = 10
+        for i in range(100):
+            vc.key("1.%d" % i)
+        self.assertEqual(len(vc._keys), 10)
+        self.assertIn("1.99", vc._keys)
+
+    def testSubclass(self):
+        class Reversed(VersionCompare):
+            def compare(self, v1, v2, mustReturnInt=True):
+                return -VersionCompare.compare(self, v1, v2, mustReturnInt)
+
+        self.assert_(self.vc.hasKey())
+        self.assert_(not Reversed().hasKey())
+        vers = ["1.0", "2.0", "1.10"]
+        self.assertEqual(sorted(vers, **sortArgs(Reversed(), vers)), ["2.0", "1.10", "1.0"])
+        self.assertEqual(sorted(vers, **sortArgs(lambda a, b: cmp(a, b), vers)), ["1.0", "1.10", "2.0"])
+
+class VersionConstraintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vc = VersionCompare()
+
+    def compare(self, op, v1, v2):
+        c = self.vc(v1, v2, mustReturnInt=False)
+        return {"<" : c < 0, "<=" : c <= 0, "==" : c == 0, ">=" : c >= 0, ">" : c > 0}[op]
+
+    def testMatch(self):
+        match = lambda v, expr: VersionConstraint.compile(expr).match(v, self.compare)
+
+        self.assertEqual(match("2.0", ">= 1.2"), "2.0")
+        self.assertEqual(match("1.0", ">= 1.2"), None)
+        self.assertEqual(match("0.4", ">= 1.2 || < 0.5"), "0.4")
+        self.assertEqual(match("1.0", ">= 1.2 || < 0.5"), None)
+        self.assertEqual(match("1.5", ">= 1.2 && < 2"), "1.5")
+        self.assertEqual(match("2.5", ">= 1.2 && < 2"), None)
+        self.assertFalse(match("1.0", ">= 1.2 && < 2"))
+        self.assertEqual(match("1.2.3", "1.2.3 or 2.0"), "1.2.3")
+        self.assertEqual(match("master", ">= 1.2"), None) # can't be ordered
+
+    def testFilter(self):
+        vers = ["0.4", "1.0", "1.2", "1.10", "2.0", "3.0"]
+        constraint = VersionConstraint.compile(">= 1.2 && < 3.0 || < 0.5")
+        self.assert_(VersionConstraint.compile(">= 1.2 && < 3.0 || < 0.5") is constraint)
+
+        # n.b. && short circuits, so "0.4" doesn't match
+        self.assertEqual(constraint.filter(vers, self.compare), ["1.2", "1.10", "2.0"])
+        self.assertEqual(constraint.filter([(v, i) for i, v in enumerate(vers)], self.compare, lambda e: e[0]),
+                         [("1.2", 2), ("1.10", 3), ("2.0", 4)])
+        self.assertEqual([v for v in vers if constraint.match(v, self.compare)], constraint.filter(vers, self.compare))
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -32,6 +255,10 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         MiscTestCase,
+        GraphTestCase,
+        VersionParserTestCase,
+        VersionCompareTestCase,
+        VersionConstraintTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
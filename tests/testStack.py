@@ -11,6 +11,8 @@ from testCommon import testEupsStack
 from eups.Product import ProductNotFound, Product
 
 from eups.stack import ProductFamily
+from eups.VersionCompare import VersionCompare
+from eups.utils import cmp_or_key
 
 class ProductFamilyTestCase(unittest.TestCase):
 
@@ -33,6 +35,45 @@ class ProductFamilyTestCase(unittest.TestCase):
         self.assert_(not self.fam.hasVersion("3.1"))
         self.assert_(self.fam.removeVersion("3.2"))
 
+    def testSortedVersions(self):
+        for v in "3.10 3.1 3.2-rc1 3.2 2.0".split():
+            self.fam.addVersion(v, "/opt/LInux/magnum/" + v)
+        self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1") # replace an existing version
+        self.assertEqual(self.fam.getSortedVersions(), "2.0 3.1 3.2-rc1 3.2 3.10".split())
+        self.assertEqual(self.fam.getLatestVersion(), "3.10")
+        self.assertEqual(self.fam.getLatestVersion(match=lambda v: v.startswith("3.2")), "3.2")
+        self.assertEqual(self.fam.getLatestVersion(match=lambda v: False), None)
+
+        self.fam.assignTag("current", "3.10")
+        self.assert_(self.fam.removeVersion("3.10"))
+        self.assertEqual(self.fam.getLatestVersion(), "3.2")
+        self.assert_(not self.fam.isTagAssigned("current"))
+
+        # a different comparison function
+        self.assertEqual(self.fam.getSortedVersions(lambda a, b: (a > b) - (a < b)),
+                         "2.0 3.1 3.2 3.2-rc1".split())
+
+        # families pickled before the order was maintained
+        del self.fam._sorted
+        self.assertEqual(self.fam.getSortedVersions(), "2.0 3.1 3.2-rc1 3.2".split())
+        self.fam.addVersion("4.0", "/opt/LInux/magnum/4.0")
+        self.assertEqual(self.fam.getLatestVersion(), "4.0")
+
+    def testSortedVersionsInconsistent(self):
+        # VersionCompare compares "3rc1" and "10" (or "4") as strings, so
+        # 1.2.3rc1 > 1.2.10 > 1.2.4 > 1.2.3rc1; the latest depends on the order
+        # the versions are sorted in, but must be what compare() makes it
+        for v in "1.2.4 1.2.10 1.2.3rc1 1.2.2".split():
+            self.fam.addVersion(v, "/opt/LInux/magnum/" + v)
+        vers = self.fam.getVersions()
+        self.assertEqual(self.fam.getLatestVersion(),
+                         sorted(vers, **cmp_or_key(VersionCompare().compare))[-1])
+        self.assertEqual(self.fam.getLatestVersion(match=lambda v: v != "1.2.3rc1"), "1.2.10")
+        self.assert_(self.fam.removeVersion("1.2.3rc1"))
+        self.assertEqual(self.fam.getLatestVersion(), "1.2.10")
+        self.fam.addVersion("1.2.11", "/opt/LInux/magnum/1.2.11")
+        self.assertEqual(self.fam.getSortedVersions(), "1.2.2 1.2.4 1.2.10 1.2.11".split())
+
     def testGetProduct(self):
         self.fam.addVersion("3.1", "/opt/LInux/magnum/3.1")
         p = self.fam.getProduct("3.1")
@@ -124,6 +165,92 @@ class ProductFamilyTestCase(unittest.TestCase):
 from eups.stack import ProductStack
 from eups import UnderSpecifiedProduct
 
+class ProductIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.file = os.path.join(testEupsStack, "test.indexDB")
+        lookup = {}
+        for name in "fw afw python eigen".split():
+            lookup[name] = ProductFamily(name)
+            lookup[name].addVersion("1.0", "/opt/sw/Linux/%s/1.0" % name, "none")
+        lookup["afw"].assignTag("stable", "1.0")
+        ProductIndex.write(self.file, lookup)
+
+    def tearDown(self):
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+    def testLookup(self):
+        index = ProductIndex(self.file)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(sorted(index.keys()), ["afw", "eigen", "fw", "python"])
+        self.assertIn("python", index)
+        self.assertNotIn("gurn", index)
+        self.assertRaises(KeyError, index.__getitem__, "gurn")
+        self.assertEqual(index.decodedCount(), 0)
+
+        self.assertEqual(index["afw"].getTaggedProduct("stable").dir,
+                         "/opt/sw/Linux/afw/1.0")
+        self.assertEqual(index.decodedCount(), 1)
+
+    def testUpdate(self):
+        index = ProductIndex(self.file)
+        del index["fw"]
+        self.assertNotIn("fw", index)
+        self.assertRaises(KeyError, index.__delitem__, "fw")
+        index["base"] = ProductFamily("base")
+        index["base"].addVersion("2.0", "/opt/sw/Linux/base/2.0", "none")
+        index["python"].addVersion("2.6", "/opt/sw/Linux/python/2.6", "none")
+        self.assertEqual(sorted(index.keys()), ["afw", "base", "eigen", "python"])
+
+        ProductIndex.write(self.file, index)
+        index = ProductIndex(self.file)
+        self.assertEqual(sorted(index.keys()), ["afw", "base", "eigen", "python"])
+        self.assertEqual(index["base"].getVersions(), ["2.0"])
+        self.assertEqual(sorted(index["python"].getVersions()), ["1.0", "2.6"])
+        self.assertEqual(index["afw"].getTags(), ["stable"])
+
+    def testDelta(self):
+        delta = self.file + ".delta"
+        try:
+            index = ProductIndex(self.file)
+            self.assertEqual(index.replayDelta(delta), (0, 0))
+
+            base = ProductFamily("base")
+            base.addVersion("2.0", "/opt/sw/Linux/base/2.0", "none")
+            size = ProductIndex.appendDelta(delta, self.file, [("base", base), ("fw", None)])
+            self.assertEqual(size, os.stat(delta).st_size)
+            ProductIndex.appendDelta(delta, self.file, [("base", None)])
+
+            index = ProductIndex(self.file)
+            self.assertEqual(index.replayDelta(delta), (os.stat(delta).st_size, 3))
+            self.assertEqual(sorted(index.keys()), ["afw", "eigen", "python"])
+
+            # a partly-written record
+            fd = open(delta, "ab")
+            fd.write(pickle.dumps(("base", base), protocol=2)[:-5])
+            fd.close()
+            index = ProductIndex(self.file)
+            self.assertEqual(index.replayDelta(delta), None)
+
+            # a delta for an earlier version of the index is ignored
+            os.remove(delta)
+            ProductIndex.appendDelta(delta, self.file, [("base", base)])
+            time.sleep(0.01)
+            ProductIndex.write(self.file, ProductIndex(self.file))
+            index = ProductIndex(self.file)
+            self.assertEqual(index.replayDelta(delta), None)
+            self.assertNotIn("base", index)
+        finally:
+            if os.path.exists(delta):
+                os.remove(delta)
+
+    def testNotAnIndex(self):
+        fd = open(self.file, "wb")
+        pickle.dump({}, fd, protocol=2)
+        fd.close()
+        self.assertRaises(ValueError, ProductIndex, self.file)
+
 class ProductStackTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -134,7 +261,7 @@ class ProductStackTestCase(unittest.TestCase):
 
     def testMisc(self):
         self.assertEqual(ProductStack.persistFilename("Linux"),
-                          "Linux.pickleDB1_3_0")
+                          "Linux.indexDB2_2_0")
         self.assertEqual(self.stack.getDbPath(),
                           os.path.join(testEupsStack, "ups_db"))
 
@@ -192,6 +319,12 @@ class ProductStackTestCase(unittest.TestCase):
         for ver in expected:
             self.assertIn(ver, vers)
 
+        self.assertEqual(self.stack.getSortedVersions("fw"), expected)
+        self.assertEqual(self.stack.getSortedVersions("fw", "Linux"), expected)
+        self.assertEqual(self.stack.getLatestVersion("fw", "Linux"), "1.3")
+        self.assertEqual(self.stack.getLatestVersion("fw", None, match=lambda v: v < "1.3"), "1.2")
+        self.assertEqual(self.stack.getLatestVersion("afw", "Linux"), None)
+
     def testAutoSave(self):
         self.assert_(self.stack.saveNeeded())
 
@@ -424,6 +557,9 @@ class ProductStackTestCase(unittest.TestCase):
 
 
 from eups.stack import CacheOutOfSync
+from eups.db import Database
+from eups.stack import ProductIndex
+import pickle
 
 class CacheTestCase(unittest.TestCase):
 
@@ -435,8 +571,9 @@ class CacheTestCase(unittest.TestCase):
             os.remove(self.cache)
 
     def tearDown(self):
-        if os.path.exists(self.cache):
-            os.remove(self.cache)
+        for f in [self.cache, os.path.join(self.dbpath, "Linux.%s" % ProductStack.deltaFileExt)]:
+            if os.path.exists(f):
+                os.remove(f)
 
     def testRegen(self):
         ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=True,
@@ -468,6 +605,176 @@ class CacheTestCase(unittest.TestCase):
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assertRaises(CacheOutOfSync, ps2.save)
 
+    def testDelta(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True, verbose=False)
+        delta = ps._deltaPath(self.cache)
+        self.assert_(not os.path.exists(delta))
+        mtime = os.stat(self.cache).st_mtime
+
+        # changes to a few products are appended to the delta file...
+        ps.addProduct(Product("fw", "1.2", "Linux", "/opt/sw/Linux/fw/1.2", "none"))
+        ps.assignTag("beta", "fw", "1.2", "Linux")
+        ps.removeProduct("doxygen", "Linux", "1.5.7.1")
+        self.assertEqual(sorted(ps.changed["Linux"]), ["doxygen", "fw"])
+        ps.save()
+        self.assert_(not ps.saveNeeded())
+        self.assertEqual(os.stat(self.cache).st_mtime, mtime)
+        self.assertEqual(ps.deltas[self.cache], (os.stat(delta).st_size, 2))
+
+        # ...and replayed when the cache is read
+        ps2 = ProductStack(self.dbpath, autosave=False)
+        ps2.reload("Linux")
+        self.assertEqual(ps2.getTaggedProduct("fw", "Linux", "beta").version, "1.2")
+        self.assert_(not ps2.hasProduct("doxygen", "Linux"))
+        self.assert_(ps2.hasProduct("python", "Linux"))
+
+        # other stacks see that the delta file has grown
+        ps2.addProduct(Product("fw", "1.3", "Linux", "/opt/sw/Linux/fw/1.3", "none"))
+        ps2.save()
+        self.assert_(not ps.cacheIsInSync())
+        ps.addProduct(Product("fw", "1.4", "Linux", "/opt/sw/Linux/fw/1.4", "none"))
+        self.assertRaises(CacheOutOfSync, ps.save)
+        ps.reload("Linux")
+        self.assertEqual(sorted(ps.getVersions("fw", "Linux")), ["1.2", "1.3"])
+
+        # once the delta file is too big, the cache is rewritten
+        maxDeltaRecords = ProductStack.maxDeltaRecords
+        try:
+            ProductStack.maxDeltaRecords = 4
+            for v in "2.0 2.1".split():     # 3 changes so far, and 1 more fits
+                ps.addProduct(Product("fw", v, "Linux", "/opt/sw/Linux/fw/" + v, "none"))
+                ps.save()
+            self.assert_(not os.path.exists(delta))
+            self.assertEqual(ps.deltas[self.cache], (0, 0))
+        finally:
+            ProductStack.maxDeltaRecords = maxDeltaRecords
+
+        ps2 = ProductStack(self.dbpath, autosave=False)
+        ps2.reload("Linux")
+        self.assertEqual(ps2.lookup["Linux"].decodedCount(), 0)
+        self.assertEqual(sorted(ps2.getVersions("fw", "Linux")), "1.2 1.3 2.0 2.1".split())
+
+        # a full refresh rewrites the cache
+        ps2.refreshFromDatabase()
+        ps2.save()
+        self.assert_(not os.path.exists(delta))
+        self.assert_(not ps2.hasProduct("fw", "Linux"))
+
+    def testLegacyCache(self):
+        ps = ProductStack.fromDatabase(self.dbpath, autosave=False)
+        legacy = os.path.join(self.dbpath, "Linux.%s" % ProductStack.legacyFileExt)
+        fd = open(legacy, "wb")
+        pickle.dump(ps.lookup["Linux"], fd, protocol=2)
+        fd.close()
+        try:
+            self.assert_(not os.path.exists(self.cache))
+            self.assertIn("Linux", ProductStack.findCachedFlavors(self.dbpath))
+
+            ps = ProductStack(self.dbpath, autosave=False)
+            self.assert_(ps.cacheIsUpToDate("Linux"))
+            ps.reload("Linux")
+            self.assert_(isinstance(ps.lookup["Linux"], dict))
+            self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
+
+            # saving writes the current format
+            ps._flavorsUpdated("Linux")
+            ps.save()
+            self.assert_(os.path.exists(self.cache))
+            ps.reload("Linux")
+            self.assert_(isinstance(ps.lookup["Linux"], ProductIndex))
+
+            ps.clearCache("Linux")
+            self.assert_(not os.path.exists(self.cache))
+            self.assert_(not os.path.exists(legacy))
+        finally:
+            if os.path.exists(legacy):
+                os.remove(legacy)
+
+    def testJournal(self):
+        db = Database(self.dbpath)
+        baseidir = os.path.join(testEupsStack, "Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"))
+        base2 = base.clone()
+        base2.version = "2.0"
+        try:
+            db.declare(base)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, verbose=False)
+            self.assertEqual(ps.generations, {self.dbpath: db.getGeneration()})
+            self.assert_(ps.cacheIsUpToDate("Linux"))
+            self.assertEqual(ps.getVersions("base", "Linux"), ["1.0"])
+
+            db.declare(base2)
+            self.assert_(not ps.cacheIsUpToDate("Linux"))
+            gens = {}
+            self.assertEqual(ps._staleProducts("Linux", self.dbpath, gens), set(["base"]))
+            self.assertEqual(gens, {self.dbpath: db.getGeneration()})
+
+            # only the generations the journal was read up to are reported
+            gens = {self.dbpath: db.getGeneration() - 1}
+            ps._staleProducts("Linux", self.dbpath, gens)
+            self.assertEqual(gens, {self.dbpath: db.getGeneration() - 1})
+
+            # the cache is patched rather than rebuilt
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, verbose=False)
+            self.assertEqual(sorted(ps.getVersions("base", "Linux")), ["1.0", "2.0"])
+            self.assert_(ps.cacheIsUpToDate("Linux"))
+            self.assert_(ps.hasProduct("python"))
+
+            db.undeclare(base)
+            db.undeclare(base2)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, verbose=False)
+            self.assert_(not ps.hasProduct("base"))
+            self.assert_(ps.hasProduct("python"))
+        finally:
+            for f in [os.path.join(self.dbpath, "_journal_"),
+                      ps._generationPath(self.cache)]:
+                if os.path.exists(f):
+                    os.remove(f)
+
+    def testReadOnly(self):
+        db = Database(self.dbpath)
+        baseidir = os.path.join(testEupsStack, "Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"))
+        ps = ProductStack(self.dbpath, autosave=False)
+        try:
+            # no journal, so the cache can't be trusted
+            ProductStack.fromCache(self.dbpath, "Linux", autosave=True,
+                                   updateCache=True, verbose=False)
+            self.assert_(ProductStack.fromCacheReadOnly(self.dbpath, "Linux") is None)
+
+            db.declare(base)
+            db.undeclare(base)
+            os.remove(self.cache)
+            ProductStack.fromCache(self.dbpath, "Linux", autosave=True,
+                                   updateCache=True, verbose=False)
+            ro = ProductStack.fromCacheReadOnly(self.dbpath, "Linux")
+            self.assert_(ro.readOnly)
+            self.assertEqual(ro.stale, set())
+            self.assert_(ro.hasProduct("python"))
+
+            # changes are reported rather than read, and nothing is written
+            mtime = os.stat(self.cache).st_mtime
+            db.declare(base)
+            ro = ProductStack.fromCacheReadOnly(self.dbpath, "Linux")
+            self.assertEqual(ro.stale, set(["base"]))
+            self.assert_(not ro.hasProduct("base"))
+            ro.addProduct(base)
+            ro.save()
+            self.assertEqual(os.stat(self.cache).st_mtime, mtime)
+            self.assert_(not ro.cacheIsUpToDate("Linux"))
+        finally:
+            db.undeclare(base)
+            for f in [os.path.join(self.dbpath, "_journal_"),
+                      ps._generationPath(self.cache)]:
+                if os.path.exists(f):
+                    os.remove(f)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -476,6 +783,7 @@ def suite(makeSuite=True):
     return testCommon.makeSuite([
         CacheTestCase,
         ProductFamilyTestCase,
+        ProductIndexTestCase,
         ProductStackTestCase
         ], makeSuite)
 
@@ -4,11 +4,16 @@ Tests for eups.product
 """
 
 import os
+import shutil
+import tempfile
 import unittest
 import testCommon
 from testCommon import testEupsStack
 
-from eups.table import Table
+from eups.table import Table, Action
+from eups import table
+from eups import utils
+from eups.utils import StringIO
 from eups.Eups import Eups
 
 class TableTestCase1(unittest.TestCase):
@@ -119,6 +124,29 @@ class TableTestCase2(unittest.TestCase):
         self.assertNotIn("FOO", os.environ)
         self.assertNotIn("BAR", os.environ)
 
+    def testEnvPrepend(self):
+        os.environ["GOOBPATH"] = "/opt/goob:/usr/goob:/opt/goob"
+        for value, append, delim in [("/usr/local/goob", True, None),
+                                     ("/home/goob", False, None),
+                                     ("/usr/goob", False, None),
+                                     ("/opt/goob:", True, ":"),
+                                     ]:
+            args = ["GOOBPATH", value]
+            if delim:
+                args.append(delim)
+            Action(self.tablefile, Action.envPrepend, args, {"append" : append}).execute(self.eups, 1, True)
+        self.assertEqual(os.environ["GOOBPATH"], "/usr/goob:/home/goob:/opt/goob:/usr/local/goob:")
+
+        Action(self.tablefile, Action.envPrepend, ["GOOBPATH", "/home/goob"],
+               {"append" : False}).execute(self.eups, 1, False)
+        self.assertEqual(os.environ["GOOBPATH"], "/usr/goob:/opt/goob:/usr/local/goob")
+
+        # changes made behind our back are respected
+        os.environ["GOOBPATH"] = "/goob"
+        Action(self.tablefile, Action.envPrepend, ["GOOBPATH", "/home/goob"],
+               {"append" : True}).execute(self.eups, 1, True)
+        self.assertEqual(os.environ["GOOBPATH"], "/goob:/home/goob")
+
     def testEnvSetWithForce(self):
         """ensure use of force does not cause failure"""
         actions = self.table.actions("Linux")
@@ -210,6 +238,118 @@ class ExternalProductsTestCase(unittest.TestCase):
         ]:
             self.assertEqual(self.table.dependencies(listExternalDependencies=led)[i][0].name, productName)
 
+class ActionsCacheTestCase(unittest.TestCase):
+    """
+    Check that the actions selected for a flavor and setup type are remembered
+    """
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        self.tablefile = os.path.join(testEupsStack, "ifElse.table")
+
+    def tearDown(self):
+        os.environ = self.environ0
+
+    def testMemo(self):
+        tbl = Table(self.tablefile, addDefaultProduct=False)
+        actions = tbl.actions("Linux", ["sst"])
+        self.assertEqual(actions[0].args, ["FOO", "SST"])
+        self.assertEqual([a.args for a in tbl.actions("Linux", "sdss")], [["FOO", "SDSS"]])
+
+        self.assertEqual(len(tbl._actionsCache), 2)
+        self.assertEqual(tbl.actions("Linux", ["sst"]), actions)
+        self.assert_(tbl.actions("Linux", ["sst"]) is not actions)
+
+    def testEnvironment(self):
+        # conditions that depend on the environment are evaluated afresh
+        tmpdir = tempfile.mkdtemp()
+        tablefile = os.path.join(tmpdir, "envCondition.table")
+        fd = open(tablefile, "w")
+        fd.write("if (${EUPS_TEST_FLAG:-0} == 1) {\n   envSet(FOO, 1)\n}\n")
+        fd.close()
+        try:
+            tbl = Table(tablefile, addDefaultProduct=False)
+            self.assertEqual(len(tbl.actions("Linux")), 0)
+            os.environ["EUPS_TEST_FLAG"] = "1"
+            self.assertEqual(len(tbl.actions("Linux")), 1)
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+class TableCacheTestCase(unittest.TestCase):
+    """
+    Check that parsed tables are cached between processes
+    """
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        self.userDataDir = tempfile.mkdtemp()
+        os.environ["EUPS_USERDATA"] = self.userDataDir
+        self.tablefile = os.path.join(self.userDataDir, "mwi.table")
+        shutil.copy(os.path.join(testEupsStack, "mwi.table"), self.tablefile)
+
+    def tearDown(self):
+        os.environ = self.environ0
+        shutil.rmtree(self.userDataDir, True)
+
+    def testCache(self):
+        cacheFile = table.tableCacheFile(self.tablefile)
+        self.assert_(cacheFile.startswith(self.userDataDir))
+        self.assert_(not os.path.exists(cacheFile))
+
+        hits, misses = table.tableCacheStats["hits"], table.tableCacheStats["misses"]
+        tbl = Table(self.tablefile)
+        self.assert_(os.path.exists(cacheFile))
+        self.assertEqual(table.tableCacheStats["misses"], misses + 1)
+
+        cached = Table(self.tablefile)
+        self.assertEqual(table.tableCacheStats["hits"], hits + 1)
+        for flavor in ["Darwin", "Linux", "Linux+2.1.2"]:
+            self.assertEqual([str(a) for a in cached.actions(flavor)],
+                             [str(a) for a in tbl.actions(flavor)])
+
+        # a changed table is parsed again
+        fd = open(self.tablefile, "a")
+        fd.write("envSet(GOOBER, 1)\n")
+        fd.close()
+        tbl = Table(self.tablefile)
+        self.assertEqual(table.tableCacheStats["misses"], misses + 2)
+        self.assertEqual(len(tbl.actions("DarwinX86")), 15)
+
+    def testProductName(self):
+        # the parsed table depends on the product it belongs to
+        self.assertNotEqual(table.tableCacheFile(self.tablefile),
+                            table.tableCacheFile(self.tablefile, productName="mwi"))
+
+    def testMessages(self):
+        fd = open(self.tablefile, "a")
+        fd.write("sourceRequired(goober)\n")
+        fd.close()
+
+        stderr = utils.stderr
+        try:
+            hits = table.tableCacheStats["hits"]
+            for i in range(2):
+                utils.stderr = StringIO.StringIO()
+                Table(self.tablefile)
+                self.assert_("Ignoring unsupported directive sourceRequired" in utils.stderr.getvalue())
+            # the second time, the warning was replayed from the cache
+            self.assertEqual(table.tableCacheStats["hits"], hits + 1)
+        finally:
+            utils.stderr = stderr
+
+    def testPrune(self):
+        cacheDir = os.path.dirname(os.path.dirname(table.tableCacheFile(self.tablefile)))
+        files = []
+        for i in range(5):
+            tablefile = os.path.join(self.userDataDir, "t%d.table" % i)
+            shutil.copy(self.tablefile, tablefile)
+            Table(tablefile)
+            files.append(table.tableCacheFile(tablefile))
+            os.utime(files[-1], (1000 + i, 1000 + i))
+        # using a table keeps it in the cache
+        Table(os.path.join(self.userDataDir, "t0.table"))
+
+        table.pruneTableCache(cacheDir, 3)
+        self.assertEqual([os.path.exists(f) for f in files], [True, False, False, True, True])
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -222,6 +362,8 @@ def suite(makeSuite=True):
         IfElseTestCase,
         EupsVersionTestCase,
         ExternalProductsTestCase,
+        ActionsCacheTestCase,
+        TableCacheTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):